@@ -1,15 +1,45 @@
+import hashlib
 import json
 import os
 import urllib.request
 import webbrowser
 import sys
+import threading
+from collections import OrderedDict
+import data_pack
+import metrics
+import segment_store
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Configuration
 PAGES_DIR = 'hk-bus-time-between-stops-pages'
 HOURLY_BASE = os.path.join(PAGES_DIR, 'times_hourly')
+DAILY_BASE = os.path.join(PAGES_DIR, 'times')
 OUTPUT_JS_FILE = 'dashboard_data.js'
 BRIDGE_DB_URL = "https://raw.githubusercontent.com/hkbus/hk-bus-crawling/refs/heads/gh-pages/routeFareList.min.json"
 
+# Memory budget for parsed times_hourly shards kept across requests (bytes)
+SHARD_CACHE_BYTES = int(os.environ.get('SHARD_CACHE_BYTES', 512 * 1024 * 1024))
+# Parsed dicts take several times the space of the JSON text on disk
+SHARD_SIZE_FACTOR = 6
+# 'auto' uses the NumPy ripple engine when numpy is installed, 'scalar' forces the loop
+RIPPLE_ENGINE = os.environ.get('RIPPLE_ENGINE', 'auto')
+# Per-request progress prints (route search, ripple). Off in the server unless
+# VERBOSE=1, the CLI always shows them
+VERBOSE = os.environ.get('VERBOSE', '0') == '1'
+# Data generation published by data_sync.py; every process (including compute
+# workers) watches this file and invalidates what the new generation changed
+GENERATION_FILE = os.environ.get('DATA_GENERATION_FILE', 'data_generation.json')
+# Routes whose precomputed ripple tables (RouteProfile) are kept in memory,
+# and the memory they may use together (a table grows with the square of the
+# route length once all its start stops are queried)
+ROUTE_PROFILE_CACHE_SIZE = int(os.environ.get('ROUTE_PROFILE_CACHE_SIZE', 128))
+ROUTE_PROFILE_CACHE_BYTES = int(os.environ.get('ROUTE_PROFILE_CACHE_BYTES', 128 * 1024 * 1024))
+
 DAYS = {
     '0': 'Sunday',
     '1': 'Monday',
@@ -20,6 +50,11 @@ DAYS = {
     '6': 'Saturday'
 }
 
+def log(message):
+    """Per-request progress output, printed only when VERBOSE is on."""
+    if VERBOSE:
+        print(message)
+
 def get_json(url):
     try:
         print(f"Downloading route database from {url}...")
@@ -31,24 +66,80 @@ def get_json(url):
         print(f"Error fetching DB: {e}")
         return None
 
+class RouteIndex:
+    """
+    Lookup tables over db['routeList'], built once per loaded database.
+    Only KMB/CTB routes are indexed.
+      variants : route number -> [(key, route_entry, dest_en)] sorted by key
+      postings : stop ID -> [(key, position)] for every occurrence, sorted
+      stops    : key -> stop ID list (KMB first, then CTB)
+      routes   : key -> route number
+      variant_of : key -> (route number, variant index as used by find_route_stops)
+      windows  : key -> valid departure hours per day (see service_windows)
+    """
+    def __init__(self, db):
+        self.db = db
+        self.variants = {}
+        self.postings = {}
+        self.stops = {}
+        self.routes = {}
+        self.variant_of = {}
+        self.windows = {}
+        
+        for key, val in db['routeList'].items():
+            company_list = val.get('co', [])
+            if not ('kmb' in company_list or 'ctb' in company_list):
+                continue
+            route_num = val.get('route')
+            dest = val.get('dest', {}).get('en', 'Unknown')
+            self.variants.setdefault(route_num, []).append((key, val, dest))
+            self.routes[key] = route_num
+            
+            stops = val.get('stops', {}).get('kmb') or val.get('stops', {}).get('ctb') or []
+            self.stops[key] = stops
+            # Parse service hours once at load time; requests reuse the table
+            self.windows[key] = service_windows(val.get('freq'))
+            for pos, sid in enumerate(stops):
+                self.postings.setdefault(sid, []).append((key, pos))
+        
+        for route_num, candidates in self.variants.items():
+            candidates.sort(key=lambda x: x[0])
+            for idx, (key, _, _) in enumerate(candidates):
+                self.variant_of[key] = (route_num, idx)
+        
+        # Sorted postings let overlap queries merge two lists in one pass
+        for plist in self.postings.values():
+            plist.sort()
+
+# Indexes of the current and the previous database, so requests still holding
+# the old ROUTE_DB after a background refresh do not force rebuilds
+_route_indexes = OrderedDict()
+_route_index_lock = threading.Lock()
+
+def get_route_index(db):
+    """Returns the RouteIndex for db, building it on first use for that database."""
+    index = _route_indexes.get(id(db))
+    if index is not None and index.db is db:
+        return index
+    with _route_index_lock:
+        index = _route_indexes.get(id(db))
+        if index is None or index.db is not db:
+            index = RouteIndex(db)
+            _route_indexes[id(db)] = index
+            while len(_route_indexes) > 2:
+                _route_indexes.popitem(last=False)
+        return index
+
 def find_route_stops(db, route_num, variant_index=0, target_dest=None):
-    print(f"Searching for Route {route_num}...")
+    log(f"Searching for Route {route_num}...")
     
-    candidates = []
-    for key, val in db['routeList'].items():
-        # Check for KMB or CTB in company list
-        company_list = val.get('co', [])
-        if val.get('route') == route_num and ('kmb' in company_list or 'ctb' in company_list):
-            dest = val.get('dest', {}).get('en', 'Unknown')
-            candidates.append((key, val, dest))
+    # Variants come pre-filtered to KMB/CTB and sorted by key from the index
+    candidates = get_route_index(db).variants.get(route_num, [])
             
     if not candidates:
-        print(f"Route {route_num} not found in database.")
-        return None, None, None, []
+        log(f"Route {route_num} not found in database.")
+        return None, None, None, [], None
 
-    # Sort candidates to ensure stable ordering (e.g. by key or dest)
-    candidates.sort(key=lambda x: x[0])
-    
     # Prepare variants list for frontend
     variants_info = []
     for idx, (key, val, dest) in enumerate(candidates):
@@ -66,7 +157,7 @@ def find_route_stops(db, route_num, variant_index=0, target_dest=None):
         for idx, (key, val, dest) in enumerate(candidates):
             if dest.strip().lower() == clean_target:
                 variant_index = idx
-                print(f"  Matched target destination '{target_dest}' to variant {idx}")
+                log(f"  Matched target destination '{target_dest}' to variant {idx}")
                 break
         
     # specific variant selection (default to 0)
@@ -75,7 +166,7 @@ def find_route_stops(db, route_num, variant_index=0, target_dest=None):
         
     selected_key, selected_val, dest = candidates[variant_index]
     freq_data = selected_val.get('freq')
-    print(f"Selected: {selected_key} (To: {dest})")
+    log(f"Selected: {selected_key} (To: {dest})")
     
     # Try getting KMB stops first, then CTB
     stop_ids = selected_val['stops'].get('kmb')
@@ -83,8 +174,8 @@ def find_route_stops(db, route_num, variant_index=0, target_dest=None):
         stop_ids = selected_val['stops'].get('ctb')
     
     if not stop_ids:
-        print("No stop list found for Key:", selected_key)
-        return None, None, None, []
+        log(f"No stop list found for Key: {selected_key}")
+        return None, None, None, [], None
     
     # Enrich with names
     enriched_stops = []
@@ -100,47 +191,258 @@ def find_route_stops(db, route_num, variant_index=0, target_dest=None):
         
     return enriched_stops, f"{route_num} to {dest}", stop_ids, variants_info, freq_data
 
-def find_overlapping_routes(db, start_id, end_id, exclude_route=None):
+def find_overlapping_variants(db, start_id, end_id, exclude_route=None):
     """
-    Finds all routes that contain start_id followed eventually by end_id.
-    Returns a list of route numbers.
+    Finds every route variant that serves start_id followed eventually by end_id.
+    Intersects the (sorted) postings of both stops, comparing the first
+    occurrence of each stop on a variant.
+    Returns dicts with route, variant index, dest, key and the start/end stop indices.
     """
+    index = get_route_index(db)
+    starts = index.postings.get(start_id, [])
+    ends = index.postings.get(end_id, [])
     matches = []
     
-    for val in db['routeList'].values():
-        route_num = val.get('route')
-        
-        # Optimization: Skip if it's the same route we are already on
-        if exclude_route and route_num == exclude_route:
-            continue
+    i = j = 0
+    while i < len(starts) and j < len(ends):
+        key_s, key_e = starts[i][0], ends[j][0]
+        if key_s < key_e:
+            i += 1
+        elif key_s > key_e:
+            j += 1
+        else:
+            # Both lists are sorted by (key, position): the current entries are
+            # the first occurrences of each stop on this variant
+            idx_start, idx_end = starts[i][1], ends[j][1]
+            route_num, variant_idx = index.variant_of[key_s]
             
-        # Try both KMB and CTB stop lists
-        stops = val.get('stops', {}).get('kmb', [])
-        if not stops:
-            stops = val.get('stops', {}).get('ctb', [])
-        
-        if start_id in stops and end_id in stops:
+            # Optimization: Skip if it's the same route we are already on
             # Check order: Start must come before End
-            idx_start = stops.index(start_id)
-            idx_end = stops.index(end_id)
+            if not (exclude_route and route_num == exclude_route) and idx_start < idx_end:
+                matches.append({
+                    "route": route_num,
+                    "variant": variant_idx,
+                    "dest": index.variants[route_num][variant_idx][2],
+                    "key": key_s,
+                    "start": idx_start,
+                    "end": idx_end
+                })
             
-            if idx_start < idx_end:
-                 # Check 'co' to ensure it's KMB or CTB
-                 company_list = val.get('co', [])
-                 if 'kmb' in company_list or 'ctb' in company_list:
-                     matches.append(route_num)
-                     
-    # Remove duplicates and sort
-    matches = sorted(list(set(matches)))
+            while i < len(starts) and starts[i][0] == key_s:
+                i += 1
+            while j < len(ends) and ends[j][0] == key_s:
+                j += 1
+    
+    matches.sort(key=lambda m: (m['route'], m['variant']))
     return matches
 
+def find_overlapping_routes(db, start_id, end_id, exclude_route=None):
+    """
+    Finds all routes that contain start_id followed eventually by end_id.
+    Returns a list of route numbers.
+    """
+    matches = find_overlapping_variants(db, start_id, end_id, exclude_route)
+    # Remove duplicates and sort
+    return sorted(set(m['route'] for m in matches))
+
+_generation = {"id": None, "stat": None}
+_generation_lock = threading.Lock()
+# Called as listener(gen, partial) after this process's caches were invalidated
+# for a new generation, to do the same for caches kept elsewhere (server.py)
+GENERATION_LISTENERS = []
+
+def check_data_generation():
+    """
+    Returns the id of the data generation published in GENERATION_FILE (None if
+    there is none). When a new one appears, drops what it changed: parsed shards
+    that were rewritten, route profiles touching changed stop prefixes and the
+    mapped segment store if it was rebuilt. If this process missed a generation,
+    everything is dropped instead.
+    """
+    try:
+        st = os.stat(GENERATION_FILE)
+    except OSError:
+        return _generation['id']
+    stat_key = (st.st_mtime_ns, st.st_size)
+    if stat_key == _generation['stat']:
+        return _generation['id']
+    
+    with _generation_lock:
+        if stat_key == _generation['stat']:
+            return _generation['id']
+        try:
+            with open(GENERATION_FILE, 'r') as f:
+                gen = json.load(f)
+        except (OSError, ValueError):
+            return _generation['id']
+        
+        previous = _generation['id']
+        if gen['id'] != previous:
+            partial = previous is not None and gen.get('previous') == previous
+            apply_data_generation(gen, partial)
+            for listener in GENERATION_LISTENERS:
+                listener(gen, partial)
+            if previous is not None:
+                print(f"Data generation {previous} -> {gen['id']} ({'partial' if partial else 'full'} invalidation)")
+        _generation['id'] = gen['id']
+        _generation['stat'] = stat_key
+        return gen['id']
+
+def apply_data_generation(gen, partial=True):
+    """Invalidates caches for a new generation (everything unless partial)."""
+    if gen.get('store_rebuilt') or not partial:
+        segment_store.reload_store()
+    
+    if not partial:
+        SHARD_CACHE.invalidate()
+        with _route_profiles_lock:
+            _route_profiles.clear()
+        return
+    
+    for rel_path in gen.get('changed_shards', []):
+        SHARD_CACHE.invalidate(os.path.join(PAGES_DIR, rel_path))
+    
+    # Profiles whose segments all start in unchanged prefixes stay valid;
+    # move them over to the new version key
+    prefixes = set(gen.get('changed_prefixes', []))
+    with _route_profiles_lock:
+        kept = OrderedDict()
+        for (stops, _), profile in _route_profiles.items():
+            if not any(sid[:2] in prefixes for sid in stops[:-1]):
+                kept[(stops, gen['id'])] = profile
+        _route_profiles.clear()
+        _route_profiles.update(kept)
+
+def get_data_version():
+    """
+    Short string identifying the travel time data on disk, used to key result
+    caches and ETags. This is the published data generation when there is one,
+    otherwise it changes when the daily sync runs (FETCH_HEAD) or the segment
+    store is rebuilt.
+    """
+    version = check_data_generation()
+    if version:
+        return version
+    
+    parts = []
+    for path in (os.path.join(PAGES_DIR, '.git', 'FETCH_HEAD'), segment_store.STORE_FILE):
+        try:
+            st = os.stat(path)
+            parts.append(f"{path}:{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            pass
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:12]
+
 def load_local_json(filepath):
+    # Data files come from the pack when the JSON is not on disk (see data_pack.py)
     try:
-        with open(filepath, 'r') as f:
-            return json.load(f)
+        return data_pack.read_json(filepath)[0]
     except:
         return {}
 
+class ShardCache:
+    """
+    Process-wide, thread-safe LRU of parsed times_hourly shards.
+    Entries are weighed by an estimate of their in-memory size (JSON file
+    size x SHARD_SIZE_FACTOR, also for shards read from a pack) and evicted least-recently-used first once the
+    total goes over max_bytes. Missing files are cached as empty dicts.
+    """
+    def __init__(self, max_bytes=SHARD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (content_dict, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Parse outside the lock so other threads are not blocked on disk I/O
+        with metrics.span('shard_load'):
+            try:
+                content, file_size = data_pack.read_json(path)
+            except (OSError, ValueError):
+                file_size = 0
+                content = {}
+        size = file_size * SHARD_SIZE_FACTOR
+        metrics.count('shard_loads')
+        metrics.count('shard_bytes', file_size)
+
+        with self._lock:
+            if path not in self._entries:
+                self._entries[path] = (content, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes and len(self._entries) > 1:
+                    _, (_, old_size) = self._entries.popitem(last=False)
+                    self.bytes -= old_size
+                    self.evictions += 1
+        return content
+
+    def invalidate(self, path=None):
+        """Drops one path, or everything when path is None."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self.bytes = 0
+            elif path in self._entries:
+                _, size = self._entries.pop(path)
+                self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+SHARD_CACHE = ShardCache()
+
+def shard_path(day_code, hour, prefix):
+    return os.path.join(HOURLY_BASE, str(day_code), f"{hour:02d}", f"{prefix}.json")
+
+def load_hourly_shard(day_code, hour, prefix):
+    """Parsed times_hourly/<day>/<hour>/<prefix>.json through the shared cache ({} if missing)."""
+    return SHARD_CACHE.get(shard_path(day_code, hour, prefix))
+
+def load_daily_times(prefix):
+    """Parsed times/<prefix>.json (daily average segment times) through the shared cache."""
+    return SHARD_CACHE.get(os.path.join(DAILY_BASE, f"{prefix}.json"))
+
+def shard_segment_time(day_code, hour, start_id, end_id):
+    """
+    (seconds or None, tier) for a segment from the JSON shards, going down the
+    same fallback tiers the segment store is compiled with (see segment_store.fill_slot).
+    """
+    prefix = start_id[:2]
+    
+    def value_at(d, h):
+        val = load_hourly_shard(d, h, prefix).get(start_id, {}).get(end_id)
+        return val if isinstance(val, (int, float)) and val > 0 else 0
+    
+    daily = load_daily_times(prefix).get(start_id, {}).get(end_id)
+    if not (isinstance(daily, (int, float)) and daily > 0):
+        daily = None
+    seconds, tier = segment_store.fill_slot(value_at, int(day_code), hour, daily)
+    return (seconds if seconds > 0 else None), tier
+
+def count_tiers(tier_counts):
+    """Adds per-tier lookup counts ({tier: n}) to the current request's metrics."""
+    for tier, n in tier_counts.items():
+        if n:
+            metrics.count('segment_tier_' + segment_store.TIER_NAMES.get(tier, 'none'), n)
+
 MAX_DAY_CODE = 6
 
 def get_next_day(day_code):
@@ -153,7 +455,44 @@ def get_next_day(day_code):
     except:
         return day_code
 
+# Valid departure hours per day, by freq dict. Filled for every variant when
+# the route index is built, so requests only do a lookup.
+ALL_HOURS = frozenset(range(24))
+ALL_HOURS_WINDOWS = (ALL_HOURS,) * 7
+SERVICE_WINDOW_CACHE_SIZE = 20000
+_service_windows = {}        # canonical freq JSON -> windows
+_service_windows_by_id = {}  # id(freq) -> (freq, windows), skips the JSON key for known dicts
+_service_windows_lock = threading.Lock()
+
+def service_windows(freq_data):
+    """
+    Valid departure hours for each day as a tuple of 7 frozensets indexed by
+    day code, parsed from freq_data once per distinct timetable.
+    """
+    if not freq_data:
+        return ALL_HOURS_WINDOWS
+    entry = _service_windows_by_id.get(id(freq_data))
+    if entry is not None and entry[0] is freq_data:
+        return entry[1]
+    
+    key = json.dumps(freq_data, sort_keys=True)
+    windows = _service_windows.get(key)
+    if windows is None:
+        windows = tuple(frozenset(parse_service_hours(freq_data, str(d))) for d in range(7))
+    with _service_windows_lock:
+        if len(_service_windows_by_id) >= SERVICE_WINDOW_CACHE_SIZE:
+            _service_windows.clear()
+            _service_windows_by_id.clear()
+        _service_windows[key] = windows
+        # Keeping freq_data referenced means its id cannot be reused while cached
+        _service_windows_by_id[id(freq_data)] = (freq_data, windows)
+    return windows
+
 def get_valid_hours_for_day(freq_data, day_code):
+    """Valid departure hours (0-23) for the given day, from the service window table."""
+    return service_windows(freq_data)[int(day_code)]
+
+def parse_service_hours(freq_data, day_code):
     """
     Parses freq_data to return a set of valid hours (0-23) for the given day.
     freq_data format example: 
@@ -246,154 +585,372 @@ def get_valid_hours_for_day(freq_data, day_code):
             
     return valid_hours
 
-def calculate_hourly_data(stops, start_index=0, end_index=None, freq_data=None):
-    chart_data = {}
-    print(f"Scanning local data files (Stops {start_index} to {end_index})...")
-    
+def clamp_stop_range(stops, start_index=0, end_index=None):
+    """Validated (start_index, end_index) for a stop list; start >= end means an empty range."""
     if end_index is None:
         end_index = len(stops) - 1
         
     # Validation
     if start_index < 0: start_index = 0
     if end_index >= len(stops): end_index = len(stops) - 1
-    if start_index >= end_index: 
-        return {k: [None]*24 for k in DAYS}
+    return start_index, end_index
+
+def iter_hourly_data(stops, start_index=0, end_index=None, freq_data=None):
+    """
+    Yields (day_code, day_data) one day at a time in DAYS order, so callers can
+    deliver each day's series as soon as it is ready.
+    """
+    log(f"Scanning local data files (Stops {start_index} to {end_index})...")
+    start_index, end_index = clamp_stop_range(stops, start_index, end_index)
     
-    total_segments_in_range = end_index - start_index
+    # No departure slot in service: nothing to read or compute
+    if start_index >= end_index or not any(service_windows(freq_data)):
+        for k in DAYS:
+            yield k, [None]*24
+        return
+    
+    if np is not None and RIPPLE_ENGINE != 'scalar':
+        # One vectorized pass per day, each yielded before the next is computed
+        yield from get_route_profile(stops).iter_chart_data(start_index, end_index, freq_data)
+        return
     
-    # Optimization: simple cache for the current file being read
-    # structure: { abs_path_string: content_dict }
-    file_cache = {}
+    # Fast path: compiled, memory-mapped store (see segment_store.py).
+    # Otherwise shards are read through the process-wide SHARD_CACHE.
+    store = segment_store.get_store()
     
     for day_code in DAYS:
-        print(f"  Processing {DAYS[day_code]}...")
-        day_data = []
-        
-        # Determine valid hours for this day based on freq_data
-        valid_service_hours = get_valid_hours_for_day(freq_data, day_code) if freq_data else set(range(24))
-        
-        # We iterate through start hours (0-23)
-        for start_hour in range(24):
-            # Filtering: Skip if not in service hours
-            if start_hour not in valid_service_hours:
-                day_data.append(None)
-                continue
-                
-            total_seconds_accumulated = 0
-            segments_found = 0
-            
-            # Start the ripple: We assume the bus starts exactly at `start_hour`:00
-            current_simulated_time = start_hour * 3600
-            
-            # Track the current day context for this specific trip
-            current_trip_day = day_code
-            
-            for i in range(start_index, end_index):
-                start_id = stops[i]
-                end_id = stops[i+1]
-                
-                # Check for day wrap
-                # 86400 seconds = 24 hours
-                # If simulated time exceeds 24h, we are in the next day
-                day_offset = current_simulated_time // 86400
-                
-                # Dwell time assumption (boarding/alighting)
-                dwell_time = 0
-                
-                start_id = stops[i]
-                end_id = stops[i+1]
-                
-                # Check for day wrap
-                day_offset = current_simulated_time // 86400
-                lookup_hour = int((current_simulated_time // 3600) % 24)
-                
-                # Helper to get time from a specific hour
-                def get_time_for_hour(d_code, h, s_id, e_id):
-                    # Handle hour wrap 24 -> 0? No, data is 0-23. 
-                    # If h < 0 or h > 23, we should probably stick to current day or wrap. 
-                    # Simple clamping for adjacent check
-                    if h < 0: h = 23 # prev day? complex. let's just clamp or wrap
-                    if h > 23: h = 0
-                    
-                    # Determine effective day code (simplified for helper)
-                    # We reuse logic from main loop or pass it in? 
-                    # Let's duplicate the path logic for safety/simplicity here involves effective_day
-                    pass
-                
-                # ... Actually let's just do it inline to access all variables
-                
-                # Determine effective day code
-                effective_day = current_trip_day
-                if day_offset > 0:
-                    try:
-                        base_d = int(current_trip_day)
-                        effective_d = (base_d + int(day_offset)) % 7
-                        effective_day = str(effective_d)
-                    except:
-                        pass
-
-                prefix = start_id[:2]
-                
-                # Function to try fetching data
-                def try_fetch(d, h):
-                    p = os.path.join(HOURLY_BASE, str(d), f"{h:02d}", f"{prefix}.json")
-                    if os.path.exists(p):
-                        if p in file_cache:
-                            dt = file_cache[p]
-                        else:
-                            dt = load_local_json(p)
-                            file_cache[p] = dt
-                        
-                        if dt and start_id in dt and end_id in dt[start_id]:
-                             val = dt[start_id][end_id]
-                             if val > 0: return val
-                    return None
+        yield day_code, ripple_day(stops, start_index, end_index, freq_data, day_code, store)
 
-                # 1. Try exact hour
-                segment_time = try_fetch(effective_day, lookup_hour)
-                
-                # 2. Gap Filling: Try adjacent hours if missing
-                if segment_time is None:
-                    # Try previous hour
-                    prev_h = (lookup_hour - 1) % 24
-                    segment_time = try_fetch(effective_day, prev_h)
-                    
-                    if segment_time is None:
-                        # Try next hour
-                        next_h = (lookup_hour + 1) % 24
-                        segment_time = try_fetch(effective_day, next_h)
-
-                if segment_time is not None and segment_time > 0:
-                    # Apply Traffic Multiplier (1.1x) found in original logic
-                    segment_time = segment_time * 1.1
-                    
-                    total_seconds_accumulated += segment_time
-                    total_seconds_accumulated += dwell_time
-                    segments_found += 1
-                    # Ripple effect: Advance the clock
-                    current_simulated_time += segment_time
-                    current_simulated_time += dwell_time
-                else:
-                    # Still missing after fallback
-                    # We will rely on final scaling
-                    # But we SHOULD add dwell time even if moving virtually?
-                    # If we scale up later, dwell time is implicitly scaled up too.
+def calculate_hourly_data(stops, start_index=0, end_index=None, freq_data=None):
+    return dict(iter_hourly_data(stops, start_index, end_index, freq_data))
+
+def calculate_day_data(stops, start_index=0, end_index=None, freq_data=None, day_code='0'):
+    """Single day of calculate_hourly_data (used to compute days in parallel)."""
+    start_index, end_index = clamp_stop_range(stops, start_index, end_index)
+    if start_index >= end_index or not get_valid_hours_for_day(freq_data, day_code):
+        return [None]*24
+    if np is not None and RIPPLE_ENGINE != 'scalar':
+        return get_route_profile(stops).day_chart_data(start_index, end_index, freq_data, day_code)
+    return ripple_day(stops, start_index, end_index, freq_data, day_code, segment_store.get_store())
+
+def ripple_day(stops, start_index, end_index, freq_data, day_code, store):
+    """Scalar ripple for the 24 departure hours of one day over stops[start_index..end_index]."""
+    total_segments_in_range = end_index - start_index
+    
+    log(f"  Processing {DAYS[day_code]}...")
+    day_data = []
+
+    # Valid hours for this day from the service window table
+    valid_service_hours = get_valid_hours_for_day(freq_data, day_code)
+    tier_counts = {}
+
+    # We iterate through start hours (0-23)
+    for start_hour in range(24):
+        # Filtering: Skip if not in service hours
+        if start_hour not in valid_service_hours:
+            day_data.append(None)
+            continue
+
+        total_seconds_accumulated = 0
+        segments_found = 0
+
+        # Start the ripple: We assume the bus starts exactly at `start_hour`:00
+        current_simulated_time = start_hour * 3600
+
+        # Track the current day context for this specific trip
+        current_trip_day = day_code
+
+        for i in range(start_index, end_index):
+            start_id = stops[i]
+            end_id = stops[i+1]
+
+            # Check for day wrap
+            # 86400 seconds = 24 hours
+            # If simulated time exceeds 24h, we are in the next day
+            day_offset = current_simulated_time // 86400
+            lookup_hour = int((current_simulated_time // 3600) % 24)
+
+            # Dwell time assumption (boarding/alighting)
+            dwell_time = 0
+
+            # Determine effective day code
+            effective_day = current_trip_day
+            if day_offset > 0:
+                try:
+                    base_d = int(current_trip_day)
+                    effective_d = (base_d + int(day_offset)) % 7
+                    effective_day = str(effective_d)
+                except:
                     pass
-            
-            # Data Validity Logic
-            if total_segments_in_range > 0 and segments_found < total_segments_in_range * 0.5: # Relaxed from 0.9 to 0.5 given gap filling
-                day_data.append(None)
+
+            # Single probe: gaps were filled ahead of time, hour -> adjacent
+            # hours -> same hour on other days -> daily average
+            if store is not None:
+                segment_time, tier = store.lookup_tier(effective_day, lookup_hour, start_id, end_id)
             else:
-                if segments_found > 0:
-                     # Scale up to account for missing segments
-                     adjusted_time = (total_seconds_accumulated / segments_found) * total_segments_in_range
-                     day_data.append(round(adjusted_time / 60.0, 2))
-                else:
-                    day_data.append(None)
-                
-        chart_data[day_code] = day_data
+                segment_time, tier = shard_segment_time(effective_day, lookup_hour, start_id, end_id)
+            tier_counts[tier] = tier_counts.get(tier, 0) + 1
+
+            if segment_time is not None and segment_time > 0:
+                # Apply Traffic Multiplier (1.1x) found in original logic
+                segment_time = segment_time * 1.1
+
+                total_seconds_accumulated += segment_time
+                total_seconds_accumulated += dwell_time
+                segments_found += 1
+                # Ripple effect: Advance the clock
+                current_simulated_time += segment_time
+                current_simulated_time += dwell_time
+            else:
+                # Still missing after fallback
+                # We will rely on final scaling
+                # But we SHOULD add dwell time even if moving virtually?
+                # If we scale up later, dwell time is implicitly scaled up too.
+                pass
+
+        day_data.append(trip_minutes(total_seconds_accumulated, segments_found, total_segments_in_range))
+    
+    count_tiers(tier_counts)
+    return day_data
+
+def trip_minutes(total_seconds_accumulated, segments_found, total_segments_in_range):
+    """Turns a finished ripple into the chart value (minutes), or None if coverage is too low."""
+    # Data Validity Logic
+    if total_segments_in_range > 0 and segments_found < total_segments_in_range * 0.5: # Relaxed from 0.9 to 0.5 given gap filling
+        return None
+    if segments_found > 0:
+        # Scale up to account for missing segments
+        adjusted_time = (total_seconds_accumulated / segments_found) * total_segments_in_range
+        return round(adjusted_time / 60.0, 2)
+    return None
+
+def load_segment_tensor(stops, start_index, end_index):
+    """
+    Fallback-filled segment times for stops[start_index..end_index] as a
+    float64 array of shape (segments, 7 days, 24 hours), 0.0 where no tier has
+    data, and the uint8 tier of every slot (same shape).
+    Reads the compiled store when available, otherwise the cached JSON shards.
+    """
+    n_segments = end_index - start_index
+    tensor = np.zeros((n_segments, 7, 24))
+    tiers = np.full((n_segments, 7, 24), segment_store.TIER_NONE, dtype=np.uint8)
+    pairs = [(stops[i], stops[i+1]) for i in range(start_index, end_index)]
+    
+    store = segment_store.get_store()
+    if store is not None:
+        view = store.matrix()
+        matrix = np.frombuffer(view, dtype=np.float32).reshape(-1, 7, 24) if view is not None else None
+        tier_matrix = np.frombuffer(store.tiers(), dtype=np.uint8).reshape(-1, 7, 24)
+        for i, (start_id, end_id) in enumerate(pairs):
+            row = store.segments.get((start_id, end_id))
+            if row is None:
+                continue
+            tiers[i] = tier_matrix[row]
+            if matrix is not None:
+                tensor[i] = matrix[row]
+            else:
+                tensor[i] = np.array(store.row(start_id, end_id)).reshape(7, 24)
+    else:
+        # Group segments by shard prefix so each shard is fetched once per hour
+        by_prefix = {}
+        for i, (start_id, end_id) in enumerate(pairs):
+            by_prefix.setdefault(start_id[:2], []).append((i, start_id, end_id))
+        for d in range(7):
+            for h in range(24):
+                for prefix, items in by_prefix.items():
+                    dt = load_hourly_shard(d, h, prefix)
+                    if not dt:
+                        continue
+                    for i, start_id, end_id in items:
+                        val = dt.get(start_id, {}).get(end_id)
+                        if isinstance(val, (int, float)) and val > 0:
+                            tensor[i, d, h] = val
+        # Same fallback tiers as the compiled store
+        for i, (start_id, end_id) in enumerate(pairs):
+            daily = load_daily_times(start_id[:2]).get(start_id, {}).get(end_id)
+            if not (isinstance(daily, (int, float)) and daily > 0):
+                daily = None
+            # float64, like the scalar loop's lookups (the store itself is float32)
+            filled, row_tiers = segment_store.fill_row(tensor[i].ravel().tolist(), daily, 'd')
+            tensor[i] = np.array(filled).reshape(7, 24)
+            tiers[i] = np.frombuffer(bytes(row_tiers), dtype=np.uint8).reshape(7, 24)
+    
+    # Missing / non-positive values all mean "no data"
+    tensor[~(tensor > 0)] = 0.0
+    return tensor, tiers
+
+def service_mask(freq_data):
+    """Boolean (7, 24) array of departure slots inside service hours."""
+    valid = np.zeros((7, 24), dtype=bool)
+    for d, valid_service_hours in enumerate(service_windows(freq_data)):
+        for h in valid_service_hours:
+            valid[d, h] = True
+    return valid
+
+def ripple_cumulative(tensor, tiers=None, days=None):
+    """
+    Vectorized ripple over every segment in tensor (segments, 7, 24), for all
+    7x24 departures (trip start day x start hour at HH:00) at once, or only
+    those of the given start days.
+    Returns (cum_total, cum_found), both shaped (segments, days, 24): the seconds
+    accumulated and segments found after each segment. Uses the same day-wrap,
+    single lookup in the fallback-filled times and 1.1x multiplier as the
+    scalar loop. With tiers, the tier of every lookup is counted in the metrics.
+    """
+    days = np.arange(7) if days is None else np.asarray(days)
+    n_segments = tensor.shape[0]
+    n_days = len(days)
+    cum_total = np.zeros((n_segments, n_days, 24))
+    cum_found = np.zeros((n_segments, n_days, 24), dtype=int)
+    
+    base_day = np.repeat(days, 24).reshape(n_days, 24)
+    current_simulated_time = np.tile(np.arange(24) * 3600.0, (n_days, 1))
+    total_seconds_accumulated = np.zeros((n_days, 24))
+    segments_found = np.zeros((n_days, 24), dtype=int)
+    tier_counts = np.zeros(256, dtype=np.int64)
+    
+    for i in range(n_segments):
+        seg = tensor[i]
+        # Day wrap and lookup hour per slot
+        effective_day = (base_day + (current_simulated_time // 86400).astype(int)) % 7
+        lookup_hour = ((current_simulated_time // 3600) % 24).astype(int)
+        
+        segment_time = seg[effective_day, lookup_hour]
+        if tiers is not None:
+            tier_counts += np.bincount(tiers[i][effective_day, lookup_hour].ravel(), minlength=256)
+        
+        found = segment_time > 0
+        # Apply Traffic Multiplier (1.1x) and advance the clock
+        segment_time = segment_time * 1.1
+        total_seconds_accumulated = np.where(found, total_seconds_accumulated + segment_time, total_seconds_accumulated)
+        current_simulated_time = np.where(found, current_simulated_time + segment_time, current_simulated_time)
+        segments_found = segments_found + found
         
-    return chart_data
+        cum_total[i] = total_seconds_accumulated
+        cum_found[i] = segments_found
+    
+    if tiers is not None:
+        count_tiers({tier: int(n) for tier, n in enumerate(tier_counts) if n})
+    return cum_total, cum_found
+
+class RouteProfile:
+    """
+    Precomputed ripple tables for one stop sequence, so any start/end sub-range
+    is answered from memory instead of re-reading segment data.
+    
+    tensor holds the segment times of the whole route (segments, 7, 24). For
+    every start stop that has been queried, `starts[s]` holds the cumulative
+    (seconds, segments found) after each following segment for all 168
+    departures leaving stop s at HH:00. A query (s, e) is then a single row:
+    cum[e - s - 1].
+    
+    No interpolation is involved: the API only simulates departures on hour
+    boundaries, and the table for start s is built by running the ripple from
+    s itself (arrival times at s from an earlier start are never reused,
+    because the ripple is path dependent). Results are therefore identical to
+    calculate_hourly_data's scalar loop. Service-hour masking is applied when
+    the chart is read, since it only blanks slots and never changes others.
+    """
+    def __init__(self, stops):
+        self.stops = tuple(stops)
+        self.tensor, self.tiers = load_segment_tensor(self.stops, 0, len(self.stops) - 1)
+        self.starts = {}
+        self.nbytes = self.tensor.nbytes + self.tiers.nbytes
+        self._lock = threading.Lock()
+    
+    def chart_data(self, start_index, end_index, freq_data=None):
+        return dict(self.iter_chart_data(start_index, end_index, freq_data))
+    
+    def iter_chart_data(self, start_index, end_index, freq_data=None):
+        """
+        Yields (day_code, day_data) in DAYS order. For a start stop not in
+        `starts` yet, each day is its own ripple pass (the same values as the
+        full pass) and is yielded as soon as it is done; the full table is
+        kept once all seven are.
+        """
+        n = end_index - start_index
+        valid = service_mask(freq_data)
+        
+        table = self.starts.get(start_index)
+        if table is not None:
+            for day_code in DAYS:
+                d = int(day_code)
+                yield day_code, day_row(table[0], table[1], d, n, valid[d])
+            return
+        
+        parts = []
+        for day_code in DAYS:
+            d = int(day_code)
+            cum_total, cum_found = ripple_cumulative(self.tensor[start_index:], self.tiers[start_index:], [d])
+            parts.append((cum_total, cum_found))
+            yield day_code, day_row(cum_total, cum_found, 0, n, valid[d])
+        # Segment counts fit in int16; seconds stay float64 so results match the scalar loop
+        table = (np.concatenate([p[0] for p in parts], axis=1),
+                 np.concatenate([p[1] for p in parts], axis=1).astype(np.int16))
+        with self._lock:
+            if start_index in self.starts:
+                return
+            self.starts[start_index] = table
+            self.nbytes += table[0].nbytes + table[1].nbytes
+        trim_route_profiles()
+
+    def day_chart_data(self, start_index, end_index, freq_data, day_code):
+        """
+        chart_data(...)[day_code] for one day alone (process pool workers).
+        Without a table for start_index, only that day's ripple is run, over
+        just the queried range, and nothing is kept.
+        """
+        d = int(day_code)
+        n = end_index - start_index
+        valid = service_mask(freq_data)
+        table = self.starts.get(start_index)
+        if table is not None:
+            return day_row(table[0], table[1], d, n, valid[d])
+        cum_total, cum_found = ripple_cumulative(self.tensor[start_index:end_index], self.tiers[start_index:end_index], [d])
+        return day_row(cum_total, cum_found, 0, n, valid[d])
+
+def day_row(cum_total, cum_found, i, n, valid_day):
+    """Chart minutes of the 24 departures in day column i of a cumulative table, at segment n."""
+    return [
+        trip_minutes(float(cum_total[n - 1, i, h]), int(cum_found[n - 1, i, h]), n)
+        if valid_day[h] else None
+        for h in range(24)
+    ]
+
+# Route profiles by (stop sequence, data version)
+_route_profiles = OrderedDict()
+_route_profiles_lock = threading.Lock()
+
+def get_route_profile(stops):
+    """Returns the cached RouteProfile for a stop sequence, building it on first use."""
+    key = (tuple(stops), get_data_version())
+    with _route_profiles_lock:
+        profile = _route_profiles.get(key)
+        if profile is not None:
+            _route_profiles.move_to_end(key)
+            return profile
+    
+    profile = RouteProfile(stops)
+    with _route_profiles_lock:
+        _route_profiles[key] = profile
+    trim_route_profiles()
+    return profile
+
+def trim_route_profiles():
+    """Drops the least recently used profiles beyond ROUTE_PROFILE_CACHE_SIZE / _BYTES (the newest one stays)."""
+    with _route_profiles_lock:
+        total = sum(p.nbytes for p in _route_profiles.values())
+        while len(_route_profiles) > 1 and (len(_route_profiles) > ROUTE_PROFILE_CACHE_SIZE
+                                            or total > ROUTE_PROFILE_CACHE_BYTES):
+            _, evicted = _route_profiles.popitem(last=False)
+            total -= evicted.nbytes
+
+def calculate_hourly_data_vectorized(stops, start_index, end_index, freq_data=None):
+    """
+    NumPy version of the ripple in calculate_hourly_data, answered from the
+    route's cached RouteProfile. Output is identical to the scalar loop.
+    """
+    return get_route_profile(stops).chart_data(start_index, end_index, freq_data)
 
 def generate_js(chart_data, title):
     content = f"""
@@ -405,6 +962,8 @@ window.chartData = {json.dumps(chart_data)};
     print(f"Data saved to {OUTPUT_JS_FILE}")
 
 def main():
+    global VERBOSE
+    VERBOSE = True
     if len(sys.argv) > 1:
         route_input = sys.argv[1]
     else:
@@ -414,11 +973,11 @@ def main():
     if not db:
         return
 
-    enriched_stops, title, raw_stop_ids, variants = find_route_stops(db, route_input)
+    enriched_stops, title, raw_stop_ids, variants, freq_data = find_route_stops(db, route_input)
     if not enriched_stops:
         return
         
-    chart_data = calculate_hourly_data(raw_stop_ids)
+    chart_data = calculate_hourly_data(raw_stop_ids, freq_data=freq_data)
     generate_js(chart_data, title)
     
     print("Opening dashboard...")
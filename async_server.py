@@ -0,0 +1,335 @@
+import asyncio
+import http
+import json
+import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import data_sync
+import metrics
+import response_encoding
+import server
+
+# asyncio entry point for the API.
+#
+# Serves /api/route, /api/search, /api/overlap, /api/plan, /api/metrics and POST /api/batch with the same response
+# builders as BusRouteHandler, but identical requests that arrive while one
+# is still being computed share that computation instead of starting their
+# own (e.g. several users opening the same route during rush hour). That
+# includes /api/route?stream=1, the dashboard's route load: clients asking
+# for a route being streamed read the same stream (SharedStream).
+#
+#     python async_server.py
+
+PORT = server.PORT
+# Threads running the (blocking) response builders
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 8))
+
+# key -> future of the computation currently in flight for that key
+_inflight = {}
+# ('route', version) + args -> SharedStream of a /api/route?stream=1 computation
+# in flight (its `finished` task is in _inflight under the same key)
+_streams = {}
+STATS = {"requests": 0, "computed": 0, "coalesced": 0}
+
+
+async def coalesce(key, fn, *args):
+    """
+    Runs fn(*args) in the executor, unless an identical call (same key) is
+    already running, in which case its result is awaited instead.
+    """
+    fut = _inflight.get(key)
+    if fut is None:
+        STATS["computed"] += 1
+        fut = asyncio.get_running_loop().run_in_executor(None, fn, *args)
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        STATS["coalesced"] += 1
+    # shield: one client going away must not cancel the others' result
+    return await asyncio.shield(fut)
+
+
+class SharedStream:
+    """
+    One streamed computation (a blocking generator of chunks, advanced in the
+    executor) read by every client that asks for it while it runs: chunks
+    already produced are replayed, then each new one is passed on as it comes.
+    `finished` resolves to finish() once the generator is exhausted.
+    """
+    def __init__(self, chunks, finish):
+        self.chunks = []
+        self.done = False
+        self._new = asyncio.Event()
+        self.finished = asyncio.get_running_loop().create_task(self._run(chunks, finish))
+
+    async def _run(self, chunks, finish):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.chunks.append(chunk)
+                self._new.set()
+                self._new = asyncio.Event()
+        finally:
+            self.done = True
+            self._new.set()
+        return await loop.run_in_executor(None, finish)
+
+    async def follow(self):
+        """Async iterator over every chunk, from the first (a client leaving does not stop the others)."""
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await self._new.wait()
+
+
+async def route_stream(key, args, version):
+    """
+    (status, body, etag) like server.get_route_stream, but concurrent callers
+    for the same key share one computation: a cold stream is a SharedStream
+    (body is its follow() iterator), and a plain /api/route computation in
+    flight is awaited so its cached result is sent instead.
+    """
+    loop = asyncio.get_running_loop()
+    shared = _streams.get(key)
+    if shared is None:
+        if key in _inflight:
+            STATS["coalesced"] += 1
+            await asyncio.shield(_inflight[key])
+        status, result, etag = await loop.run_in_executor(None, server.get_route_stream, args, version)
+        if status != 200 or isinstance(result, bytes):
+            return status, result, etag
+        shared = _streams.get(key)
+        if shared is None:
+            # Nothing is computed until the generator is advanced
+            STATS["computed"] += 1
+            shared = _streams[key] = SharedStream(result, lambda: server.get_route_result(args, version))
+            _inflight[key] = shared.finished
+
+            def forget(task):
+                _streams.pop(key, None)
+                _inflight.pop(key, None)
+                if not task.cancelled():
+                    task.exception()  # raised to the plain requests waiting on it
+            shared.finished.add_done_callback(forget)
+        else:
+            result.close()
+            STATS["coalesced"] += 1
+    else:
+        STATS["coalesced"] += 1
+    return 200, shared.follow(), server.route_etag(args, version)
+
+
+def _static_response(path, content_type, accept_encoding):
+    """(body, headers) for a static file, compressed at the highest level (cached) when accepted."""
+    body, key = response_encoding.read_static(path)
+    return response_encoding.negotiate(body, accept_encoding, content_type, key, best=True)
+
+
+async def dispatch_post(target, body):
+    """Returns (status, content_type, body bytes, extra headers) for a POST request."""
+    if urllib.parse.urlparse(target).path != '/api/batch':
+        return 404, 'application/json', json.dumps({"error": "Not found"}).encode(), {}
+    try:
+        request = json.loads(body or b'{}')
+    except ValueError:
+        return 400, 'application/json', json.dumps({"error": "Invalid JSON body"}).encode(), {}
+    status, payload = await asyncio.get_running_loop().run_in_executor(None, server.build_batch_response, request)
+    return status, 'application/json', response_encoding.dumps(payload), {}
+
+
+async def dispatch(target, headers):
+    """
+    Returns (status, content_type, body, extra headers) for a GET request.
+    body is bytes, or an async iterator of byte chunks for streamed responses.
+    """
+    parsed = urllib.parse.urlparse(target)
+    query = urllib.parse.parse_qs(parsed.query)
+
+    if parsed.path == '/api/route':
+        try:
+            args = server.parse_route_query(query)
+        except ValueError:
+            args = None
+        if not args:
+            return 400, 'application/json', json.dumps({"error": "Missing route id or invalid start/end/variant"}).encode(), {}
+        version = server.current_data_version()
+        etag = server.route_etag(args, version)
+        if server.etag_matches(headers.get('if-none-match'), etag):
+            server.record_access(args)
+            return 304, None, b'', server.route_cache_headers(etag)
+        if query.get('stream', ['0'])[0] == '1':
+            status, result, etag = await route_stream(('route', version) + args, args, version)
+            if status != 200:
+                return status, 'application/json', result, {}
+            if isinstance(result, bytes):
+                return status, 'application/x-ndjson', result, server.route_cache_headers(etag)
+            extra = server.route_cache_headers(etag)
+            result, encoding_headers = response_encoding.negotiate_stream(
+                result, headers.get('accept-encoding'), 'application/x-ndjson')
+            if 'Content-Encoding' in encoding_headers:
+                extra['ETag'] = response_encoding.weak_etag(etag)
+            extra.update(encoding_headers)
+            return status, 'application/x-ndjson', result, extra
+        status, body, etag = await coalesce(('route', version) + args, server.get_route_result, args, version)
+        if status == 200:
+            server.record_access(args)
+        return status, 'application/json', body, server.route_cache_headers(etag) if etag else {}
+
+    elif parsed.path == '/api/search':
+        q = query.get('q', [''])[0]
+        status, payload = await coalesce(('search', q.strip().lower()), server.build_search_response, q)
+
+    elif parsed.path == '/api/overlap':
+        args = server.parse_overlap_query(query)
+        if not args:
+            return 400, 'application/json', json.dumps({"error": "Missing start or end stop id"}).encode(), {}
+        status, body = await coalesce(('overlap',) + args, server.get_overlap_result, args)
+        return status, 'application/json', body, {}
+
+    elif parsed.path == '/api/plan':
+        try:
+            args = server.parse_plan_query(query)
+        except ValueError:
+            args = None
+        if not args:
+            return 400, 'application/json', json.dumps({"error": "Missing or invalid from/to/day/hour"}).encode(), {}
+        status, payload = await coalesce(('plan',) + args, server.build_plan_response, *args)
+
+    elif parsed.path == '/api/metrics':
+        return 200, metrics.CONTENT_TYPE, metrics.render().encode(), {}
+
+    elif parsed.path in ('/', '/index.html', '/dashboard.html'):
+        content_type = 'text/html; charset=utf-8'
+        body, extra = await asyncio.get_running_loop().run_in_executor(
+            None, _static_response, 'dashboard.html', content_type, headers.get('accept-encoding'))
+        return 200, content_type, body, extra
+
+    else:
+        return 404, 'application/json', json.dumps({"error": "Not found"}).encode(), {}
+
+    return status, 'application/json', response_encoding.dumps(payload), {}
+
+
+async def encode_response(body, content_type, extra, headers):
+    """Compresses a bytes body for the client (large ones in the executor) and adds the encoding headers."""
+    if 'Content-Encoding' in extra:
+        return body, extra
+    etag = extra.get('ETag')
+    # A streamed route sent whole shares its ETag with the /api/route body
+    key = ('stream', etag) if etag and content_type == 'application/x-ndjson' else etag
+    args = (body, headers.get('accept-encoding'), content_type, key)
+    if len(body) >= response_encoding.COMPRESS_MIN_BYTES:
+        body, encoding_headers = await asyncio.get_running_loop().run_in_executor(None, response_encoding.negotiate, *args)
+    else:
+        body, encoding_headers = response_encoding.negotiate(*args)
+    extra = dict(extra)
+    if etag and 'Content-Encoding' in encoding_headers:
+        extra['ETag'] = response_encoding.weak_etag(etag)
+    extra.update(encoding_headers)
+    return body, extra
+
+
+async def handle_connection(reader, writer):
+    try:
+        request_line = await reader.readline()
+        parts = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(parts) < 2:
+            return
+
+        STATS["requests"] += 1
+        started = time.perf_counter()
+        extra = {}
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = 0
+        if parts[0] not in ('GET', 'POST'):
+            status, content_type, body = 405, 'application/json', json.dumps({"error": "Method not allowed"}).encode()
+        elif length > server.BATCH_MAX_BYTES:
+            status, content_type, body = 413, 'application/json', json.dumps({"error": "Request too large"}).encode()
+        else:
+            try:
+                if parts[0] == 'POST':
+                    request_body = await reader.readexactly(length) if length else b''
+                    status, content_type, body, extra = await dispatch_post(parts[1], request_body)
+                else:
+                    status, content_type, body, extra = await dispatch(parts[1], headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                print(f"Server Error: {e}")
+                status, content_type, body = 500, 'application/json', json.dumps({"error": str(e)}).encode()
+
+        metrics.record_request(server.endpoint_label(parts[1]), status, time.perf_counter() - started)
+        head = f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+        if content_type:
+            head += f"Content-Type: {content_type}\r\n"
+
+        if isinstance(body, bytes):
+            body, extra = await encode_response(body, content_type, extra, headers)
+        for name, value in extra.items():
+            head += f"{name}: {value}\r\n"
+
+        if isinstance(body, bytes):
+            head += f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+        else:
+            # Streamed: the body ends when the connection closes
+            writer.write((head + "Connection: close\r\n\r\n").encode('latin-1'))
+            async for chunk in body:
+                writer.write(chunk)
+                await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def serve(port=PORT):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="api"))
+    srv = await asyncio.start_server(handle_connection, "", port)
+    print(f"Async API server listening on port {port}...")
+    async with srv:
+        await srv.serve_forever()
+
+
+def run_async_server():
+    # Load the route DB and fork compute workers before the event loop starts
+    server.get_route_db()
+    server.start_compute_pool()
+    server.start_route_db_refresh()
+    data_sync.start_background_sync()
+    server.start_access_recorder()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+    finally:
+        if server.COMPUTE_POOL is not None:
+            server.COMPUTE_POOL.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    run_async_server()
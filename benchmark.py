@@ -0,0 +1,382 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import analyze_route
+import route_snapshot
+import segment_store
+import server
+
+# Offline benchmark for the analysis and serving hot paths.
+#
+# Builds a deterministic routeFareList fixture from the bundled travel time
+# data (random walks over real stop-to-stop segments, so every lookup hits
+# actual data), then times:
+#
+#   index / find_route_stops / find_overlapping_routes
+#   calculate_hourly_data: cold vs warm caches, short vs long routes,
+#                          full range vs sub-range
+#   HTTP: concurrent requests against BusRouteHandler (cold and warm)
+#
+# and writes p50/p95/p99 latency, throughput and peak RSS as JSON so runs
+# can be compared:
+#
+#     python benchmark.py [--backend store|json|both] [--output bench_results.json]
+#     python benchmark.py --compare old_results.json
+#
+# "cold" means this process' caches are empty; the OS page cache is not dropped.
+# The store backend of a --data copy other than the live data repo reads a
+# store compiled from that copy (bench_segment_times.bin).
+
+BACKUP_PAGES_DIR = 'hk-bus-time-between-stops-pages_backup'
+OUTPUT_FILE = 'bench_results.json'
+SEED = 7
+# Stop counts of the generated short and long routes
+SHORT_ROUTE_STOPS = (6, 12)
+LONG_ROUTE_STOPS = (45, 70)
+# Ratio of new/old p50 above which --compare flags a regression
+REGRESSION_RATIO = 1.2
+
+
+def use_data_dir(pages_dir):
+    """Points analyze_route and segment_store at another copy of the data repo."""
+    analyze_route.PAGES_DIR = segment_store.PAGES_DIR = pages_dir
+    analyze_route.HOURLY_BASE = segment_store.HOURLY_BASE = os.path.join(pages_dir, 'times_hourly')
+    analyze_route.DAILY_BASE = segment_store.DAILY_BASE = os.path.join(pages_dir, 'times')
+
+
+def build_fixture(routes_per_class=20, seed=SEED):
+    """
+    Generates a compact route database (route_snapshot.compact_db layout) with
+    `routes_per_class` short and long routes, each with both directions.
+    """
+    rng = random.Random(seed)
+    graph = analyze_route.load_local_json(os.path.join(analyze_route.HOURLY_BASE, '1', '08', 'all.json'))
+    if not graph:
+        raise SystemExit(f"No travel time data under {analyze_route.HOURLY_BASE}")
+    starts = sorted(graph)
+
+    def walk(min_len, max_len):
+        for _ in range(1000):
+            chain = [rng.choice(starts)]
+            target = rng.randint(min_len, max_len)
+            while len(chain) < target:
+                nxt = sorted(x for x in graph.get(chain[-1], {}) if x not in chain)
+                if not nxt:
+                    break
+                chain.append(rng.choice(nxt))
+            if len(chain) >= min_len:
+                return chain
+        raise SystemExit("Could not generate fixture routes from the data")
+
+    route_list = {}
+    stop_list = {}
+    classes = {"short": [], "long": []}
+    numbers = rng.sample(range(1, 1000), 2 * routes_per_class)
+    for i, num in enumerate(numbers):
+        kind = "short" if i < routes_per_class else "long"
+        chain = walk(*(SHORT_ROUTE_STOPS if kind == "short" else LONG_ROUTE_STOPS))
+        route = f"{num}{rng.choice(['', '', 'A', 'X'])}"
+        co = 'kmb' if len(chain[0]) == 16 else 'ctb'
+        freq = {"31": {"0600": ["2330", "600"]}, "96": {"0700": ["2400", "900"]}} if i % 4 else None
+        for sid in chain:
+            stop_list.setdefault(sid, {"name": {"en": f"STOP {sid[:6]}"}})
+        for bound, seq in (('O', chain), ('I', chain[::-1])):
+            key = f"{route}+1+{seq[0][:4]}+{seq[-1][:4]}+{bound}"
+            route_list[key] = {
+                "route": route, "co": [co], "bound": {co: bound}, "stops": {co: seq}, "freq": freq,
+                "dest": {"en": stop_list[seq[-1]]["name"]["en"]}
+            }
+        classes[kind].append(route)
+
+    db = route_snapshot.compact_db({"routeList": route_list, "stopList": stop_list})
+    return db, classes
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summarize(latencies, wall_seconds, extra=None):
+    ms = sorted(x * 1000 for x in latencies)
+    result = {
+        "n": len(ms),
+        "p50_ms": round(percentile(ms, 50), 3) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 3) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 3) if ms else None,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else None,
+        "max_ms": round(ms[-1], 3) if ms else None,
+        "throughput_per_s": round(len(ms) / wall_seconds, 1) if wall_seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+def time_calls(fn, calls, before_each=None):
+    """Runs fn(*args) for every args tuple in calls and returns the summary."""
+    latencies = []
+    wall_start = time.perf_counter()
+    for args in calls:
+        if before_each:
+            before_each()
+        t0 = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - wall_start)
+
+
+def reset_caches():
+    """Empties every in-process result cache on the request path (the store stays mapped)."""
+    analyze_route.SHARD_CACHE.invalidate()
+    with analyze_route._route_profiles_lock:
+        analyze_route._route_profiles.clear()
+    server.ROUTE_CACHE = server.ResultCache(server.ROUTE_CACHE_SIZE)
+
+
+STORE_FILE = segment_store.STORE_FILE
+# Store compiled for a --data copy other than the live data repo
+BENCH_STORE_FILE = 'bench_segment_times.bin'
+
+
+def use_backend(backend):
+    """'store' reads the compiled segment store, 'json' the times_hourly files."""
+    segment_store.STORE_FILE = STORE_FILE if backend == 'store' else ''
+    segment_store.reload_store()
+    reset_caches()
+
+
+def bench_lookups(db, classes, results):
+    t0 = time.perf_counter()
+    index = analyze_route.RouteIndex(db)
+    results["index_build"] = summarize([time.perf_counter() - t0], time.perf_counter() - t0,
+                                       {"routes": len(db['routeList']), "stops": len(index.postings)})
+    analyze_route.get_route_index(db)
+
+    routes = classes["short"] + classes["long"]
+    results["find_route_stops"] = time_calls(
+        lambda r: analyze_route.find_route_stops(db, r), [(r,) for r in routes * 5])
+
+    pairs = []
+    for route in routes:
+        stop_ids = analyze_route.find_route_stops(db, route)[2]
+        pairs.append((stop_ids[1], stop_ids[-2]))
+    results["find_overlapping_routes"] = time_calls(
+        lambda s, e: analyze_route.find_overlapping_routes(db, s, e), pairs * 5)
+
+
+def bench_hourly(db, classes, backend, results):
+    for kind in ("short", "long"):
+        variants = []
+        for route in classes[kind]:
+            _, _, stop_ids, _, freq = analyze_route.find_route_stops(db, route)
+            variants.append((stop_ids, freq))
+        for span in ("full", "sub"):
+            calls = []
+            for stop_ids, freq in variants:
+                if span == "full":
+                    calls.append((stop_ids, 0, len(stop_ids) - 1, freq))
+                else:
+                    calls.append((stop_ids, len(stop_ids) // 4, 3 * len(stop_ids) // 4, freq))
+            name = f"hourly/{backend}/{kind}/{span}"
+            results[name + "/cold"] = time_calls(analyze_route.calculate_hourly_data, calls, reset_caches)
+            for args in calls:
+                analyze_route.calculate_hourly_data(*args)
+            results[name + "/warm"] = time_calls(analyze_route.calculate_hourly_data, calls)
+
+
+def http_paths(db, classes):
+    paths = []
+    for route in classes["short"] + classes["long"]:
+        stop_ids = analyze_route.find_route_stops(db, route)[2]
+        n = len(stop_ids)
+        paths.append(f"/api/route?id={route}")
+        paths.append(f"/api/route?id={route}&start={n // 4}&end={3 * n // 4}")
+        paths.append(f"/api/overlap?start={stop_ids[1]}&end={stop_ids[-2]}")
+        paths.append(f"/api/search?q={route[:1]}")
+    return paths
+
+
+class QuietHandler(server.BusRouteHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_http(db, classes, backend, concurrency, results):
+    server.ROUTE_DB = db
+    httpd = server.PooledTCPServer(("127.0.0.1", 0), QuietHandler,
+                                   threads=server.SERVER_THREADS, queue_size=concurrency)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    def fetch(path):
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base + path, timeout=60) as resp:
+                resp.read()
+                status = resp.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 'error'
+        return time.perf_counter() - t0, status
+
+    paths = http_paths(db, classes)
+    rng = random.Random(SEED)
+    try:
+        for phase in ("cold", "warm"):
+            if phase == "cold":
+                reset_caches()
+            order = list(paths)
+            rng.shuffle(order)
+            wall_start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                responses = list(pool.map(fetch, order))
+            wall = time.perf_counter() - wall_start
+            statuses = {}
+            for _, status in responses:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            results[f"http/{backend}/{phase}"] = summarize(
+                [latency for latency, _ in responses], wall,
+                {"concurrency": concurrency, "statuses": statuses})
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the per-request progress prints of analyze_route and server."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(old_file, results):
+    """Prints p50/p95 of every case next to a previous run, flagging slowdowns."""
+    with open(old_file, 'r') as f:
+        old = json.load(f)["results"]
+    print(f"\nCompared with {old_file}:")
+    for name, new in results.items():
+        prev = old.get(name)
+        if not prev or not prev.get("p50_ms") or not new.get("p50_ms"):
+            continue
+        ratio = new["p50_ms"] / prev["p50_ms"]
+        flag = "  <-- slower" if ratio > REGRESSION_RATIO else ""
+        print(f"  {name:40s} p50 {prev['p50_ms']:9.3f} -> {new['p50_ms']:9.3f} ms  (x{ratio:.2f}){flag}")
+
+
+def print_results(results):
+    print(f"\n{'case':40s} {'n':>5s} {'p50 ms':>10s} {'p95 ms':>10s} {'p99 ms':>10s} {'per s':>9s} {'rss MB':>8s}")
+    for name, r in results.items():
+        print(f"{name:40s} {r['n']:5d} {r['p50_ms']:10.3f} {r['p95_ms']:10.3f} {r['p99_ms']:10.3f} "
+              f"{r['throughput_per_s'] or 0:9.1f} {r['peak_rss_mb'] or 0:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the route analysis and API")
+    parser.add_argument('--data', help="data repo copy (default: the live one, else the bundled backup)")
+    parser.add_argument('--backend', choices=['store', 'json', 'both'], default='both')
+    parser.add_argument('--routes', type=int, default=20, help="short and long routes each")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--no-http', action='store_true')
+    parser.add_argument('--output', default=OUTPUT_FILE)
+    parser.add_argument('--compare', help="previous results file to compare against")
+    args = parser.parse_args()
+
+    global STORE_FILE
+    live_dir = analyze_route.PAGES_DIR
+    pages_dir = args.data or (live_dir if os.path.isdir(analyze_route.HOURLY_BASE) else BACKUP_PAGES_DIR)
+    use_data_dir(pages_dir)
+    # Keep the benchmark independent of any published data generation
+    analyze_route.GENERATION_FILE = ''
+
+    backends = ['store', 'json'] if args.backend == 'both' else [args.backend]
+    if 'store' in backends and os.path.abspath(pages_dir) != os.path.abspath(live_dir):
+        # SEGMENT_STORE is compiled from the live data, not this copy
+        STORE_FILE = BENCH_STORE_FILE
+        with quiet():
+            segment_store.build_store(segment_store.HOURLY_BASE, STORE_FILE, segment_store.DAILY_BASE)
+    if 'store' in backends and not os.path.exists(STORE_FILE):
+        print(f"No segment store at {STORE_FILE} (python segment_store.py build), skipping the store backend")
+        backends.remove('store')
+
+    print(f"Generating fixture from {pages_dir}...")
+    db, classes = build_fixture(args.routes)
+    results = {}
+
+    print("Benchmarking lookups...")
+    with quiet():
+        bench_lookups(db, classes, results)
+    for backend in backends:
+        use_backend(backend)
+        print(f"Benchmarking calculate_hourly_data ({backend})...")
+        with quiet():
+            bench_hourly(db, classes, backend, results)
+        if not args.no_http:
+            print(f"Benchmarking HTTP ({backend}, concurrency {args.concurrency})...")
+            with quiet():
+                bench_http(db, classes, backend, args.concurrency, results)
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": analyze_route.np is not None,
+            "ripple_engine": analyze_route.RIPPLE_ENGINE,
+            "server_threads": server.SERVER_THREADS,
+            "data": pages_dir,
+            "fixture": {"routes": len(db['routeList']), "stops": len(db['stopList']), "seed": SEED}
+        },
+        "results": results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
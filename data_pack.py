@@ -0,0 +1,373 @@
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Packed distribution format for the travel time data.
+#
+# The data repo is tens of thousands of small, verbose JSON files
+# (times_hourly alone is ~56k of them, with floats like 193.50150737187738),
+# which makes the image build upload, the image and cold-start page-ins large.
+# `build` turns each data dir into one pack file:
+#
+#   header : magic, codec, quantum, counts and section offsets (little-endian)
+#   blocks : one compressed block per JSON file, in name order
+#   stops  : newline separated stop IDs (interned once for the whole pack)
+#   index  : zlib(newline separated shard names), uint64 block offsets
+#            (n + 1, so block i is offsets[i]:offsets[i + 1]), uint32 size of
+#            the original JSON file (for cache weighting)
+#
+# A {from_stop: {to_stop: seconds}} shard becomes uint32 columns of stop
+# numbers and times quantized to 1/QUANTUM s, each stored as its byte planes
+# (the high bytes are mostly zero and compress to almost nothing), compressed
+# with zstd when the zstandard package is installed (zlib otherwise). Anything
+# not of that shape is kept as compressed JSON. Reading a shard decompresses
+# its block only.
+#
+# read_json() is what the shard readers use: the JSON file when it is on disk,
+# else its block from the pack in DATA_PACK_DIR, so a checkout with the raw
+# data and an image with only the packs behave the same.
+#
+#     python data_pack.py build [pages_dir] [pack_dir]
+#     python data_pack.py check [pages_dir] [pack_dir]   # compare packs with the JSON
+
+PAGES_DIR = 'hk-bus-time-between-stops-pages'
+PACK_DIR = os.environ.get('DATA_PACK_DIR', 'data_packs')
+DATASETS = ['times_hourly', 'times', 'first_bus_times', 'last_bus_times']
+# 'zstd' or 'zlib' for new packs; zstd only when zstandard is installed
+PACK_CODEC = os.environ.get('DATA_PACK_CODEC', 'zstd' if zstandard is not None else 'zlib')
+PACK_LEVEL = int(os.environ.get('DATA_PACK_LEVEL', 19 if PACK_CODEC == 'zstd' else 9))
+# Times are stored as integer multiples of 1/QUANTUM seconds; a power of two,
+# so every stored time is exact in the segment store's float32 as well
+QUANTUM = 16
+
+MAGIC = b'HKPACK01'
+# magic, codec, quantum, n_stops, n_shards, stops_off, stops_len, index_off, names_len
+HEADER = struct.Struct('<8sBxHIIQQQQ')
+CODECS = {'zlib': 0, 'zstd': 1}
+# Block kinds (first byte of a block)
+BLOCK_TIMES = 0
+BLOCK_JSON = 1
+# n_from, n_entries at the start of a BLOCK_TIMES payload
+COUNTS = struct.Struct('<II')
+
+
+def _compressor(codec, level=PACK_LEVEL):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd packs need the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress
+    return lambda data: zlib.compress(data, level)
+
+
+def _decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd packs need the zstandard package")
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+
+def _le(arr):
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_le(typecode, data):
+    arr = array.array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+def _shuffle(arr):
+    """uint32 column as its 4 byte planes (low bytes first), which compresses better."""
+    data = _le(arr)
+    return b''.join(data[i::4] for i in range(4))
+
+
+def _unshuffle(data, n):
+    out = bytearray(4 * n)
+    for i in range(4):
+        out[i::4] = data[i * n:(i + 1) * n]
+    return _from_le('I', out)
+
+
+def encode_shard(shard, stop_index):
+    """Uncompressed block body for a parsed shard; new stop IDs are added to stop_index."""
+    froms, counts, tos, vals = array.array('I'), array.array('I'), array.array('I'), array.array('I')
+    try:
+        for start_id, targets in shard.items():
+            froms.append(stop_index.setdefault(start_id, len(stop_index)))
+            counts.append(len(targets))
+            for end_id, val in targets.items():
+                if isinstance(val, bool) or not isinstance(val, (int, float)) or not 0 <= val < 4e8:
+                    raise TypeError
+                tos.append(stop_index.setdefault(end_id, len(stop_index)))
+                vals.append(int(round(val * QUANTUM)))
+    except (AttributeError, TypeError):
+        return bytes([BLOCK_JSON]) + json.dumps(shard, separators=(',', ':')).encode('utf-8')
+    return (bytes([BLOCK_TIMES]) + COUNTS.pack(len(froms), len(tos))
+            + _shuffle(froms) + _shuffle(counts) + _shuffle(tos) + _shuffle(vals))
+
+
+def build_pack(src_dir, out_file, codec=PACK_CODEC):
+    """Packs every JSON file under src_dir into out_file. Returns the number of shards."""
+    compress = _compressor(codec)
+    names = []
+    for root, _, files in os.walk(src_dir):
+        for name in files:
+            if name.endswith('.json'):
+                rel = os.path.relpath(os.path.join(root, name), src_dir)
+                names.append(rel[:-5].replace(os.sep, '/'))
+    names.sort()
+
+    stop_index = {}
+    offsets = array.array('Q')
+    raw_sizes = array.array('I')
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        for name in names:
+            path = os.path.join(src_dir, *name.split('/')) + '.json'
+            with open(path, 'rb') as src:
+                raw = src.read()
+            try:
+                shard = json.loads(raw)
+                body = encode_shard(shard, stop_index)
+            except ValueError:
+                # Not valid JSON: kept byte for byte
+                body = bytes([BLOCK_JSON]) + raw
+            block = body[:1] + compress(body[1:])
+            offsets.append(f.tell())
+            raw_sizes.append(min(len(raw), 0xffffffff))
+            f.write(block)
+        offsets.append(f.tell())
+
+        stop_ids = sorted(stop_index, key=stop_index.get)
+        stops_blob = '\n'.join(stop_ids).encode('utf-8')
+        stops_off = f.tell()
+        f.write(stops_blob)
+        names_blob = zlib.compress('\n'.join(names).encode('utf-8'), 9)
+        index_off = f.tell()
+        f.write(names_blob)
+        f.write(_le(offsets))
+        f.write(_le(raw_sizes))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, CODECS[codec], QUANTUM, len(stop_ids), len(names),
+                            stops_off, len(stops_blob), index_off, len(names_blob)))
+    os.replace(tmp_file, out_file)
+    return len(names)
+
+
+def build_packs(pages_dir=PAGES_DIR, pack_dir=PACK_DIR, codec=PACK_CODEC):
+    os.makedirs(pack_dir, exist_ok=True)
+    for dataset in DATASETS:
+        src_dir = os.path.join(pages_dir, dataset)
+        if not os.path.isdir(src_dir):
+            print(f"  Skipping {dataset}: {src_dir} not found")
+            continue
+        out_file = os.path.join(pack_dir, f"{dataset}.pack")
+        n = build_pack(src_dir, out_file, codec)
+        print(f"  {dataset}: {n} shards -> {out_file} ({os.path.getsize(out_file) / 1e6:.1f} MB, {codec})")
+
+
+class DataPack:
+    """Read-only view of one pack file, memory-mapped; blocks are decompressed on read."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, codec, self.quantum, n_stops, n_shards,
+         stops_off, stops_len, index_off, names_len) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a data pack")
+        codec_name = {v: k for k, v in CODECS.items()}.get(codec)
+        if codec_name is None:
+            raise ValueError(f"{path}: unknown codec {codec}")
+        self.codec = codec_name
+        self._decompress = _decompressor(codec_name)
+        stops_blob = bytes(self._mm[stops_off:stops_off + stops_len]).decode('utf-8')
+        self.stop_ids = stops_blob.split('\n') if n_stops else []
+        names = zlib.decompress(self._mm[index_off:index_off + names_len]).decode('utf-8')
+        self.index = {name: i for i, name in enumerate(names.split('\n'))} if n_shards else {}
+        pos = index_off + names_len
+        self.offsets = _from_le('Q', self._mm[pos:pos + 8 * (n_shards + 1)])
+        pos += 8 * (n_shards + 1)
+        self.raw_sizes = _from_le('I', self._mm[pos:pos + 4 * n_shards])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return list(self.index)
+
+    def _block(self, name):
+        i = self.index[name]
+        return self._mm[self.offsets[i]:self.offsets[i + 1]]
+
+    def raw_size(self, name):
+        """Size of the JSON file the shard was packed from."""
+        return self.raw_sizes[self.index[name]]
+
+    def digest(self, name):
+        """Content hash of a shard (of its stored block)."""
+        return hashlib.sha1(self._block(name)).hexdigest()
+
+    def read(self, name):
+        """Parsed shard (KeyError if the pack has no such shard)."""
+        block = self._block(name)
+        try:
+            body = self._decompress(block[1:])
+            if block[0] == BLOCK_JSON:
+                return json.loads(body)
+            return self._decode_times(body)
+        except Exception as e:
+            raise ValueError(f"{self.path}: bad block {name}: {e}") from e
+
+    def _decode_times(self, body):
+        n_from, n_entries = COUNTS.unpack_from(body)
+        pos = COUNTS.size
+        froms = _unshuffle(body[pos:pos + 4 * n_from], n_from)
+        pos += 4 * n_from
+        counts = _unshuffle(body[pos:pos + 4 * n_from], n_from)
+        pos += 4 * n_from
+        tos = _unshuffle(body[pos:pos + 4 * n_entries], n_entries)
+        pos += 4 * n_entries
+        vals = _unshuffle(body[pos:pos + 4 * n_entries], n_entries)
+        stop_ids = self.stop_ids
+        q = self.quantum
+        targets = [stop_ids[t] for t in tos]
+        seconds = [v / q for v in vals]
+        shard = {}
+        i = 0
+        for f, c in zip(froms, counts):
+            shard[stop_ids[f]] = dict(zip(targets[i:i + c], seconds[i:i + c]))
+            i += c
+        return shard
+
+    def close(self):
+        self._mm.close()
+
+
+# Open packs, reopened when the file on disk changes (rebuilt or replaced)
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+def get_pack(dataset, pack_dir=PACK_DIR):
+    """The DataPack for a data dir, or None when there is no (readable) pack."""
+    path = os.path.join(pack_dir, f"{dataset}.pack")
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    entry = _packs.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    with _packs_lock:
+        entry = _packs.get(path)
+        if entry is None or entry[0] != key:
+            try:
+                pack = DataPack(path)
+            except (OSError, ValueError, RuntimeError) as e:
+                print(f"Could not open data pack {path}: {e}")
+                pack = None
+            # The old mapping is left to the garbage collector, readers may still hold it
+            entry = (key, pack)
+            _packs[path] = entry
+        return entry[1]
+
+
+def locate(path, pages_dir=PAGES_DIR):
+    """(dataset, shard name) for a JSON path inside the data dirs, else None."""
+    rel = os.path.relpath(path, pages_dir).replace(os.sep, '/')
+    dataset, _, name = rel.partition('/')
+    if dataset not in DATASETS or not name.endswith('.json'):
+        return None
+    return dataset, name[:-5]
+
+
+def read_json(path):
+    """
+    (parsed content, size of the JSON file) for a data file: from disk when it
+    exists, else from its pack. OSError when neither has it, ValueError when it
+    does not parse.
+    """
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        return json.loads(raw), len(raw)
+    except FileNotFoundError:
+        where = locate(path)
+        pack = get_pack(where[0]) if where else None
+        if pack is None or where[1] not in pack:
+            raise
+        return pack.read(where[1]), pack.raw_size(where[1])
+
+
+def list_json(directory):
+    """Sorted *.json file names in a data directory, from disk or from its pack."""
+    if os.path.isdir(directory):
+        return sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    where = locate(os.path.join(directory, 'x.json'))
+    pack = get_pack(where[0]) if where else None
+    if pack is None:
+        return []
+    sub = where[1][:-1]  # '<dir>/' inside the dataset, '' at its top
+    return sorted(name[len(sub):] + '.json' for name in pack.index
+                  if name.startswith(sub) and '/' not in name[len(sub):])
+
+
+def check_packs(pages_dir=PAGES_DIR, pack_dir=PACK_DIR):
+    """Compares every packed shard with its JSON file (times within half a quantum). Returns mismatches."""
+    bad = 0
+    for dataset in DATASETS:
+        pack = get_pack(dataset, pack_dir)
+        if pack is None:
+            continue
+        for name in pack.names():
+            with open(os.path.join(pages_dir, dataset, *name.split('/')) + '.json', 'rb') as f:
+                original = json.loads(f.read())
+            if not _close(original, pack.read(name), 0.5 / pack.quantum + 1e-9):
+                bad += 1
+                print(f"  Mismatch: {dataset}/{name}")
+        print(f"  {dataset}: {len(pack)} shards checked")
+    return bad
+
+
+def _close(a, b, tolerance):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(_close(a[k], b[k], tolerance) for k in a)
+    if isinstance(a, (int, float)) and not isinstance(a, bool):
+        return isinstance(b, (int, float)) and abs(a - b) <= tolerance
+    return a == b
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    pages = sys.argv[2] if len(sys.argv) > 2 else PAGES_DIR
+    out = sys.argv[3] if len(sys.argv) > 3 else PACK_DIR
+    if command == 'build':
+        print(f"Packing {pages} into {out}/...")
+        build_packs(pages, out)
+    elif command == 'check':
+        sys.exit(1 if check_packs(pages, out) else 0)
+    else:
+        print("Usage: python data_pack.py build|check [pages_dir] [pack_dir]")
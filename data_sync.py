@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import analyze_route
+import data_pack
+import precompute
+import segment_store
+
+# Background incremental data sync.
+#
+# The daily pull of hk-bus-time-between-stops-pages used to block server
+# startup and then throw away every cache. Instead this runs in a background
+# thread and publishes a new "data generation":
+#
+#   1. pull the data repo (sync_data.sh) when the last sync is over a day old
+#   2. rescan a manifest of the data files ({path: [size, mtime_ns, sha1]});
+#      hashes are only recomputed for files whose size or mtime moved
+#   3. diff it against the saved manifest and rebuild the segment store only
+#      if some times_hourly or times (daily fallback) file really changed
+#   4. write data_generation.json atomically with the list of changed shards
+#      and stop prefixes
+#   5. rerun precompute.py if its output is in use, since the server only
+#      reads a table built for the current generation
+#
+# Every process watches the generation file (analyze_route.get_data_version)
+# and drops just the shards and route profiles the new generation touched.
+#
+#     python data_sync.py sync        # one sync cycle
+#     python data_sync.py manifest    # (re)write the manifest and generation
+
+PAGES_DIR = analyze_route.PAGES_DIR
+DATA_DIRS = ['times_hourly', 'times', 'first_bus_times', 'last_bus_times']
+MANIFEST_FILE = os.environ.get('DATA_MANIFEST_FILE', 'data_manifest.json')
+GENERATION_FILE = analyze_route.GENERATION_FILE
+# How old the last pull may get before the next one (seconds)
+SYNC_INTERVAL = int(os.environ.get('DATA_SYNC_INTERVAL', 86400))
+# How often the background thread wakes up to check (seconds)
+SYNC_CHECK_INTERVAL = int(os.environ.get('DATA_SYNC_CHECK_INTERVAL', 3600))
+# Processes for the precompute rerun (it shares the machine with the server)
+SYNC_PRECOMPUTE_WORKERS = int(os.environ.get('SYNC_PRECOMPUTE_WORKERS', 1))
+
+_sync_lock = threading.Lock()
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_manifest(previous=None):
+    """
+    Returns {relative path: [size, mtime_ns, sha1]} for every JSON file in the
+    data dirs or their packs (JSON on disk wins, as in data_pack.read_json).
+    Hashes from previous are reused when size and mtime match.
+    """
+    previous = previous or {}
+    manifest = {}
+    for data_dir in DATA_DIRS:
+        base = os.path.join(PAGES_DIR, data_dir)
+        for root, _, files in os.walk(base):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, PAGES_DIR).replace(os.sep, '/')
+                try:
+                    st = os.stat(path)
+                    old = previous.get(rel_path)
+                    if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                        manifest[rel_path] = old
+                    else:
+                        manifest[rel_path] = [st.st_size, st.st_mtime_ns, _file_sha1(path)]
+                except OSError as e:
+                    print(f"  Skipping {rel_path}: {e}")
+        # Shards only present in the data dir's pack (an image built from
+        # packs); keyed by the pack's mtime so their hashes are reused too
+        pack = data_pack.get_pack(data_dir)
+        if pack is None:
+            continue
+        pack_mtime = os.stat(pack.path).st_mtime_ns
+        for name in pack.names():
+            rel_path = f"{data_dir}/{name}.json"
+            if rel_path in manifest:
+                continue
+            old = previous.get(rel_path)
+            size = pack.raw_size(name)
+            if old and old[0] == size and old[1] == pack_mtime:
+                manifest[rel_path] = old
+            else:
+                manifest[rel_path] = [size, pack_mtime, pack.digest(name)]
+    return manifest
+
+
+def diff_manifests(old, new):
+    """Relative paths that were added, removed or whose content changed (sorted)."""
+    changed = [p for p, entry in new.items() if p not in old or old[p][2] != entry[2]]
+    changed += [p for p in old if p not in new]
+    return sorted(changed)
+
+
+def manifest_id(manifest):
+    """Short content hash of a manifest (ignores mtimes) and of the segment store format."""
+    h = hashlib.sha1(segment_store.MAGIC)
+    for rel_path in sorted(manifest):
+        h.update(f"{rel_path}:{manifest[rel_path][2]}\n".encode())
+    return h.hexdigest()[:12]
+
+
+def load_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_generation(path=GENERATION_FILE):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def needs_pull():
+    """True when the data repo has never been pulled or the last pull is older than SYNC_INTERVAL."""
+    fetch_head = os.path.join(PAGES_DIR, ".git", "FETCH_HEAD")
+    if not os.path.exists(fetch_head):
+        print("Status: No previous sync record found.")
+        return True
+    if time.time() - os.path.getmtime(fetch_head) > SYNC_INTERVAL:
+        print("Status: Data is older than 24 hours.")
+        return True
+    print("Status: Data is up to date (synced within 24h).")
+    return False
+
+
+def publish_generation():
+    """
+    Rescans the data files and, if anything changed since the saved manifest,
+    rebuilds what depends on it and publishes a new generation. Returns the
+    generation dict (the current one if nothing changed).
+    """
+    old_manifest = load_manifest()
+    new_manifest = scan_manifest(old_manifest)
+    current = load_generation()
+    # Missing, or written by an older version in another format
+    store_missing = not segment_store.store_is_current()
+
+    if old_manifest is None:
+        changed = sorted(new_manifest)
+    else:
+        changed = diff_manifests(old_manifest, new_manifest)
+    if not changed and current and not store_missing:
+        print("Data unchanged, keeping generation", current['id'])
+        return current
+
+    # Files the store is compiled from (and the JSON fallback path caches)
+    changed_shards = [p for p in changed if p.startswith(('times_hourly/', 'times/'))]
+    store_rebuilt = False
+    if changed_shards or store_missing:
+        segment_store.build_store()
+        store_rebuilt = True
+
+    # Stop prefix of each changed shard (times_hourly/<day>/<hour>/<prefix>.json, times/<prefix>.json)
+    prefixes = sorted({p.rsplit('/', 1)[-1][:-5] for p in changed_shards} - {'all'})
+
+    if old_manifest is None:
+        # Nothing to diff against: publish without a previous id so every
+        # process drops all its caches rather than reading a huge change list
+        current = None
+        changed_shards, prefixes = [], []
+
+    generation = {
+        "id": manifest_id(new_manifest),
+        "previous": current['id'] if current else None,
+        "published": int(time.time()),
+        "changed_files": len(changed),
+        "changed_shards": changed_shards,
+        "changed_prefixes": prefixes,
+        "store_rebuilt": store_rebuilt
+    }
+    if generation["id"] == generation["previous"]:
+        # Content is back to what it was (e.g. reverted upstream)
+        generation["previous"] = None
+    _write_json_atomic(MANIFEST_FILE, new_manifest)
+    _write_json_atomic(GENERATION_FILE, generation)
+    print(f"Published data generation {generation['id']}: {len(changed)} files changed, "
+          f"{len(changed_shards)} shard files, store {'rebuilt' if store_rebuilt else 'kept'}")
+    rebuild_precomputed(generation)
+    return generation
+
+
+def rebuild_precomputed(generation):
+    """Reruns precompute.py for a new generation when PRECOMPUTED_FILE exists; servers reopen the replaced file."""
+    path = precompute.PRECOMPUTED_FILE
+    if not os.path.exists(path):
+        return
+    print(f"Rebuilding precomputed travel times {path} for generation {generation['id']}...")
+    try:
+        subprocess.run([sys.executable, "precompute.py", "--output", path,
+                        "--workers", str(SYNC_PRECOMPUTE_WORKERS)], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        # The old table is ignored (wrong data version) until the next rebuild
+        print(f"Precompute failed: {e}")
+
+
+def run_sync(force=False):
+    """One sync cycle: pull when due (or forced), then publish whatever changed."""
+    with _sync_lock:
+        if force or needs_pull():
+            print("Auto-syncing data from GitHub...")
+            try:
+                subprocess.run(["bash", "sync_data.sh"], check=True)
+            except Exception as e:
+                print(f"Auto-sync failed: {e}")
+        try:
+            return publish_generation()
+        except Exception as e:
+            print(f"Publishing data generation failed: {e}")
+            return None
+
+
+def _sync_loop():
+    while True:
+        run_sync()
+        time.sleep(SYNC_CHECK_INTERVAL)
+
+
+def start_background_sync():
+    """Runs the sync cycle now and then periodically, without blocking the caller."""
+    thread = threading.Thread(target=_sync_loop, name="data-sync", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'sync':
+        run_sync(force='--force' in sys.argv)
+    elif command == 'manifest':
+        publish_generation()
+    else:
+        print("Usage: python data_sync.py sync [--force] | manifest")
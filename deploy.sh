@@ -12,11 +12,15 @@ echo "Deploying to Project: $PROJECT_ID"
 # 1. Set Project
 gcloud config set project $PROJECT_ID
 
-# 2. Build Container (Increase timeout for large upload)
-echo "Building container (this may take a while for 1.3GB data)..."
+# 2. Pack the travel time data; only the packs are uploaded (see .gcloudignore)
+echo "Packing data..."
+python3 data_pack.py build
+
+# 3. Build Container
+echo "Building container..."
 gcloud builds submit --tag gcr.io/$PROJECT_ID/bus-travel-time --timeout=20m
 
-# 3. Deploy to Cloud Run
+# 4. Deploy to Cloud Run
 echo "Deploying to Cloud Run..."
 gcloud run deploy bus-travel-time \
   --image gcr.io/$PROJECT_ID/bus-travel-time \
@@ -25,7 +29,7 @@ gcloud run deploy bus-travel-time \
   --allow-unauthenticated \
   --memory 2Gi
 
-# 4. Deploy Hosting
+# 5. Deploy Hosting
 echo "Deploying Hosting..."
 firebase deploy --only hosting --project $PROJECT_ID
 
@@ -0,0 +1,260 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Request timing, Prometheus metrics and an opt-in profiler for slow requests.
+#
+# Each request handled through track_request() gets a trace in a thread-local.
+# Code on the request path adds timed spans (span("ripple")) and counters
+# (count("shard_loads")) to it without passing anything around; outside a
+# request (CLI, compute worker processes) these are no-ops.
+#
+# When the request ends its duration and spans go into histograms that
+# render() exposes in Prometheus text format (served on /api/metrics).
+
+# Requests slower than this are logged with their spans (ms, 0 = never)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+# cProfile a sample of requests and dump the stats of those slower than
+# PROFILE_SLOW_MS (ms, 0 = profiler off) into PROFILE_DIR
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.1))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Histogram buckets (seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = 'hkbus_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Counters and histograms keyed by (name, sorted label items)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.help = {}
+        self.collectors = []
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def register_collector(self, fn):
+        """fn() returns [(name, 'counter'|'gauge', value, labels dict)], read at render time."""
+        self.collectors.append(fn)
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {PREFIX}{name} {self.help[name]}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count, h.buckets))
+                                for key, h in self.histograms.items())
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {count}")
+
+        for collector in self.collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, kind, value, labels in samples:
+                header(name, kind)
+                lines.append(f"{PREFIX}{name}{_labels(tuple(sorted(labels.items())))} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(items):
+    if not items:
+        return ''
+    parts = []
+    for name, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('requests_total', 'HTTP requests by endpoint and status.')
+REGISTRY.describe('request_duration_seconds', 'HTTP request latency by endpoint.')
+REGISTRY.describe('span_duration_seconds', 'Time spent per request in each stage.')
+REGISTRY.describe('request_events_total', 'Per-request counters (shard loads and bytes read).')
+
+_local = threading.local()
+_profile_lock = threading.Lock()
+
+
+class RequestTrace:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.status = None
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.counts = {}
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+class span:
+    """Context manager adding the time spent inside to the current request's span `name`."""
+    __slots__ = ('name', 'trace', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace()
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            spans = self.trace.spans
+            spans[self.name] = spans.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def count(name, value=1):
+    """Adds to a per-request counter (e.g. shard loads); no-op outside a request."""
+    trace = current_trace()
+    if trace is not None:
+        trace.counts[name] = trace.counts.get(name, 0) + value
+
+
+def set_status(status):
+    trace = current_trace()
+    if trace is not None and trace.status is None:
+        trace.status = status
+
+
+class track_request:
+    """
+    Wraps the handling of one request: records its latency, spans and status,
+    logs it when slow, and profiles it when it was sampled by the profiler.
+    """
+    def __init__(self, endpoint):
+        self.trace = RequestTrace(endpoint)
+        self.profiler = None
+
+    def __enter__(self):
+        _local.trace = self.trace
+        # Only one request is profiled at a time (profilers are per thread,
+        # and newer Pythons allow a single active one)
+        if PROFILE_SLOW_MS > 0 and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                self.profiler = None
+                _profile_lock.release()
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        elapsed = time.perf_counter() - trace.start
+        _local.trace = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            try:
+                if elapsed * 1000 >= PROFILE_SLOW_MS:
+                    dump_profile(self.profiler, trace, elapsed)
+            finally:
+                _profile_lock.release()
+
+        status = trace.status or (500 if exc_type else 200)
+        record_request(trace.endpoint, status, elapsed)
+        for name, seconds in trace.spans.items():
+            REGISTRY.observe('span_duration_seconds', seconds, endpoint=trace.endpoint, span=name)
+        for name, value in trace.counts.items():
+            REGISTRY.inc('request_events_total', value, endpoint=trace.endpoint, event=name)
+
+        if SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS:
+            print("Slow request: " + json.dumps({
+                "endpoint": trace.endpoint,
+                "status": status,
+                "ms": round(elapsed * 1000, 1),
+                "spans_ms": {k: round(v * 1000, 1) for k, v in trace.spans.items()},
+                "counts": trace.counts
+            }))
+        return False
+
+
+def record_request(endpoint, status, seconds):
+    """Counts a finished request and its latency (also used directly by async_server.py)."""
+    REGISTRY.inc('requests_total', endpoint=endpoint, status=str(status))
+    REGISTRY.observe('request_duration_seconds', seconds, endpoint=endpoint)
+
+
+def dump_profile(profiler, trace, elapsed):
+    """Writes the cProfile stats of a slow request to PROFILE_DIR and prints the top entries."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', trace.endpoint).strip('_') or 'root'
+    path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{slug}.prof")
+    profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(10)
+    print(f"Profiled slow request {trace.endpoint} ({elapsed * 1000:.0f} ms) -> {path}\n{out.getvalue()}")
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,312 @@
+import argparse
+import array
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import analyze_route
+import route_snapshot
+
+# Network-wide travel time precompute.
+#
+# Walks every KMB/CTB route variant and computes the hourly ripple (the same
+# chart /api/route returns) for the full route and for every stop-to-terminus
+# suffix, spread over a process pool. Variants with the same stops and
+# service hours are computed once.
+#
+# Output is columnar: Parquet when pyarrow is installed (one row per profile
+# and start stop, 168 minutes per row), otherwise a compact binary file:
+#
+#   header  : magic, n_profiles, n_rows, meta_len, matrix_off (little-endian)
+#   meta    : JSON (data version, and per profile: key, first row, stops, routes)
+#   matrix  : n_rows x 7 days x 24 hours float32 minutes, NaN = no value
+#
+# Rows of one profile are contiguous, ordered by start stop. The server reads
+# the file (PrecomputedTable) and answers matching /api/route queries from it
+# while its data version is current; data_sync.py reruns this for every new
+# data generation and the server reopens the replaced file.
+#
+#     python precompute.py [--db url_or_file] [--output FILE] [--format auto|parquet|binary]
+
+PRECOMPUTED_FILE = os.environ.get('PRECOMPUTED_FILE', 'precomputed_routes.bin')
+MAGIC = b'HKPREC01'
+# magic, n_profiles, n_rows, meta_len, matrix_off
+HEADER = struct.Struct('<8sIIQQ')
+SLOTS = 7 * 24
+
+
+def profile_key(stops, freq_data):
+    """Identifies a computation: the chart only depends on the stop sequence and service hours."""
+    blob = json.dumps([list(stops), freq_data], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def collect_profiles(db):
+    """Unique (key, stops, freq, [(variant key, route)]) for every KMB/CTB variant in db."""
+    profiles = {}
+    for key, val in db.get('routeList', {}).items():
+        company_list = val.get('co', [])
+        if not ('kmb' in company_list or 'ctb' in company_list):
+            continue
+        stops_map = val.get('stops', {})
+        stops = stops_map.get('kmb') or stops_map.get('ctb')
+        if not stops or len(stops) < 2:
+            continue
+        freq_data = val.get('freq')
+        pkey = profile_key(stops, freq_data)
+        entry = profiles.get(pkey)
+        if entry is None:
+            entry = profiles[pkey] = (pkey, list(stops), freq_data, [])
+        entry[3].append((key, val.get('route')))
+    return sorted(profiles.values(), key=lambda p: p[0])
+
+
+def compute_profile(task):
+    """Worker: float32 bytes of (len(stops) - 1) rows x 168 minutes, one row per start stop."""
+    stops, freq_data = task
+    end_index = len(stops) - 1
+    rows = array.array('f')
+    for start_index in range(end_index):
+        chart_data = analyze_route.calculate_hourly_data(stops, start_index, end_index, freq_data)
+        for day_code in analyze_route.DAYS:
+            rows.extend(math.nan if v is None else v for v in chart_data[day_code])
+    if sys.byteorder != 'little':
+        rows.byteswap()
+    return rows.tobytes()
+
+
+def run_precompute(db, workers=None, limit=None):
+    """Computes every profile in db. Returns (profiles, list of row bytes per profile)."""
+    profiles = collect_profiles(db)
+    if limit:
+        profiles = profiles[:limit]
+    total_rows = sum(len(p[1]) - 1 for p in profiles)
+    print(f"Precomputing {len(profiles)} stop sequences ({total_rows} start stops) "
+          f"with {workers or os.cpu_count()} processes...")
+
+    started = time.time()
+    results = []
+    tasks = [(stops, freq_data) for _, stops, freq_data, _ in profiles]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, rows in enumerate(pool.map(compute_profile, tasks, chunksize=8)):
+            results.append(rows)
+            if (i + 1) % 500 == 0:
+                print(f"  {i + 1}/{len(tasks)} done ({time.time() - started:.0f}s)")
+    print(f"Computed {total_rows} rows in {time.time() - started:.1f}s")
+    return profiles, results
+
+
+def build_meta(db, profiles):
+    meta = {
+        "data_version": analyze_route.get_data_version(),
+        "db_version": db.get('snapshotVersion'),
+        "created": int(time.time()),
+        "profiles": []
+    }
+    row = 0
+    for pkey, stops, _, routes in profiles:
+        meta["profiles"].append({"key": pkey, "row": row, "stops": stops, "routes": routes})
+        row += len(stops) - 1
+    return meta, row
+
+
+def write_binary(db, profiles, results, output_file):
+    meta, n_rows = build_meta(db, profiles)
+    meta_blob = json.dumps(meta, separators=(',', ':')).encode()
+    matrix_off = (HEADER.size + len(meta_blob) + 7) // 8 * 8
+
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(profiles), n_rows, len(meta_blob), matrix_off))
+        f.write(meta_blob)
+        f.write(b'\0' * (matrix_off - f.tell()))
+        for rows in results:
+            f.write(rows)
+    os.replace(tmp_file, output_file)
+
+
+def write_parquet(db, profiles, results, output_file):
+    meta, _ = build_meta(db, profiles)
+    columns = {"profile_key": [], "routes": [], "start_index": [], "start_stop": [], "end_stop": [], "minutes": []}
+    for (pkey, stops, _, routes), rows in zip(profiles, results):
+        values = array.array('f')
+        values.frombytes(rows)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        route_keys = [key for key, _ in routes]
+        for start_index in range(len(stops) - 1):
+            columns["profile_key"].append(pkey)
+            columns["routes"].append(route_keys)
+            columns["start_index"].append(start_index)
+            columns["start_stop"].append(stops[start_index])
+            columns["end_stop"].append(stops[-1])
+            chunk = values[start_index * SLOTS:(start_index + 1) * SLOTS]
+            columns["minutes"].append([None if math.isnan(v) else round(v, 2) for v in chunk])
+
+    table = pyarrow.table({
+        "profile_key": pyarrow.array(columns["profile_key"], pyarrow.string()),
+        "routes": pyarrow.array(columns["routes"], pyarrow.list_(pyarrow.string())),
+        "start_index": pyarrow.array(columns["start_index"], pyarrow.int32()),
+        "start_stop": pyarrow.array(columns["start_stop"], pyarrow.string()),
+        "end_stop": pyarrow.array(columns["end_stop"], pyarrow.string()),
+        "minutes": pyarrow.array(columns["minutes"], pyarrow.list_(pyarrow.float32(), SLOTS)),
+    })
+    table = table.replace_schema_metadata({
+        "data_version": meta["data_version"] or '',
+        "db_version": meta["db_version"] or '',
+        "created": str(meta["created"])
+    })
+    tmp_file = output_file + '.tmp'
+    pyarrow.parquet.write_table(table, tmp_file, compression='zstd')
+    os.replace(tmp_file, output_file)
+
+
+class PrecomputedTable:
+    """Read-only view of a precompute output (binary or Parquet)."""
+
+    def __init__(self, path=PRECOMPUTED_FILE):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(len(MAGIC))
+        if head == MAGIC:
+            self._open_binary(path)
+        elif head == b'PAR1' and pyarrow is not None:
+            self._open_parquet(path)
+        else:
+            raise ValueError(f"{path} is not a precompute output (or needs pyarrow)")
+
+    def _open_binary(self, path):
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_profiles, n_rows, meta_len, matrix_off = HEADER.unpack_from(self._mm, 0)
+        meta = json.loads(self._mm[HEADER.size:HEADER.size + meta_len].decode())
+        self.data_version = meta["data_version"]
+        self.db_version = meta.get("db_version")
+        self.rows = {p["key"]: (p["row"], len(p["stops"]) - 1) for p in meta["profiles"]}
+        self._matrix_off = matrix_off
+        self._values = None
+
+    def _open_parquet(self, path):
+        table = pyarrow.parquet.read_table(path, columns=["profile_key", "start_index", "minutes"])
+        metadata = table.schema.metadata or {}
+        self.data_version = metadata.get(b"data_version", b"").decode() or None
+        self.db_version = metadata.get(b"db_version", b"").decode() or None
+        self.rows = {}
+        self._values = array.array('f')
+        for i, (pkey, start_index, minutes) in enumerate(zip(
+                table.column("profile_key").to_pylist(), table.column("start_index").to_pylist(),
+                table.column("minutes").to_pylist())):
+            if start_index == 0:
+                self.rows[pkey] = (i, 0)
+            first, count = self.rows[pkey]
+            self.rows[pkey] = (first, count + 1)
+            self._values.extend(math.nan if v is None else v for v in minutes)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, row):
+        if self._values is not None:
+            return self._values[row * SLOTS:(row + 1) * SLOTS]
+        values = array.array('f')
+        offset = self._matrix_off + row * SLOTS * 4
+        values.frombytes(self._mm[offset:offset + SLOTS * 4])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def chart_data(self, stops, freq_data, start_index):
+        """calculate_hourly_data(stops, start_index, terminus, freq_data) if precomputed, else None."""
+        entry = self.rows.get(profile_key(stops, freq_data))
+        if entry is None or not 0 <= start_index < entry[1]:
+            return None
+        values = self._row(entry[0] + start_index)
+        return {
+            day_code: [None if math.isnan(v) else round(v, 2) for v in values[d * 24:(d + 1) * 24]]
+            for d, day_code in enumerate(analyze_route.DAYS)
+        }
+
+
+# (file stat, PrecomputedTable or None) of the file last opened
+_table = (None, None)
+_table_lock = threading.Lock()
+
+
+def get_precomputed_table():
+    """
+    Process-wide PrecomputedTable, or None if PRECOMPUTED_FILE does not exist or
+    cannot be read. The file is reopened when it is replaced (data_sync.py
+    rebuilds it for every new data generation).
+    """
+    global _table
+    try:
+        st = os.stat(PRECOMPUTED_FILE)
+    except OSError:
+        return None
+    key = (PRECOMPUTED_FILE, st.st_ino, st.st_mtime_ns, st.st_size)
+    if _table[0] == key:
+        return _table[1]
+    with _table_lock:
+        if _table[0] != key:
+            try:
+                table = PrecomputedTable(PRECOMPUTED_FILE)
+                print(f"Loaded precomputed travel times {PRECOMPUTED_FILE} ({len(table)} stop sequences)")
+            except Exception as e:
+                print(f"Could not open precomputed travel times {PRECOMPUTED_FILE}: {e}")
+                table = None
+            # A replaced table's mapping is left to the garbage collector, readers may still hold it
+            _table = (key, table)
+        return _table[1]
+
+
+def load_db(source=None):
+    """Route database from a URL/file, or the local snapshot, or a fresh download."""
+    if source:
+        if '://' not in source:
+            source = 'file://' + os.path.abspath(source)
+        return route_snapshot.fetch_compact_db(source)
+    return route_snapshot.load_snapshot() or route_snapshot.fetch_compact_db(analyze_route.BRIDGE_DB_URL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute hourly travel times for every route and start stop")
+    parser.add_argument('--db', help="routeFareList URL or file (default: route snapshot, else download)")
+    parser.add_argument('--output', default=PRECOMPUTED_FILE)
+    parser.add_argument('--format', choices=['auto', 'parquet', 'binary'], default='auto')
+    parser.add_argument('--workers', type=int, help="processes (default: all cores)")
+    parser.add_argument('--limit', type=int, help="only the first N stop sequences (for testing)")
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt == 'auto':
+        fmt = 'parquet' if pyarrow is not None and args.output.endswith('.parquet') else 'binary'
+    if fmt == 'parquet' and pyarrow is None:
+        print("Parquet output needs pyarrow (pip install pyarrow)")
+        sys.exit(1)
+
+    db = load_db(args.db)
+    if not db:
+        sys.exit(1)
+    profiles, results = run_precompute(db, args.workers, args.limit)
+    if fmt == 'parquet':
+        write_parquet(db, profiles, results, args.output)
+    else:
+        write_binary(db, profiles, results, args.output)
+    print(f"Wrote {args.output} ({fmt}, {os.path.getsize(args.output) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
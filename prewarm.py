@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+
+import analyze_route
+
+# Traffic-driven cache prewarming for cold starts.
+#
+# BusRouteHandler records every answered /api/route query in an
+# AccessRecorder, which keeps decayed hit counts and periodically writes the
+# top ACCESS_TOP_N queries to ACCESS_LOG_FILE. When a new instance starts,
+# start_prewarm() replays that list (most requested first) in a background
+# thread while the server already accepts connections, so the popular routes'
+# segment data and results are in memory before users ask for them. The
+# warmup stops at PREWARM_SECONDS or once the process has grown by
+# PREWARM_MEMORY_MB, whichever comes first.
+
+# Where the top queries are kept (point it at a mounted volume to share it
+# between instances and deploys)
+ACCESS_LOG_FILE = os.environ.get('ACCESS_LOG_FILE', 'access_top.json')
+ACCESS_TOP_N = int(os.environ.get('ACCESS_TOP_N', 200))
+# Distinct queries counted between flushes; new ones are ignored once full
+ACCESS_MAX_KEYS = int(os.environ.get('ACCESS_MAX_KEYS', ACCESS_TOP_N * 20))
+# How often the counts are decayed and written out (seconds)
+ACCESS_FLUSH_INTERVAL = int(os.environ.get('ACCESS_FLUSH_INTERVAL', 300))
+# Weight kept by old counts at each flush, so the list follows changing traffic
+ACCESS_DECAY = float(os.environ.get('ACCESS_DECAY', 0.9))
+# Warmup budget (0 = no prewarming)
+PREWARM_SECONDS = float(os.environ.get('PREWARM_SECONDS', 60))
+PREWARM_MEMORY_MB = float(os.environ.get('PREWARM_MEMORY_MB', 256))
+
+
+def current_rss_mb():
+    """Resident memory of this process (Linux), else the shard cache size as an estimate."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return analyze_route.SHARD_CACHE.stats()["bytes"] / (1024 * 1024)
+
+
+def load_top(path=ACCESS_LOG_FILE):
+    """[(query args, count)] from the access file, most requested first ([] if there is none)."""
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return []
+    top = []
+    for e in entries:
+        try:
+            args = (str(e["route"]), int(e["start"]), e.get("end"), int(e.get("variant", 0)), e.get("dest"))
+            top.append((args, float(e.get("count", 1))))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return top
+
+
+class AccessRecorder:
+    """Decayed hit counts of /api/route queries, (route, start, end, variant, dest) -> count."""
+    def __init__(self, path=ACCESS_LOG_FILE, top_n=ACCESS_TOP_N, max_keys=ACCESS_MAX_KEYS):
+        self.path = path
+        self.top_n = top_n
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # Seeded with the saved list so a restart does not forget the history
+        self.counts = dict(load_top(path))
+        self._thread = None
+
+    def record(self, args):
+        with self._lock:
+            count = self.counts.get(args)
+            if count is None:
+                # Bounds memory under many one-off queries; each flush keeps
+                # only the top ones, which makes room again
+                if len(self.counts) >= self.max_keys:
+                    return
+                count = 0
+            self.counts[args] = count + 1
+
+    def top(self, n=None):
+        with self._lock:
+            items = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        return items[:n or self.top_n]
+
+    def flush(self):
+        """Writes the top queries out and decays the counts; the long tail is dropped."""
+        with self._lock:
+            items = sorted(self.counts.items(), key=lambda kv: -kv[1])[:self.top_n * 2]
+            self.counts = {args: count * ACCESS_DECAY for args, count in items}
+        entries = [
+            {"route": route_id, "variant": variant_idx, "start": start_idx, "end": end_idx,
+             "dest": dest, "count": round(count, 2)}
+            for (route_id, start_idx, end_idx, variant_idx, dest), count in items[:self.top_n]
+        ]
+        if not entries:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save access counts to {self.path}: {e}")
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(ACCESS_FLUSH_INTERVAL)
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="access-flush", daemon=True)
+            self._thread.start()
+        return self
+
+
+def prewarm(warm_fn, top, seconds=PREWARM_SECONDS, memory_mb=PREWARM_MEMORY_MB):
+    """
+    Calls warm_fn(args) for each query in top (most requested first) until the
+    list or a budget runs out. Returns (warmed, reason stopped).
+    """
+    started = time.time()
+    base_rss = current_rss_mb()
+    warmed = 0
+    for args, _ in top:
+        if time.time() - started >= seconds:
+            return warmed, "time budget"
+        if current_rss_mb() - base_rss >= memory_mb:
+            return warmed, "memory budget"
+        try:
+            warm_fn(args)
+            warmed += 1
+        except Exception as e:
+            print(f"Prewarm of {args} failed: {e}")
+    return warmed, "done"
+
+
+def start_prewarm(warm_fn, recorder):
+    """Runs prewarm() over the recorded top queries in a background thread."""
+    top = recorder.top()
+    if not top or PREWARM_SECONDS <= 0:
+        return None
+
+    def run():
+        started = time.time()
+        warmed, reason = prewarm(warm_fn, top)
+        print(f"Prewarmed {warmed}/{len(top)} popular routes in {time.time() - started:.1f}s ({reason}).")
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
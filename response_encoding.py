@@ -0,0 +1,212 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# Response serialization and compression, shared by server.py and async_server.py.
+#
+# Payloads are serialized with orjson when it is installed (several times
+# faster than json.dumps on the chart data), and bodies above
+# COMPRESS_MIN_BYTES are sent gzip- or brotli-encoded when the client's
+# Accept-Encoding allows it. Compressed bytes are kept in a small LRU keyed by
+# the response's identity (the ETag for /api/route, the file and its mtime for
+# static files, else a hash of the body), so hot responses are compressed once.
+
+# Smallest body worth compressing (bytes)
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+# Compression levels for API responses; static files get the maximum, once
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+# Memory for compressed responses (MB)
+COMPRESSED_CACHE_MB = float(os.environ.get('COMPRESSED_CACHE_MB', 32))
+
+# Preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/javascript', 'image/svg+xml', 'text/')
+
+
+def dumps(payload):
+    """JSON body bytes for a response payload."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            pass  # something orjson does not know (e.g. a float subclass)
+    return json.dumps(payload).encode()
+
+
+def choose_encoding(accept_encoding, encodings=ENCODINGS):
+    """Best of encodings the Accept-Encoding header allows, or None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(body, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else BROTLI_QUALITY)
+    if encoding == 'gzip':
+        # mtime=0 keeps the output (and the cache) deterministic
+        return gzip.compress(body, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+class CompressedCache:
+    """Thread-safe LRU of compressed bodies, bounded by total size."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+CACHE = CompressedCache(int(COMPRESSED_CACHE_MB * 1024 * 1024))
+
+
+def encode_body(body, encoding, key=None, best=False):
+    """Compressed body, from CACHE when the same key (default: body hash) was compressed before."""
+    if key is None:
+        key = hashlib.sha1(body).digest()
+    cache_key = (key, encoding)
+    encoded = CACHE.get(cache_key)
+    if encoded is None:
+        encoded = compress(body, encoding, best)
+        CACHE.put(cache_key, encoded)
+    return encoded
+
+
+def negotiate(body, accept_encoding, content_type, key=None, best=False):
+    """
+    (body, extra headers) to send for a response: compressed when the type is
+    compressible, the body is large enough and the client accepts an encoding.
+    """
+    if not is_compressible(content_type):
+        return body, {}
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return body, headers
+    headers['Content-Encoding'] = encoding
+    return encode_body(body, encoding, key, best), headers
+
+
+def negotiate_stream(chunks, accept_encoding, content_type):
+    """
+    (chunks, extra headers) for a body sent while it is produced (an iterator
+    or async iterator of bytes): gzip-encoded
+    on the fly when the client accepts it, with a sync flush after every chunk
+    so each one reaches the client as soon as it is written.
+    """
+    if not is_compressible(content_type):
+        return chunks, {}
+    headers = {'Vary': 'Accept-Encoding'}
+    if choose_encoding(accept_encoding, ('gzip',)) is None:
+        return chunks, headers
+    headers['Content-Encoding'] = 'gzip'
+    if hasattr(chunks, '__aiter__'):
+        return gzip_astream(chunks), headers
+    return gzip_stream(chunks), headers
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+async def gzip_astream(chunks):
+    """gzip_stream for an async iterator (async_server.py)."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def weak_etag(etag):
+    """The ETag of a compressed representation (byte-different, semantically the same)."""
+    return etag if etag.startswith('W/') else 'W/' + etag
+
+
+# Static file bodies by path, with the key they were read under
+_static_files = {}
+_static_lock = threading.Lock()
+
+
+def read_static(path):
+    """
+    (body, cache key) for a static file; the key changes when the file does.
+    The body is read again only then.
+    """
+    st = os.stat(path)
+    key = ('static', path, st.st_mtime_ns, st.st_size)
+    entry = _static_files.get(path)
+    if entry is not None and entry[1] == key:
+        return entry
+    with open(path, 'rb') as f:
+        body = f.read()
+    with _static_lock:
+        _static_files[path] = (body, key)
+    return body, key
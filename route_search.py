@@ -0,0 +1,289 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import analyze_route
+
+# Search index behind /api/search (the dashboard's autocomplete).
+#
+# Built once per loaded database, next to analyze_route.RouteIndex:
+#
+#   route number prefix   -> route entries        ("1", "1A", "N21"...)
+#   destination word prefix / Chinese n-gram -> route entries
+#   stop name word prefix / Chinese n-gram   -> stops -> routes calling there
+#
+# English text is split into lowercase words and every prefix of a word is a
+# key, so "star f" finds "Star Ferry". Chinese has no word breaks, so names
+# are indexed by single characters and character pairs and a query must
+# contain all of its pairs ("尖沙咀" -> 尖沙, 沙咀), checked against the full
+# name afterwards. Posting lists hold document numbers in ranking order, so
+# the first matches of an intersection are already the best ones.
+#
+# Results are ranked exact route number > route number prefix > destination
+# > stop name, and each keystroke has SEARCH_BUDGET_MS: the slower tiers are
+# skipped once the budget is spent and the results found so far returned.
+
+# Time allowed for one query (ms)
+SEARCH_BUDGET_MS = float(os.environ.get('SEARCH_BUDGET_MS', 20))
+# Recent queries kept with their results (typing re-sends the same prefixes)
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 2048))
+MAX_LIMIT = 50
+# Longest word prefix indexed; longer query words are checked against the name
+MAX_PREFIX = 12
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+CJK_RE = re.compile('[\u2e80-\U0002ffff]+')
+
+
+def is_cjk(ch):
+    return ch >= '\u2e80'
+
+
+def split_text(text):
+    """(English words, runs of CJK characters) of a name, lowercased."""
+    text = text.lower()
+    words = WORD_RE.findall(text)
+    runs = CJK_RE.findall(text)
+    return words, runs
+
+
+class TermIndex:
+    """Word-prefix and CJK n-gram postings over documents added in ranking order."""
+    def __init__(self):
+        self.postings = {}
+        self.texts = []
+
+    def _post(self, term, doc):
+        plist = self.postings.setdefault(term, [])
+        if not plist or plist[-1] != doc:
+            plist.append(doc)
+
+    def add(self, doc, *texts):
+        """Indexes doc (the next document number) under each of its names."""
+        # One line per name, for the checks made after the postings
+        self.texts.append('\n' + '\n'.join(t.lower() for t in texts if t))
+        for text in texts:
+            if not text:
+                continue
+            words, runs = split_text(text)
+            for word in words:
+                for n in range(1, min(len(word), MAX_PREFIX) + 1):
+                    self._post(word[:n], doc)
+            for run in runs:
+                for i, ch in enumerate(run):
+                    self._post(ch, doc)
+                    if i + 1 < len(run):
+                        self._post(run[i:i + 2], doc)
+
+    def starts_with(self, doc, query):
+        """Whether one of doc's names starts with query (ranked above a match further in)."""
+        return '\n' + query.lower() in self.texts[doc]
+
+    def finish(self):
+        # Posting lists only ever grow in document order, so they are sorted;
+        # tuples are smaller than lists
+        self.postings = {term: tuple(plist) for term, plist in self.postings.items()}
+
+    def lookup(self, query, limit, deadline):
+        """Document numbers matching every word / character pair of query, best first."""
+        words, runs = split_text(query)
+        terms, checks = [], []
+        for word in words:
+            terms.append(word[:MAX_PREFIX])
+            if len(word) > MAX_PREFIX:
+                checks.append(word)
+        for run in runs:
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+                if len(run) > 2:
+                    checks.append(run)
+        if not terms:
+            return []
+
+        lists = []
+        for term in set(terms):
+            plist = self.postings.get(term)
+            if not plist:
+                return []
+            lists.append(plist)
+        lists.sort(key=len)
+        first, others = lists[0], [set(plist) for plist in lists[1:]]
+
+        found = []
+        for doc in first:
+            if all(doc in other for other in others):
+                text = self.texts[doc]
+                if all(check in text for check in checks):
+                    found.append(doc)
+                    if len(found) >= limit or time.perf_counter() >= deadline:
+                        break
+        return found
+
+
+class SearchIndex:
+    """Route, destination and stop name search over one database."""
+    def __init__(self, db):
+        self.db = db
+        route_index = analyze_route.get_route_index(db)
+        stop_list = db.get('stopList', {})
+
+        # Route documents: one per (route number, destination), in the same
+        # order as the old prefix search (shortest route number first)
+        entries = {}
+        for route_num, variants in route_index.variants.items():
+            if not isinstance(route_num, str):
+                continue
+            for key, val, dest in variants:
+                if (route_num, dest) not in entries:
+                    entries[(route_num, dest)] = (val.get('dest', {}).get('zh'), [])
+                entries[(route_num, dest)][1].append(key)
+        self.routes = []
+        self.route_keys = []
+        self.route_prefixes = {}
+        doc_of_key = {}
+        for (route_num, dest), (dest_zh, keys) in sorted(entries.items(), key=lambda kv: (len(kv[0][0]), kv[0])):
+            doc = len(self.routes)
+            entry = {"route": route_num, "dest": dest}
+            if dest_zh:
+                entry["dest_zh"] = dest_zh
+            self.routes.append(entry)
+            self.route_keys.append(keys)
+            for key in keys:
+                doc_of_key[key] = doc
+            upper = route_num.upper()
+            for n in range(1, len(upper) + 1):
+                self.route_prefixes.setdefault(upper[:n], []).append(doc)
+
+        self.dest_terms = TermIndex()
+        for doc, entry in enumerate(self.routes):
+            self.dest_terms.add(doc, entry["dest"], entry.get("dest_zh"))
+        self.dest_terms.finish()
+
+        # Stop documents, busiest stops (most routes calling) first
+        served = {}
+        for sid, plist in route_index.postings.items():
+            docs = []
+            for key, _ in plist:
+                doc = doc_of_key.get(key)
+                if doc is not None and doc not in docs:
+                    docs.append(doc)
+            if docs:
+                served[sid] = sorted(docs)
+        self.stops = []
+        self.stop_terms = TermIndex()
+        ranked = sorted(served, key=lambda sid: (-len(served[sid]), stop_list.get(sid, {}).get('name', {}).get('en', ''), sid))
+        for sid in ranked:
+            name = stop_list.get(sid, {}).get('name', {})
+            if not name:
+                continue
+            doc = len(self.stops)
+            self.stops.append((sid, name.get('en'), name.get('zh'), tuple(served[sid])))
+            self.stop_terms.add(doc, name.get('en'), name.get('zh'))
+        self.stop_terms.finish()
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def search(self, query, limit=10):
+        """Up to limit route entries for query, best match first."""
+        query = query.strip()
+        limit = max(1, min(limit, MAX_LIMIT))
+        if not query:
+            return []
+        cache_key = (query.lower(), limit)
+        with self._cache_lock:
+            results = self._cache.get(cache_key)
+            if results is not None:
+                self._cache.move_to_end(cache_key)
+                return results
+
+        results, complete = self._search(query, limit)
+        # A search cut short by the budget is not cached, so the next
+        # keystroke (or a retry) can complete it
+        if complete:
+            with self._cache_lock:
+                self._cache[cache_key] = results
+                while len(self._cache) > SEARCH_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return results
+
+    def _search(self, query, limit):
+        deadline = time.perf_counter() + SEARCH_BUDGET_MS / 1000
+        results = []
+        seen = set()
+
+        def add(doc, match, extra=None):
+            if doc in seen:
+                return
+            seen.add(doc)
+            result = dict(self.routes[doc], match=match)
+            if extra:
+                result.update(extra)
+            results.append(result)
+
+        # 1. Route numbers. Prefix lists are sorted by length, so the exact
+        # route (all its destinations) comes first
+        upper = query.upper().replace(' ', '')
+        for doc in self.route_prefixes.get(upper, ())[:limit]:
+            add(doc, "route")
+
+        # 2. Destinations; names starting with the query go first
+        if len(results) < limit:
+            if time.perf_counter() >= deadline:
+                return results, False
+            docs = self.dest_terms.lookup(query, limit * 4, deadline)
+            docs.sort(key=lambda doc: not self.dest_terms.starts_with(doc, query))
+            for doc in docs:
+                add(doc, "dest")
+                if len(results) >= limit:
+                    break
+
+        # 3. Stop names, then the routes calling at each matching stop
+        if len(results) < limit:
+            if time.perf_counter() >= deadline:
+                return results, False
+            docs = self.stop_terms.lookup(query, limit * 4, deadline)
+            docs.sort(key=lambda doc: not self.stop_terms.starts_with(doc, query))
+            chinese = any(is_cjk(ch) for ch in query)
+            for doc in docs:
+                sid, name_en, name_zh, route_docs = self.stops[doc]
+                stop_name = name_zh if chinese and name_zh else name_en
+                for route_doc in route_docs:
+                    add(route_doc, "stop", {"stop": stop_name, "stop_id": sid})
+                    if len(results) >= limit:
+                        break
+                if len(results) >= limit:
+                    break
+
+        return results, time.perf_counter() < deadline
+
+
+# Indexes of the current and the previous database (see analyze_route.get_route_index)
+_search_indexes = OrderedDict()
+_search_index_lock = threading.Lock()
+
+
+def get_search_index(db):
+    """Returns the SearchIndex for db, building it on first use for that database."""
+    index = _search_indexes.get(id(db))
+    if index is not None and index.db is db:
+        return index
+    with _search_index_lock:
+        index = _search_indexes.get(id(db))
+        if index is None or index.db is not db:
+            started = time.time()
+            index = SearchIndex(db)
+            _search_indexes[id(db)] = index
+            while len(_search_indexes) > 2:
+                _search_indexes.popitem(last=False)
+            print(f"Search index built in {time.time() - started:.2f}s "
+                  f"({len(index.routes)} routes, {len(index.stops)} stops)")
+        return index
+
+
+def search(db, query, limit=10):
+    return get_search_index(db).search(query, limit)
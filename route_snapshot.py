@@ -0,0 +1,263 @@
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import sys
+import urllib.request
+
+import analyze_route
+
+# Compact local snapshot of routeFareList.
+#
+# The full routeFareList.min.json is large and needs a network round trip on
+# every cold start. The snapshot keeps only what the server reads - KMB/CTB
+# routes (route, co, dest, stops, freq) and the names (English and Chinese, for
+# search) and locations of the stops they use - with interned strings, pickled
+# so it loads in milliseconds.
+# It keeps the routeFareList layout, so it can be used wherever ROUTE_DB is.
+#
+# The download is parsed as a stream, one routeList/stopList entry at a time
+# (json's C scanner via raw_decode), and projected while it is read, so the
+# full database is never held in memory.
+#
+# Build (at image build / sync time):
+#     python route_snapshot.py build [url_or_file]
+
+SNAPSHOT_FILE = os.environ.get('ROUTE_SNAPSHOT', 'route_snapshot.pickle')
+# Bytes read per step when parsing routeFareList as a stream
+STREAM_CHUNK = 1 << 16
+
+
+class Compactor:
+    """
+    Builds a compact db one routeList / stopList entry at a time, so the full
+    database never has to be in memory. Stop sequences and operator lists are
+    interned tuples, identical freq tables are shared, and stops no KMB/CTB
+    route uses are dropped at the end.
+    """
+    def __init__(self):
+        self.route_list = {}
+        self.stop_list = {}
+        self.used_stops = set()
+        self._freqs = {}
+
+    def add_route(self, key, val):
+        intern = sys.intern
+        company_list = val.get('co', [])
+        if not ('kmb' in company_list or 'ctb' in company_list):
+            return
+        stops = {}
+        for co in ('kmb', 'ctb'):
+            ids = val.get('stops', {}).get(co)
+            if ids:
+                stops[co] = tuple(intern(sid) for sid in ids)
+                self.used_stops.update(stops[co])
+        route = val.get('route')
+        entry = {
+            "route": intern(route) if isinstance(route, str) else route,
+            "co": tuple(intern(c) for c in company_list),
+            "stops": stops,
+            "freq": self._shared_freq(val.get('freq'))
+        }
+        dest = {lang: intern(name) for lang, name in val.get('dest', {}).items()
+                if lang in ('en', 'zh') and isinstance(name, str)}
+        if dest:
+            entry["dest"] = dest
+        self.route_list[intern(key)] = entry
+
+    def _shared_freq(self, freq_data):
+        # Most variants of a route (and many routes) have the same timetable
+        if not freq_data:
+            return freq_data
+        fkey = json.dumps(freq_data, sort_keys=True)
+        return self._freqs.setdefault(fkey, freq_data)
+
+    def add_stop(self, sid, info):
+        entry = {}
+        name = {lang: text for lang, text in info.get('name', {}).items()
+                if lang in ('en', 'zh') and isinstance(text, str)}
+        if name:
+            entry["name"] = name
+        location = info.get('location')
+        if location and 'lat' in location and 'lng' in location:
+            entry["location"] = {"lat": location['lat'], "lng": location['lng']}
+        self.stop_list[sys.intern(sid)] = entry
+
+    def result(self):
+        stop_list = {sid: info for sid, info in self.stop_list.items() if sid in self.used_stops}
+        return {"routeList": self.route_list, "stopList": stop_list}
+
+
+def compact_db(db):
+    """Projects a routeFareList dict down to the fields the server uses."""
+    compactor = Compactor()
+    for key, val in db.get('routeList', {}).items():
+        compactor.add_route(key, val)
+    for sid, info in db.get('stopList', {}).items():
+        compactor.add_stop(sid, info)
+    return compactor.result()
+
+
+class _JSONStream:
+    """Pull reader over a JSON byte stream: structural characters one at a time, values with raw_decode."""
+    def __init__(self, f):
+        self.f = f
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(STREAM_CHUNK)
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + self.text.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character without consuming it ('' at the end)."""
+        while True:
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self.fill():
+                return ''
+
+    def take(self, expected):
+        c = self.peek()
+        if not c or c not in expected:
+            raise ValueError(f"Malformed route database: expected {expected!r}, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_members(f, sections):
+    """(section, key, value) for every member of the top-level objects named in sections."""
+    reader = _JSONStream(f)
+    reader.take('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.take(':')
+        if reader.peek() != '{':
+            reader.value()
+        else:
+            # Decoded member by member, so a section is never in memory as a whole
+            reader.take('{')
+            if reader.peek() == '}':
+                reader.take('}')
+            else:
+                while True:
+                    key = reader.value()
+                    reader.take(':')
+                    value = reader.value()
+                    if name in sections:
+                        yield name, key, value
+                    if reader.take(',}') == '}':
+                        break
+        if reader.take(',}') == '}':
+            return
+
+
+def stream_compact_db(f):
+    """Compact db parsed straight from a routeFareList byte stream (file or HTTP response)."""
+    compactor = Compactor()
+    for section, key, value in iter_members(f, ('routeList', 'stopList')):
+        if section == 'routeList':
+            compactor.add_route(key, value)
+        else:
+            compactor.add_stop(key, value)
+    return compactor.result()
+
+
+def fetch_compact_db(url):
+    """Downloads (or reads, for file:// URLs) routeFareList and compacts it while parsing. None on failure."""
+    try:
+        print(f"Downloading route database from {url}...")
+        req = urllib.request.Request(url, headers={'User-Agent': "Mozilla/5.0", 'Accept-Encoding': 'gzip'})
+        with urllib.request.urlopen(req) as resp:
+            f = resp
+            if resp.headers.get('Content-Encoding') == 'gzip':
+                f = gzip.GzipFile(fileobj=resp)
+            return stream_compact_db(f)
+    except Exception as e:
+        print(f"Error fetching DB: {e}")
+        return None
+
+
+def save_snapshot(db, path=SNAPSHOT_FILE):
+    """
+    Writes a compact db (see compact_db) atomically and returns it with its
+    content hash stored under 'snapshotVersion'.
+    """
+    db = dict(db)
+    db.pop('snapshotVersion', None)
+    data = pickle.dumps(db, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    db['snapshotVersion'] = hashlib.sha1(data).hexdigest()[:12]
+    return db
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """Loads a snapshot written by save_snapshot, or returns None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        db = pickle.loads(data)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Could not load route snapshot {path}: {e}")
+        return None
+    db['snapshotVersion'] = hashlib.sha1(data).hexdigest()[:12]
+    print(f"Loaded route snapshot {path} ({len(db['routeList'])} routes)")
+    return db
+
+
+def fetch_snapshot(url=analyze_route.BRIDGE_DB_URL, path=SNAPSHOT_FILE):
+    """Downloads routeFareList, compacts it and saves the snapshot. Returns the compact db or None."""
+    db = fetch_compact_db(url)
+    if not db:
+        return None
+    return save_snapshot(db, path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        source = sys.argv[2] if len(sys.argv) > 2 else analyze_route.BRIDGE_DB_URL
+        if '://' not in source:
+            source = 'file://' + os.path.abspath(source)
+        db = fetch_snapshot(source)
+        if not db:
+            sys.exit(1)
+        print(f"Snapshot written to {SNAPSHOT_FILE}: {len(db['routeList'])} routes, "
+              f"{len(db['stopList'])} stops, {os.path.getsize(SNAPSHOT_FILE) / 1e6:.1f} MB")
+    else:
+        print("Usage: python route_snapshot.py build [url_or_file]")
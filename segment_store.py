@@ -0,0 +1,328 @@
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+
+import data_pack
+
+# Compiled segment-time store.
+#
+# The times_hourly tree is ~56k small JSON files (<day>/<hour>/<prefix>.json).
+# Parsing them on every request dominates cold request latency, so this module
+# compiles the whole tree into one binary file that is memory-mapped at runtime:
+#
+#   header   : magic, counts and section offsets (little-endian)
+#   stops    : newline separated stop IDs (the interning table)
+#   segments : n_segments x (uint32 from_stop, uint32 to_stop), sorted
+#   matrix   : n_segments x 7 days x 24 hours float32 seconds, 0.0 = no data
+#   tiers    : n_segments x 7 days x 24 hours uint8, which fallback tier
+#              filled each matrix slot (TIER_*)
+#
+# Slots without data for their hour are filled at build time from, in order:
+# the previous / next hour of the same day, the mean of the same hour on the
+# other days, and the segment's daily average in times/<prefix>.json. Every
+# lookup is then a single read from the page cache, which is shared by all
+# worker processes on the instance.
+#
+# Build (offline, after each data sync):
+#     python segment_store.py build [hourly_dir] [output_file] [daily_dir]
+
+PAGES_DIR = 'hk-bus-time-between-stops-pages'
+HOURLY_BASE = os.path.join(PAGES_DIR, 'times_hourly')
+DAILY_BASE = os.path.join(PAGES_DIR, 'times')
+STORE_FILE = os.environ.get('SEGMENT_STORE', 'segment_times.bin')
+
+MAGIC = b'HKSEGT02'
+# magic, n_stops, n_segments, n_days, n_hours, stops_off, stops_len, segs_off, matrix_off, tiers_off
+HEADER = struct.Struct('<8sIIIIQQQQQ')
+N_DAYS = 7
+N_HOURS = 24
+SLOTS = N_DAYS * N_HOURS
+
+# Where a segment time came from, best first
+TIER_EXACT = 0       # times_hourly, the hour asked for
+TIER_NEIGHBOUR = 1   # times_hourly, previous or next hour of the same day
+TIER_OTHER_DAYS = 2  # times_hourly, mean of the same hour on the other days
+TIER_DAILY = 3       # times/<prefix>.json daily average
+TIER_NONE = 255
+TIER_NAMES = {TIER_EXACT: 'exact', TIER_NEIGHBOUR: 'neighbour_hour',
+              TIER_OTHER_DAYS: 'other_days', TIER_DAILY: 'daily', TIER_NONE: 'none'}
+
+
+def _align(n, to=8):
+    return (n + to - 1) // to * to
+
+
+def fill_slot(value_at, day, hour, daily=None):
+    """
+    (seconds, tier) for one departure slot, going down the fallback tiers.
+    value_at(day, hour) returns the hourly seconds for the segment (0 = none),
+    daily is its times/ average (or None).
+    """
+    v = value_at(day, hour)
+    if v > 0:
+        return v, TIER_EXACT
+    for h in ((hour - 1) % N_HOURS, (hour + 1) % N_HOURS):
+        v = value_at(day, h)
+        if v > 0:
+            return v, TIER_NEIGHBOUR
+    others = [v for v in (value_at(d, hour) for d in range(N_DAYS) if d != day) if v > 0]
+    if others:
+        return sum(others) / len(others), TIER_OTHER_DAYS
+    if daily:
+        return daily, TIER_DAILY
+    return 0.0, TIER_NONE
+
+
+def fill_row(raw, daily=None, typecode='f'):
+    """
+    (filled seconds, tiers) for a segment's 168 raw hourly slots (day-major, 0 =
+    no data). Seconds are float32 as in the store; typecode 'd' keeps float64.
+    """
+    filled = array.array(typecode, raw)
+    tiers = bytearray(SLOTS)
+    value_at = lambda d, h: raw[d * N_HOURS + h]
+    for slot in range(SLOTS):
+        if raw[slot] <= 0:
+            filled[slot], tiers[slot] = fill_slot(value_at, slot // N_HOURS, slot % N_HOURS, daily)
+    return filled, tiers
+
+
+def load_daily(daily_base=DAILY_BASE):
+    """(start_id, end_id) -> daily average seconds from times/<prefix>.json (own-prefix entries only)."""
+    daily = {}
+    for name in data_pack.list_json(daily_base):
+        prefix = name[:-5]
+        try:
+            shard, _ = data_pack.read_json(os.path.join(daily_base, name))
+        except Exception as e:
+            print(f"  Skipping daily {name}: {e}")
+            continue
+        for start_id, targets in shard.items():
+            if start_id[:2] != prefix:
+                continue
+            for end_id, val in targets.items():
+                if isinstance(val, (int, float)) and val > 0:
+                    daily[(start_id, end_id)] = val
+    return daily
+
+
+def build_store(hourly_base=HOURLY_BASE, output_file=STORE_FILE, daily_base=DAILY_BASE):
+    """
+    Walks times_hourly/<day>/<hour>/<prefix>.json and times/<prefix>.json
+    (or their data packs) and writes the compiled store. Only entries living in the shard for their own
+    prefix are kept, which is exactly what the JSON lookup in
+    calculate_hourly_data can see.
+    """
+    print(f"Compiling {hourly_base} into {output_file}...")
+    rows = {}  # (start_id, end_id) -> array('f') of SLOTS
+    files = 0
+
+    for day in range(N_DAYS):
+        for hour in range(N_HOURS):
+            hour_dir = os.path.join(hourly_base, str(day), f"{hour:02d}")
+            slot = day * N_HOURS + hour
+            # From the JSON files, or the data pack when they are not on disk
+            for name in data_pack.list_json(hour_dir):
+                prefix = name[:-5]
+                if name == 'all.json':
+                    continue
+                try:
+                    shard, _ = data_pack.read_json(os.path.join(hour_dir, name))
+                except Exception as e:
+                    print(f"  Skipping {name} ({day}/{hour:02d}): {e}")
+                    continue
+                files += 1
+                for start_id, targets in shard.items():
+                    if start_id[:2] != prefix:
+                        continue
+                    for end_id, val in targets.items():
+                        if not isinstance(val, (int, float)) or val <= 0:
+                            continue
+                        row = rows.get((start_id, end_id))
+                        if row is None:
+                            row = array.array('f', bytes(4 * SLOTS))
+                            rows[(start_id, end_id)] = row
+                        row[slot] = val
+        print(f"  Day {day} done ({files} files, {len(rows)} segments)")
+
+    daily = load_daily(daily_base)
+    # Segments with only a daily average still get a row (all TIER_DAILY)
+    for pair in daily:
+        if pair not in rows:
+            rows[pair] = array.array('f', bytes(4 * SLOTS))
+    print(f"  Daily averages for {len(daily)} segments")
+
+    stop_ids = sorted({sid for pair in rows for sid in pair})
+    stop_index = {sid: i for i, sid in enumerate(stop_ids)}
+    seg_keys = sorted(rows, key=lambda k: (stop_index[k[0]], stop_index[k[1]]))
+
+    stops_blob = '\n'.join(stop_ids).encode('utf-8')
+    seg_table = array.array('I')
+    for start_id, end_id in seg_keys:
+        seg_table.append(stop_index[start_id])
+        seg_table.append(stop_index[end_id])
+
+    stops_off = HEADER.size
+    segs_off = _align(stops_off + len(stops_blob))
+    matrix_off = _align(segs_off + len(seg_table) * 4)
+    tiers_off = _align(matrix_off + len(seg_keys) * SLOTS * 4)
+
+    if sys.byteorder != 'little':
+        seg_table.byteswap()
+
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(stop_ids), len(seg_keys), N_DAYS, N_HOURS,
+                            stops_off, len(stops_blob), segs_off, matrix_off, tiers_off))
+        f.write(stops_blob)
+        f.write(b'\0' * (segs_off - f.tell()))
+        f.write(seg_table.tobytes())
+        f.write(b'\0' * (matrix_off - f.tell()))
+        tier_counts = [0] * 256
+        all_tiers = []
+        for key in seg_keys:
+            row, tiers = fill_row(rows[key], daily.get(key))
+            for t in tiers:
+                tier_counts[t] += 1
+            all_tiers.append(tiers)
+            if sys.byteorder != 'little':
+                row.byteswap()
+            f.write(row.tobytes())
+        f.write(b'\0' * (tiers_off - f.tell()))
+        for tiers in all_tiers:
+            f.write(tiers)
+    # Atomic swap so running readers keep their old mapping
+    os.replace(tmp_file, output_file)
+
+    print(f"Store written: {len(stop_ids)} stops, {len(seg_keys)} segments, "
+          f"{os.path.getsize(output_file) / 1e6:.1f} MB")
+    print("  Slots per tier: " + ", ".join(f"{TIER_NAMES[t]} {n}" for t, n in enumerate(tier_counts) if n))
+    return output_file
+
+
+class SegmentStore:
+    """Read-only view over a compiled store file."""
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, n_stops, n_segments, n_days, n_hours,
+         stops_off, stops_len, segs_off, matrix_off, tiers_off) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or n_days != N_DAYS or n_hours != N_HOURS:
+            raise ValueError(f"{path} is not a segment store (or has an old format)")
+
+        stop_ids = self._mm[stops_off:stops_off + stops_len].decode('utf-8').split('\n') if n_stops else []
+        seg_table = array.array('I')
+        seg_table.frombytes(self._mm[segs_off:segs_off + n_segments * 8])
+        if sys.byteorder != 'little':
+            seg_table.byteswap()
+
+        # (start_id, end_id) -> row number in the matrix
+        self.segments = {}
+        for row in range(n_segments):
+            self.segments[(stop_ids[seg_table[2 * row]], stop_ids[seg_table[2 * row + 1]])] = row
+
+        self.stop_ids = stop_ids
+        self._matrix_off = matrix_off
+        self._tiers = memoryview(self._mm)[tiers_off:tiers_off + n_segments * SLOTS]
+        if sys.byteorder == 'little':
+            self._matrix = memoryview(self._mm)[matrix_off:matrix_off + n_segments * SLOTS * 4].cast('f')
+        else:
+            self._matrix = None
+        self.mtime = os.path.getmtime(path)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _value(self, pos):
+        if self._matrix is not None:
+            return self._matrix[pos]
+        return struct.unpack_from('<f', self._mm, self._matrix_off + pos * 4)[0]
+
+    def lookup(self, day, hour, start_id, end_id):
+        """Segment time in seconds for day '0'-'6' and hour 0-23 (after fallback), or None if unknown."""
+        return self.lookup_tier(day, hour, start_id, end_id)[0]
+
+    def lookup_tier(self, day, hour, start_id, end_id):
+        """(seconds or None, TIER_*) for day '0'-'6' and hour 0-23: a single probe."""
+        row = self.segments.get((start_id, end_id))
+        if row is None:
+            return None, TIER_NONE
+        pos = row * SLOTS + int(day) * N_HOURS + hour
+        val = self._value(pos)
+        if val > 0:
+            return val, self._tiers[pos]
+        return None, TIER_NONE
+
+    def matrix(self):
+        """Flat float32 view of the whole (filled) matrix (zero-copy), or None on big-endian hosts."""
+        return self._matrix
+
+    def tiers(self):
+        """Flat uint8 view of the tier of every matrix slot (zero-copy)."""
+        return self._tiers
+
+    def row(self, start_id, end_id):
+        """All 168 filled slots (day-major) for one segment, or None. Missing slots are 0.0."""
+        row = self.segments.get((start_id, end_id))
+        if row is None:
+            return None
+        return [self._value(row * SLOTS + i) for i in range(SLOTS)]
+
+
+_store = None
+_store_checked = False
+_store_lock = threading.Lock()
+
+
+def store_is_current(path=STORE_FILE):
+    """True when path exists and was written in the current format."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def get_store():
+    """
+    Returns the process-wide SegmentStore, or None if no compiled store exists
+    (callers then fall back to reading the JSON shards).
+    """
+    global _store, _store_checked
+    if _store_checked:
+        return _store
+    with _store_lock:
+        if not _store_checked:
+            if os.path.exists(STORE_FILE):
+                try:
+                    _store = SegmentStore(STORE_FILE)
+                    print(f"Loaded segment store {STORE_FILE} ({len(_store)} segments)")
+                except Exception as e:
+                    print(f"Could not open segment store {STORE_FILE}: {e}")
+                    _store = None
+            _store_checked = True
+    return _store
+
+
+def reload_store():
+    """Drops the cached store so the next get_store() maps the (rebuilt) file again."""
+    global _store, _store_checked
+    with _store_lock:
+        _store = None
+        _store_checked = False
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        src = sys.argv[2] if len(sys.argv) > 2 else HOURLY_BASE
+        dst = sys.argv[3] if len(sys.argv) > 3 else STORE_FILE
+        daily_src = sys.argv[4] if len(sys.argv) > 4 else DAILY_BASE
+        build_store(src, dst, daily_src)
+    else:
+        print("Usage: python segment_store.py build [hourly_dir] [output_file] [daily_dir]")
@@ -1,43 +1,303 @@
+import atexit
+import hashlib
 import http.server
 import socketserver
 import urllib.parse
 import json
 import analyze_route
+import metrics
+import precompute
+import prewarm
+import response_encoding
+import shared_cache
+import trip_planner
+import route_search
+import route_snapshot
+import data_sync
 import sys
-import subprocess
 import time
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # Configuration
 PORT = int(os.environ.get('PORT', 8000))
 BRIDGE_DB_URL = "https://raw.githubusercontent.com/hkbus/hk-bus-crawling/refs/heads/gh-pages/routeFareList.min.json"
 
+# Concurrency: request handler threads (0 = serve one request at a time),
+# processes for the ripple computation (0 = compute in the handler thread),
+# and how many accepted connections may wait for a thread before we answer 503
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+SERVER_PROCESSES = int(os.environ.get('SERVER_PROCESSES', 0))
+SERVER_QUEUE = int(os.environ.get('SERVER_QUEUE', 32))
+
+# /api/route results kept per data version, and the caching policy sent to
+# browsers / Firebase Hosting's CDN along with the ETag
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', 256))
+ROUTE_CACHE_CONTROL = os.environ.get('ROUTE_CACHE_CONTROL', 'public, max-age=300, s-maxage=3600')
+
+# How often the route database is re-downloaded in the background (seconds, 0 = once)
+ROUTE_DB_REFRESH = int(os.environ.get('ROUTE_DB_REFRESH', 86400))
+
+# Limits for POST /api/batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_MAX_BYTES = 64 * 1024
+
 # Global Cache
 ROUTE_DB = None
+ROUTE_DB_SOURCE = None  # 'snapshot' or 'download'
+_route_db_lock = threading.Lock()
+
+# Process pool for calculate_hourly_data, created by run_server
+COMPUTE_POOL = None
+
+# Popular /api/route queries (prewarm.AccessRecorder), created by run_server
+ACCESS_RECORDER = None
+
+def download_route_db():
+    """Downloads routeFareList, compacting it while it is parsed, and saves it as the local snapshot."""
+    db = route_snapshot.fetch_compact_db(BRIDGE_DB_URL)
+    if not db:
+        return None
+    try:
+        db = route_snapshot.save_snapshot(db)
+    except OSError as e:
+        print(f"Could not save route snapshot: {e}")
+    return db
+
+def load_route_db():
+    """
+    Loads the route database from the local snapshot, or downloads it when there
+    is no snapshot yet, and builds its lookup and search indexes up front.
+    """
+    global ROUTE_DB_SOURCE
+    db = route_snapshot.load_snapshot()
+    ROUTE_DB_SOURCE = 'snapshot'
+    if not db:
+        db = download_route_db()
+        ROUTE_DB_SOURCE = 'download'
+    if db:
+        analyze_route.get_route_index(db)
+        route_search.get_search_index(db)
+    return db
+
+def refresh_route_db():
+    """Downloads a fresh route database and swaps it in once its index is built."""
+    global ROUTE_DB
+    db = download_route_db()
+    if not db:
+        return False
+    analyze_route.get_route_index(db)
+    route_search.get_search_index(db)
+    ROUTE_DB = db
+    print(f"Route database refreshed ({len(db['routeList'])} routes)")
+    return True
+
+def start_route_db_refresh(interval=ROUTE_DB_REFRESH):
+    """
+    Background refresh loop. A database loaded from the snapshot is refreshed
+    right away, a freshly downloaded one only after `interval`.
+    """
+    def loop():
+        if ROUTE_DB_SOURCE == 'download':
+            if interval <= 0:
+                return
+            time.sleep(interval)
+        while True:
+            try:
+                refresh_route_db()
+            except Exception as e:
+                print(f"Route database refresh failed: {e}")
+            if interval <= 0:
+                return
+            time.sleep(interval)
+    t = threading.Thread(target=loop, name="route-db-refresh", daemon=True)
+    t.start()
+    return t
+
+def current_data_version():
+    """Version of everything an /api/route answer depends on: travel time data and route DB."""
+    db = get_route_db()
+    return analyze_route.get_data_version() + '-' + ((db or {}).get('snapshotVersion') or '')
+
+def get_route_db():
+    """Returns ROUTE_DB, loading it once even when several threads ask at the same time."""
+    global ROUTE_DB
+    if not ROUTE_DB:
+        with _route_db_lock:
+            if not ROUTE_DB:
+                print("Initializing DB...")
+                ROUTE_DB = load_route_db()
+    return ROUTE_DB
+
+def stream_hourly_data(raw_stop_ids, start_idx=0, end_idx=None, freq_data=None):
+    """
+    Yields (day_code, day_data) as each day finishes. With a process pool the
+    seven days are computed in parallel and come out in completion order.
+    """
+    if COMPUTE_POOL is None:
+        yield from analyze_route.iter_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
+        return
+    futures = {
+        COMPUTE_POOL.submit(analyze_route.calculate_day_data, raw_stop_ids, start_idx, end_idx, freq_data, day_code): day_code
+        for day_code in analyze_route.DAYS
+    }
+    for fut in as_completed(futures):
+        yield futures[fut], fut.result()
+
+class ResultCache:
+    """Small thread-safe LRU of finished responses, bounded by entry count."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def rekey(self, move):
+        """Replaces every entry by move(key, value) -> (key, value), or drops it when that returns None."""
+        with self._lock:
+            kept = OrderedDict()
+            for key, value in self._entries.items():
+                moved = move(key, value)
+                if moved is not None:
+                    kept[moved[0]] = moved[1]
+            self._entries = kept
+
+    def __len__(self):
+        return len(self._entries)
+
+ROUTE_CACHE = ResultCache(ROUTE_CACHE_SIZE)
+
+def apply_data_generation(gen, partial):
+    """
+    Carries ROUTE_CACHE over to a new data generation (an
+    analyze_route.GENERATION_LISTENERS entry). A route with no stop in the
+    generation's changed prefixes has the same result, so its entries move to
+    the new version with the new ETag; the rest are dropped, and everything is
+    after a full invalidation.
+    """
+    db = ROUTE_DB
+    if not partial or db is None:
+        ROUTE_CACHE.rekey(lambda key, value: None)
+        return
+    prefixes = set(gen.get('changed_prefixes', []))
+    snapshot = db.get('snapshotVersion') or ''
+    old_version = f"{gen.get('previous')}-{snapshot}"
+    new_version = f"{gen['id']}-{snapshot}"
+    
+    def move(key, value):
+        args, version = key[:-1], key[-1]
+        if version != old_version:
+            return None
+        raw_stop_ids = analyze_route.find_route_stops(db, args[0], args[3], args[4])[2]
+        if not raw_stop_ids or any(sid[:2] in prefixes for sid in raw_stop_ids[:-1]):
+            return None
+        status, body, _ = value
+        return args + (new_version,), (status, body, route_etag(args, new_version))
+    
+    ROUTE_CACHE.rekey(move)
+
+analyze_route.GENERATION_LISTENERS.append(apply_data_generation)
+
+# /api/route and /api/overlap results shared between instances (shared_cache.py)
+SHARED_CACHE = shared_cache.SharedCache(shared_cache.create_backend())
+
+def precomputed_hourly_data(raw_stop_ids, start_idx=0, end_idx=None, freq_data=None):
+    """
+    Chart data for a start-to-terminus query from the precompute output
+    (precompute.py), or None when there is none for this data version.
+    """
+    if end_idx is not None and end_idx < len(raw_stop_ids) - 1:
+        return None
+    table = precompute.get_precomputed_table()
+    if table is None or table.data_version != analyze_route.get_data_version():
+        return None
+    return table.chart_data(raw_stop_ids, freq_data, max(start_idx, 0))
+
+def compute_hourly_data(raw_stop_ids, start_idx=0, end_idx=None, freq_data=None):
+    """
+    Runs the ripple calculation, in the process pool when one is configured.
+    Start-to-terminus queries are answered from the precompute output when it is current.
+    """
+    with metrics.span('precomputed'):
+        chart_data = precomputed_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
+    if chart_data is not None:
+        return chart_data
+    with metrics.span('ripple'):
+        if COMPUTE_POOL is not None:
+            return COMPUTE_POOL.submit(analyze_route.calculate_hourly_data, raw_stop_ids, start_idx, end_idx, freq_data).result()
+        return analyze_route.calculate_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
 
 class BusRouteHandler(http.server.SimpleHTTPRequestHandler):
+    def do_POST(self):
+        with metrics.track_request(endpoint_label(self.path)):
+            self.handle_post()
+
     def do_GET(self):
+        with metrics.track_request(endpoint_label(self.path)):
+            self.handle_get()
+
+    def send_response(self, code, message=None):
+        metrics.set_status(code)
+        super().send_response(code, message)
+
+    def handle_post(self):
+        parsed = urllib.parse.urlparse(self.path)
+        
+        # Batch Endpoint
+        if parsed.path == '/api/batch':
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > BATCH_MAX_BYTES:
+                self.send_error(413, "Batch request too large")
+                return
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self.send_error(400, "Invalid JSON body")
+                return
+            self.handle_batch_request(body)
+            return
+        
+        self.send_error(404, "Not found")
+
+    def handle_get(self):
         parsed = urllib.parse.urlparse(self.path)
         
         # API Endpoint
         if parsed.path == '/api/route':
             query = urllib.parse.parse_qs(parsed.query)
-            route_id = query.get('id', [None])[0]
-            start_idx = int(query.get('start', [0])[0])
-            
-            end_param = query.get('end', [None])[0]
-            end_idx = int(end_param) if end_param else None
+            try:
+                args = parse_route_query(query)
+            except ValueError:
+                args = None
             
-            var_param = query.get('variant', [0])[0]
-            variant_idx = int(var_param)
-            
-            dest_param = query.get('dest', [None])[0]
-            
-            if not route_id:
-                self.send_error(400, "Missing route id")
+            if not args:
+                self.send_error(400, "Missing route id or invalid start/end/variant")
                 return
 
-            self.handle_route_request(route_id, start_idx, end_idx, variant_idx, dest_param)
+            if query.get('stream', ['0'])[0] == '1':
+                self.handle_route_stream(*args)
+            else:
+                self.handle_route_request(*args)
             return
 
         # Search Endpoint
@@ -46,157 +306,665 @@ class BusRouteHandler(http.server.SimpleHTTPRequestHandler):
             q = query.get('q', [''])[0]
             self.handle_search_request(q)
             return
-            self.handle_search_request(q)
-            return
 
         # Overlap Endpoint
         if parsed.path == '/api/overlap':
             query = urllib.parse.parse_qs(parsed.query)
-            start_id = query.get('start', [None])[0]
-            end_id = query.get('end', [None])[0]
-            exclude = query.get('exclude', [None])[0]
+            args = parse_overlap_query(query)
             
-            if start_id and end_id:
-                self.handle_overlap_request(start_id, end_id, exclude)
+            if args:
+                self.handle_overlap_request(*args)
             else:
                  self.send_error(400, "Missing start or end stop id")
             return
             
+        # Trip Planner Endpoint
+        if parsed.path == '/api/plan':
+            query = urllib.parse.parse_qs(parsed.query)
+            try:
+                args = parse_plan_query(query)
+            except ValueError:
+                args = None
+            if args:
+                self.handle_plan_request(*args)
+            else:
+                self.send_error(400, "Missing or invalid from/to/day/hour")
+            return
+            
+        # Prometheus metrics
+        if parsed.path == '/api/metrics':
+            self.send_body(200, metrics.render().encode(), content_type=metrics.CONTENT_TYPE)
+            return
+            
         # Default to dashboard
         if self.path == '/' or self.path == '/index.html':
             self.path = '/dashboard.html'
-            
+        
+        if self.send_static():
+            return
         return super().do_GET()
 
+    def send_static(self):
+        """
+        Serves a text static file compressed (at the highest level, cached) when
+        the client accepts it. Returns False to leave the request to SimpleHTTPRequestHandler.
+        """
+        path = self.translate_path(self.path)
+        content_type = self.guess_type(path)
+        if not (os.path.isfile(path) and response_encoding.is_compressible(content_type)
+                and response_encoding.choose_encoding(self.headers.get('Accept-Encoding'))):
+            return False
+        body, key = response_encoding.read_static(path)
+        last_modified = self.date_time_string(key[2] // 10**9)
+        if self.headers.get('If-Modified-Since') == last_modified:
+            self.send_response(304)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return True
+        self.send_body(200, body, {'Last-Modified': last_modified}, content_type, cache_key=key, best=True)
+        return True
+
+    def send_json(self, status, payload):
+        with metrics.span('serialize'):
+            body = response_encoding.dumps(payload)
+        self.send_body(status, body)
+
+    def send_body(self, status, body, headers=None, content_type='application/json', cache_key=None, best=False):
+        headers = dict(headers or {})
+        with metrics.span('compress'):
+            body, encoding_headers = response_encoding.negotiate(
+                body, self.headers.get('Accept-Encoding'), content_type, cache_key, best)
+        if 'Content-Encoding' in encoding_headers and 'ETag' in headers:
+            headers['ETag'] = response_encoding.weak_etag(headers['ETag'])
+        headers.update(encoding_headers)
+        
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        with metrics.span('write'):
+            self.wfile.write(body)
+
     def handle_route_request(self, route_id, start_idx=0, end_idx=None, variant_idx=0, dest=None):
         try:
-            global ROUTE_DB
-            if not ROUTE_DB:
-                print("Initializing DB...")
-                ROUTE_DB = analyze_route.get_json(BRIDGE_DB_URL)
+            args = (route_id, start_idx, end_idx, variant_idx, dest)
+            version = current_data_version()
             
-            print(f"Analyzing Route {route_id} [Var {variant_idx}] [Stop {start_idx} -> {end_idx}] [Dest: {dest}]...")
-            enriched_stops, title, raw_stop_ids, variants, freq_data = analyze_route.find_route_stops(ROUTE_DB, route_id, variant_idx, dest)
-            
-            if not enriched_stops:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Route not found"}).encode())
+            # Revalidation: the ETag is known without computing anything
+            if etag_matches(self.headers.get('If-None-Match'), route_etag(args, version)):
+                record_access(args)
+                self.send_not_modified(route_etag(args, version))
                 return
-                
-            chart_data = analyze_route.calculate_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
-            
-            response_data = {
-                "title": title,
-                "stops": enriched_stops,
-                "variants": variants,
-                "current_variant": variant_idx,
-                "data": chart_data
-            }
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode())
             
+            status, body, etag = get_route_result(args, version)
+            if status == 200:
+                record_access(args)
+            self.send_body(status, body, route_cache_headers(etag) if etag else None, cache_key=etag)
         except Exception as e:
             print(f"Server Error: {e}")
             self.send_error(500, str(e))
 
-    def handle_search_request(self, query):
-        global ROUTE_DB
-        if not ROUTE_DB:
-            ROUTE_DB = analyze_route.get_json(BRIDGE_DB_URL)
-            
-        create_response = []
-        seen = set()
-        
-        # Search DB
-        q = query.upper()
-        count = 0 
-        
-        # We search keys or values?
-        # The structure is "HexID": { "route": "94", ... }
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        for name, value in route_cache_headers(etag).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def handle_route_stream(self, route_id, start_idx=0, end_idx=None, variant_idx=0, dest=None):
+        try:
+            args = (route_id, start_idx, end_idx, variant_idx, dest)
+            version = current_data_version()
+            if etag_matches(self.headers.get('If-None-Match'), route_etag(args, version)):
+                record_access(args)
+                self.send_not_modified(route_etag(args, version))
+                return
+            status, result, etag = get_route_stream(args, version)
+        except Exception as e:
+            print(f"Server Error: {e}")
+            self.send_error(500, str(e))
+            return
+        if status != 200:
+            self.send_body(status, result)
+            return
+        headers = route_cache_headers(etag)
+        if isinstance(result, bytes):
+            # The NDJSON differs from the /api/route body with the same ETag
+            self.send_body(200, result, headers, 'application/x-ndjson', cache_key=('stream', etag))
+            return
         
-        for val in ROUTE_DB['routeList'].values():
-            r = val.get('route', '')
-            company_list = val.get('co', [])
-            if r.startswith(q) and ('kmb' in company_list or 'ctb' in company_list):
-                unique_key = r + "-" + val.get('dest', {}).get('en', '')
-                if unique_key not in seen:
-                    create_response.append({
-                        "route": r,
-                        "dest": val.get('dest', {}).get('en', 'Unknown')
-                    })
-                    seen.add(unique_key)
-                    count += 1
-                    
-            if count >= 10: # Limit results
-                break
-                
-        # Sort by route length then alpha
-        create_response.sort(key=lambda x: (len(x['route']), x['route']))
+        result, encoding_headers = response_encoding.negotiate_stream(
+            result, self.headers.get('Accept-Encoding'), 'application/x-ndjson')
+        if 'Content-Encoding' in encoding_headers:
+            headers['ETag'] = response_encoding.weak_etag(headers['ETag'])
+        headers.update(encoding_headers)
         
+        # No Content-Length: the body ends when the connection closes (HTTP/1.0)
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', 'application/x-ndjson')
+        for name, value in headers.items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(create_response).encode())
+        for chunk in result:
+            with metrics.span('write'):
+                self.wfile.write(chunk)
+                self.wfile.flush()
 
-    def handle_overlap_request(self, start_id, end_id, exclude_route=None):
-        global ROUTE_DB
-        if not ROUTE_DB:
-            ROUTE_DB = analyze_route.get_json(BRIDGE_DB_URL)
-            
+    def handle_search_request(self, query):
+        status, payload = build_search_response(query)
+        self.send_json(status, payload)
+
+    def handle_overlap_request(self, start_id, end_id, exclude_route=None, detail=False):
         try:
-             matches = analyze_route.find_overlapping_routes(ROUTE_DB, start_id, end_id, exclude_route)
-             
-             self.send_response(200)
-             self.send_header('Content-type', 'application/json')
-             self.end_headers()
-             self.wfile.write(json.dumps(matches).encode())
+            status, body = get_overlap_result((start_id, end_id, exclude_route, detail))
+            self.send_body(status, body)
         except Exception as e:
             print(f"Overlap search error: {e}")
             self.send_error(500, str(e))
 
+    def handle_plan_request(self, *args):
+        try:
+            status, payload = build_plan_response(*args)
+            self.send_json(status, payload)
+        except Exception as e:
+            print(f"Plan Error: {e}")
+            self.send_error(500, str(e))
+
+    def handle_batch_request(self, body):
+        try:
+            status, payload = build_batch_response(body)
+            self.send_json(status, payload)
+        except Exception as e:
+            print(f"Batch Error: {e}")
+            self.send_error(500, str(e))
+
+# Request parsing and response building, shared by BusRouteHandler and async_server.py.
+# Builders return (status, payload) with a JSON-serializable payload.
+
+def parse_route_query(query):
+    """
+    (route_id, start, end, variant, dest) from /api/route query params, or None
+    without an id. Raises ValueError for malformed numbers.
+    """
+    route_id = query.get('id', [None])[0]
+    start_idx = int(query.get('start', [0])[0])
+    
+    end_param = query.get('end', [None])[0]
+    end_idx = int(end_param) if end_param else None
+    
+    var_param = query.get('variant', [0])[0]
+    variant_idx = int(var_param)
+    
+    dest_param = query.get('dest', [None])[0]
+    
+    if not route_id:
+        return None
+    return route_id, start_idx, end_idx, variant_idx, dest_param
+
+def parse_overlap_query(query):
+    """(start, end, exclude, detail) from /api/overlap query params, or None if a stop is missing."""
+    start_id = query.get('start', [None])[0]
+    end_id = query.get('end', [None])[0]
+    exclude = query.get('exclude', [None])[0]
+    detail = query.get('detail', ['0'])[0] == '1'
+    
+    if not (start_id and end_id):
+        return None
+    return start_id, end_id, exclude, detail
+
+def parse_plan_query(query):
+    """
+    (from, to, day, hour, minute, transfers, walk) from /api/plan query params,
+    or None without both stops. Day and time default to now in Hong Kong.
+    Raises ValueError for malformed numbers.
+    """
+    from_id = query.get('from', [None])[0]
+    to_id = query.get('to', [None])[0]
+    if not (from_id and to_id):
+        return None
+    now = time.gmtime(time.time() + 8 * 3600)
+    day = int(query.get('day', [(now.tm_wday + 1) % 7])[0])  # 0 = Sunday, as in DAYS
+    hour = int(query.get('hour', [now.tm_hour])[0])
+    minute = int(query.get('minute', [0 if 'hour' in query else now.tm_min])[0])
+    transfers = int(query.get('transfers', [2])[0])
+    walk = query.get('walk', ['1'])[0] != '0'
+    if not (0 <= day <= 6 and 0 <= hour <= 23 and 0 <= minute <= 59):
+        return None
+    return from_id, to_id, day, hour, minute, transfers, walk
+
+def build_plan_response(from_id, to_id, day, hour, minute=0, transfers=2, walk=True):
+    db = get_route_db()
+    with metrics.span('plan'):
+        return trip_planner.plan_trip(db, from_id, to_id, day, hour, minute, transfers, walk)
+
+def build_route_response(route_id, start_idx=0, end_idx=None, variant_idx=0, dest=None):
+    db = get_route_db()
+    
+    analyze_route.log(f"Analyzing Route {route_id} [Var {variant_idx}] [Stop {start_idx} -> {end_idx}] [Dest: {dest}]...")
+    with metrics.span('db_lookup'):
+        enriched_stops, title, raw_stop_ids, variants, freq_data = analyze_route.find_route_stops(db, route_id, variant_idx, dest)
+    
+    if not enriched_stops:
+        return 404, {"error": "Route not found"}
+        
+    chart_data = compute_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
+    
+    return 200, {
+        "title": title,
+        "stops": enriched_stops,
+        "variants": variants,
+        "current_variant": variant_idx,
+        "data": chart_data
+    }
+
+def build_route_stream(route_id, start_idx=0, end_idx=None, variant_idx=0, dest=None, on_complete=None):
+    """
+    Streaming variant of build_route_response. Returns (404, error payload) or
+    (200, generator of NDJSON lines): a "meta" line with everything but the
+    chart data, then one "day" line per day as soon as it is computed (all at
+    once from the precompute output), then "end". When every day is done,
+    on_complete gets the same payload build_route_response would have built.
+    """
+    db = get_route_db()
+    
+    analyze_route.log(f"Streaming Route {route_id} [Var {variant_idx}] [Stop {start_idx} -> {end_idx}] [Dest: {dest}]...")
+    with metrics.span('db_lookup'):
+        enriched_stops, title, raw_stop_ids, variants, freq_data = analyze_route.find_route_stops(db, route_id, variant_idx, dest)
+    
+    if not enriched_stops:
+        return 404, {"error": "Route not found"}
+    
+    payload = {
+        "title": title,
+        "stops": enriched_stops,
+        "variants": variants,
+        "current_variant": variant_idx
+    }
+    
+    def lines():
+        yield route_stream_line(dict({"type": "meta"}, **payload))
+        with metrics.span('precomputed'):
+            chart_data = precomputed_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
+        days = chart_data.items() if chart_data is not None else stream_hourly_data(raw_stop_ids, start_idx, end_idx, freq_data)
+        done = {}
+        try:
+            for day_code, day_data in days:
+                done[day_code] = day_data
+                yield route_stream_line({"type": "day", "day": day_code, "data": day_data})
+        except Exception as e:
+            print(f"Stream Error: {e}")
+            yield route_stream_line({"type": "error", "error": str(e)})
+            return
+        yield route_stream_line({"type": "end"})
+        if on_complete is not None:
+            # Days can finish out of order (process pool); the result is in DAYS order
+            on_complete(dict(payload, data={day_code: done[day_code] for day_code in analyze_route.DAYS}))
+    
+    return 200, lines()
+
+def route_stream_line(obj):
+    return response_encoding.dumps(obj) + b"\n"
+
+def route_stream_lines(payload):
+    """The NDJSON lines of build_route_stream for a finished build_route_response payload."""
+    yield route_stream_line(dict({"type": "meta"}, **{k: v for k, v in payload.items() if k != "data"}))
+    for day_code, day_data in payload["data"].items():
+        yield route_stream_line({"type": "day", "day": day_code, "data": day_data})
+    yield route_stream_line({"type": "end"})
+
+def route_etag(args, version):
+    """ETag for an /api/route result: depends only on the query and the data version."""
+    return '"' + hashlib.sha1(repr((args, version)).encode()).hexdigest()[:20] + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+def route_cache_headers(etag):
+    return {'ETag': etag, 'Cache-Control': ROUTE_CACHE_CONTROL}
+
+def get_cached_route_result(args, version):
+    """(status, body bytes, etag) for /api/route args from ROUTE_CACHE or the shared cache, without computing; else None."""
+    key = args + (version,)
+    cached = ROUTE_CACHE.get(key)
+    if cached is not None:
+        metrics.count('route_cache_hits')
+        return cached
+    stored = SHARED_CACHE.get(SHARED_CACHE.make_key('route', version, args))
+    if stored is None:
+        return None
+    result = stored + (route_etag(args, version),)
+    ROUTE_CACHE.put(key, result)
+    return result
+
+def get_route_result(args, version=None):
+    """
+    (status, body bytes, etag) for /api/route args, served from ROUTE_CACHE when
+    the same query was answered for the current data version, else from the
+    shared cache (computed there by one caller). etag is None for errors.
+    """
+    if version is None:
+        version = current_data_version()
+    key = args + (version,)
+    cached = ROUTE_CACHE.get(key)
+    if cached is not None:
+        metrics.count('route_cache_hits')
+        return cached
+    
+    def compute():
+        status, payload = build_route_response(*args)
+        with metrics.span('serialize'):
+            return status, response_encoding.dumps(payload)
+    
+    status, body = SHARED_CACHE.get_or_compute(SHARED_CACHE.make_key('route', version, args), compute)
+    if status != 200:
+        return status, body, None
+    
+    result = (status, body, route_etag(args, version))
+    ROUTE_CACHE.put(key, result)
+    return result
+
+def get_route_stream(args, version=None):
+    """
+    (status, body, etag) for /api/route?stream=1 args. A result already in
+    ROUTE_CACHE or the shared cache is sent whole: body is the NDJSON bytes.
+    Otherwise body is the generator of build_route_stream, and the finished
+    result goes into both caches like get_route_result's, so the next request
+    (streamed or not) is served from them. The query is recorded (record_access)
+    once it has been answered. etag is None for errors.
+    """
+    if version is None:
+        version = current_data_version()
+    etag = route_etag(args, version)
+    cached = get_cached_route_result(args, version)
+    if cached is not None and cached[0] == 200:
+        record_access(args)
+        with metrics.span('serialize'):
+            return 200, b''.join(route_stream_lines(json.loads(cached[1]))), etag
+    
+    def store(payload):
+        body = response_encoding.dumps(payload)
+        ROUTE_CACHE.put(args + (version,), (200, body, etag))
+        SHARED_CACHE.put(SHARED_CACHE.make_key('route', version, args), 200, body)
+        record_access(args)
+    
+    status, result = build_route_stream(*args, on_complete=store)
+    if status != 200:
+        return status, response_encoding.dumps(result), None
+    return 200, result, etag
+
+def get_overlap_result(args, version=None):
+    """(status, body bytes) for /api/overlap args, through the shared cache."""
+    if version is None:
+        version = current_data_version()
+    
+    def compute():
+        status, payload = build_overlap_response(*args)
+        return status, response_encoding.dumps(payload)
+    
+    return SHARED_CACHE.get_or_compute(SHARED_CACHE.make_key('overlap', version, args), compute)
+
+def build_search_response(query):
+    db = get_route_db()
+    
+    # Route numbers, then destinations and stop names (English or Chinese)
+    return 200, route_search.search(db, query, limit=10)
+
+def build_overlap_response(start_id, end_id, exclude_route=None, detail=False):
+    db = get_route_db()
+    
+    if detail:
+        # One entry per route: the first variant serving the segment,
+        # with its stop indices so the client can query /api/route directly
+        matches = []
+        seen = set()
+        for m in analyze_route.find_overlapping_variants(db, start_id, end_id, exclude_route):
+            if m['route'] not in seen:
+                seen.add(m['route'])
+                matches.append(m)
+    else:
+        matches = analyze_route.find_overlapping_routes(db, start_id, end_id, exclude_route)
+    return 200, matches
+
+def resolve_batch_item(db, item):
+    """
+    Resolves one batch item {"route", "start", "end"[, "variant" | "dest"]},
+    where start/end are stop IDs, to (variant index, candidate, start index,
+    end index). Without a variant or dest, the first variant serving start
+    before end is used. Returns an error string if nothing matches.
+    """
+    route_id = item.get('route')
+    start_id = item.get('start')
+    end_id = item.get('end')
+    if not (route_id and start_id and end_id):
+        return "Missing route, start or end"
+    
+    index = analyze_route.get_route_index(db)
+    candidates = index.variants.get(str(route_id))
+    if not candidates:
+        return "Route not found"
+    
+    if item.get('variant') is not None:
+        order = [int(item['variant'])]
+    elif item.get('dest'):
+        clean_target = str(item['dest']).strip().lower()
+        order = [idx for idx, c in enumerate(candidates) if c[2].strip().lower() == clean_target]
+    else:
+        order = range(len(candidates))
+    
+    for variant_idx in order:
+        if not 0 <= variant_idx < len(candidates):
+            continue
+        stops = index.stops[candidates[variant_idx][0]]
+        if start_id in stops and end_id in stops:
+            start_idx = stops.index(start_id)
+            end_idx = stops.index(end_id)
+            if start_idx < end_idx:
+                return variant_idx, candidates[variant_idx], start_idx, end_idx
+    return "Segment not served by this route"
+
+def build_batch_response(body):
+    """
+    Chart series for many (route, variant/dest, start stop, end stop) items in
+    one response, in request order. Identical items are computed once, and all
+    items share the process-wide segment caches.
+    """
+    items = body.get('items') if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return 400, {"error": "Expected {\"items\": [...]}"}
+    if len(items) > BATCH_MAX_ITEMS:
+        return 400, {"error": f"At most {BATCH_MAX_ITEMS} items per batch"}
+    
+    db = get_route_db()
+    index = analyze_route.get_route_index(db)
+    computed = {}
+    results = []
+    
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"error": "Invalid item"})
+            continue
+        try:
+            resolved = resolve_batch_item(db, item)
+        except (TypeError, ValueError):
+            resolved = "Invalid item"
+        if isinstance(resolved, str):
+            results.append({"route": item.get('route'), "error": resolved})
+            continue
+        
+        variant_idx, (key, val, dest), start_idx, end_idx = resolved
+        if (key, start_idx, end_idx) not in computed:
+            computed[(key, start_idx, end_idx)] = compute_hourly_data(index.stops[key], start_idx, end_idx, val.get('freq'))
+        results.append({
+            "route": index.routes[key],
+            "variant": variant_idx,
+            "dest": dest,
+            "title": f"{index.routes[key]} to {dest}",
+            "start": start_idx,
+            "end": end_idx,
+            "data": computed[(key, start_idx, end_idx)]
+        })
+    
+    return 200, {"results": results}
+
+API_ENDPOINTS = ('/api/route', '/api/search', '/api/overlap', '/api/plan', '/api/batch', '/api/metrics')
+
+def endpoint_label(path):
+    """Metrics label for a request path; everything that is not an API endpoint counts as 'static'."""
+    path = urllib.parse.urlparse(path).path
+    return path if path in API_ENDPOINTS else 'static'
+
+def collect_cache_metrics():
+    """Cache counters and sizes for /api/metrics."""
+    shard = analyze_route.SHARD_CACHE.stats()
+    samples = [
+        ("shard_cache_hits_total", "counter", shard["hits"], {}),
+        ("shard_cache_misses_total", "counter", shard["misses"], {}),
+        ("shard_cache_evictions_total", "counter", shard["evictions"], {}),
+        ("shard_cache_entries", "gauge", shard["entries"], {}),
+        ("shard_cache_bytes", "gauge", shard["bytes"], {}),
+        ("route_cache_hits_total", "counter", ROUTE_CACHE.hits, {}),
+        ("route_cache_misses_total", "counter", ROUTE_CACHE.misses, {}),
+        ("route_cache_entries", "gauge", len(ROUTE_CACHE), {}),
+        ("compressed_cache_hits_total", "counter", response_encoding.CACHE.hits, {}),
+        ("compressed_cache_misses_total", "counter", response_encoding.CACHE.misses, {}),
+        ("compressed_cache_bytes", "gauge", response_encoding.CACHE.bytes, {}),
+        ("shared_cache_hits_total", "counter", SHARED_CACHE.stats["hits"], {"backend": SHARED_CACHE.name}),
+        ("shared_cache_misses_total", "counter", SHARED_CACHE.stats["misses"], {"backend": SHARED_CACHE.name}),
+        ("shared_cache_waits_total", "counter", SHARED_CACHE.stats["waits"], {"backend": SHARED_CACHE.name}),
+        ("shared_cache_errors_total", "counter", SHARED_CACHE.stats["errors"], {"backend": SHARED_CACHE.name}),
+        ("route_profiles", "gauge", len(analyze_route._route_profiles), {}),
+        ("route_profile_bytes", "gauge", sum(p.nbytes for p in list(analyze_route._route_profiles.values())), {}),
+        ("compute_processes", "gauge", SERVER_PROCESSES if COMPUTE_POOL is not None else 0, {}),
+    ]
+    return samples
+
+metrics.REGISTRY.register_collector(collect_cache_metrics)
+
+class PooledTCPServer(socketserver.TCPServer):
+    """
+    TCPServer that hands each connection to a fixed pool of handler threads.
+    At most `threads + queue_size` connections are in flight; anything beyond
+    that is answered with 503 straight away instead of waiting in the backlog.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, threads=SERVER_THREADS, queue_size=SERVER_QUEUE):
+        # The default listen backlog (5) drops SYNs under bursts, costing the
+        # client a 1s retransmit before we even get to shed load
+        self.request_queue_size = threads + queue_size
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.reject_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def reject_request(self, request):
+        body = json.dumps({"error": "Server busy"}).encode()
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Content-Type: application/json\r\n"
+                            b"Retry-After: 1\r\n"
+                            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+def record_access(args):
+    """Counts an answered /api/route query, if it names a route in the route DB."""
+    if ACCESS_RECORDER is not None and route_exists(args):
+        ACCESS_RECORDER.record(args)
+
+def route_exists(args):
+    # A 304 is answered from the ETag alone, so the route has not been looked up
+    variants = analyze_route.get_route_index(get_route_db()).variants.get(args[0])
+    return bool(variants) and (args[4] is not None or 0 <= args[3] < len(variants))
+
+def start_access_recorder():
+    """
+    Starts recording /api/route queries and prewarms the caches with the ones
+    recorded before (by this or an earlier instance) in the background.
+    """
+    global ACCESS_RECORDER
+    ACCESS_RECORDER = prewarm.AccessRecorder().start()
+    atexit.register(ACCESS_RECORDER.flush)
+    prewarm.start_prewarm(get_route_result, ACCESS_RECORDER)
+    return ACCESS_RECORDER
+
+def _worker_pid(_):
+    return os.getpid()
+
+def start_compute_pool(processes=SERVER_PROCESSES):
+    """
+    Starts the ripple process pool. Called after ROUTE_DB is loaded and before
+    any handler thread exists, so the workers are forked once with a
+    copy-on-write view of the loaded data.
+    """
+    global COMPUTE_POOL
+    if processes <= 0:
+        return None
+    COMPUTE_POOL = ProcessPoolExecutor(max_workers=processes)
+    # Force every worker to start now rather than from a busy handler thread
+    list(COMPUTE_POOL.map(_worker_pid, range(processes)))
+    print(f"Started {processes} compute processes.")
+    return COMPUTE_POOL
+
 def run_server():
     print(f"Starting Bus Analyzer Server on port {PORT}...")
     print(f"Open http://localhost:{PORT} in your browser.")
     
     # Pre-load DB
     global ROUTE_DB
-    ROUTE_DB = analyze_route.get_json(BRIDGE_DB_URL)
+    ROUTE_DB = load_route_db()
     
-    # Auto-Sync Logic
-    try:
-        pages_dir = "hk-bus-time-between-stops-pages"
-        fetch_head = os.path.join(pages_dir, ".git", "FETCH_HEAD")
-        
-        should_sync = False
-        if not os.path.exists(fetch_head):
-            should_sync = True
-            print("Status: No previous sync record found.")
-        else:
-            last_mtime = os.path.getmtime(fetch_head)
-            if time.time() - last_mtime > 86400: # 24 hours
-                should_sync = True
-                print("Status: Data is older than 24 hours.")
-            else:
-                print("Status: Data is up to date (synced within 24h).")
-                
-        if should_sync:
-            print("Auto-syncing data from GitHub...")
-            subprocess.run(["bash", "sync_data.sh"], check=True)
-    except Exception as e:
-        print(f"Auto-sync failed: {e}")
+    start_compute_pool()
+    # Started after the pool so workers are not forked while they run.
+    # The data sync publishes new generations in the background instead of
+    # blocking startup; workers pick them up through analyze_route.
+    start_route_db_refresh()
+    data_sync.start_background_sync()
     
     class ReusableTCPServer(socketserver.TCPServer):
         allow_reuse_address = True
 
-    with ReusableTCPServer(("", PORT), BusRouteHandler) as httpd:
+    if SERVER_THREADS > 0:
+        print(f"Serving with {SERVER_THREADS} threads (queue {SERVER_QUEUE}).")
+        httpd = PooledTCPServer(("", PORT), BusRouteHandler)
+    else:
+        httpd = ReusableTCPServer(("", PORT), BusRouteHandler)
+    
+    # The socket is listening now: requests are queued while the popular
+    # routes are warmed up in the background
+    start_access_recorder()
+
+    with httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nServer stopped.")
+        finally:
+            if COMPUTE_POOL is not None:
+                COMPUTE_POOL.shutdown(wait=False)
 
 if __name__ == "__main__":
     run_server()
@@ -0,0 +1,356 @@
+import asyncio
+import hashlib
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from collections import OrderedDict
+
+# Result cache shared between server instances.
+#
+# /api/route and /api/overlap results are stored under a key made of the
+# data version and the query, so every instance behind the load balancer can
+# reuse what another one computed. Two backends:
+#
+#   MemoryBackend : in-process LRU (the default, shared by the handler threads)
+#   RedisBackend  : any server speaking the Redis protocol (SHARED_CACHE_URL=redis://host:6379/0)
+#
+# A cold key is computed by one caller only: it takes a short-lived lock key
+# (SET NX) and the others poll for the result instead of computing it too.
+# If the backend is unreachable the cache steps aside for a while and results
+# are computed locally.
+#
+# A minimal Redis stand-in for local testing:
+#     python shared_cache.py serve [port]
+
+SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL', '')
+# Lifetime of a result (seconds); keys carry the data version anyway
+SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL', 86400))
+# Entries kept by the in-process backend
+SHARED_CACHE_ENTRIES = int(os.environ.get('SHARED_CACHE_ENTRIES', 1024))
+# How long a computation may hold its lock, and how long others wait for it (seconds)
+SHARED_CACHE_LOCK_TTL = float(os.environ.get('SHARED_CACHE_LOCK_TTL', 30))
+SHARED_CACHE_WAIT = float(os.environ.get('SHARED_CACHE_WAIT', 20))
+# Socket timeout for the Redis backend, and how long to skip it after an error (seconds)
+SHARED_CACHE_TIMEOUT = float(os.environ.get('SHARED_CACHE_TIMEOUT', 0.5))
+SHARED_CACHE_RETRY = float(os.environ.get('SHARED_CACHE_RETRY', 30))
+
+KEY_PREFIX = 'hkbus:'
+POLL_INTERVAL = 0.05
+# Stored value: status (uint16) + zlib-compressed body
+VALUE_HEADER = struct.Struct('>H')
+
+
+class CacheError(Exception):
+    pass
+
+
+class MemoryBackend:
+    """In-process LRU with per-key expiry, bounded by entry count."""
+    def __init__(self, max_entries=SHARED_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, nx=False):
+        """Stores value (for ttl seconds); with nx only if the key is absent. Returns whether it was set."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if nx and entry is not None and (entry[1] is None or entry[1] > time.time()):
+                return False
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Minimal Redis protocol (RESP) client, one connection per thread."""
+    def __init__(self, url, timeout=SHARED_CACHE_TIMEOUT):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        if self.password:
+            self._call(b'AUTH', self.password)
+        if self.db:
+            self._call(b'SELECT', self.db)
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def _call(self, *args):
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._local.sock.sendall(b''.join(out))
+        return read_reply(self._local.reader)
+
+    def command(self, *args):
+        try:
+            if getattr(self._local, 'sock', None) is None:
+                self._connect()
+            return self._call(*args)
+        except (OSError, ValueError) as e:
+            self._close()
+            raise CacheError(f"{self.host}:{self.port}: {e}") from e
+
+    def get(self, key):
+        return self.command(b'GET', key)
+
+    def set(self, key, value, ttl=None, nx=False):
+        args = [b'SET', key, value]
+        if ttl:
+            args += [b'PX', int(ttl * 1000)]
+        if nx:
+            args.append(b'NX')
+        return self.command(*args) is not None
+
+    def delete(self, key):
+        return self.command(b'DEL', key) == 1
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ValueError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise CacheError(rest.decode(errors='replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ValueError("Connection closed")
+        return data[:-2]
+    if kind == b'*':
+        count = int(rest)
+        return None if count < 0 else [read_reply(reader) for _ in range(count)]
+    raise ValueError(f"Bad reply {line[:20]!r}")
+
+
+def pack(status, body):
+    return VALUE_HEADER.pack(status) + zlib.compress(body, 1)
+
+
+def unpack(value):
+    return VALUE_HEADER.unpack_from(value)[0], zlib.decompress(value[VALUE_HEADER.size:])
+
+
+class SharedCache:
+    """get_or_compute() over a backend, with single-flight locking and fallback when the backend is down."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = type(backend).__name__
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "errors": 0}
+        self._down_until = 0
+
+    @staticmethod
+    def make_key(kind, version, args):
+        digest = hashlib.sha1(repr(args).encode()).hexdigest()[:24]
+        return f"{KEY_PREFIX}{version}:{kind}:{digest}"
+
+    def _backend_call(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except CacheError as e:
+            self.stats["errors"] += 1
+            if time.time() >= self._down_until:
+                print(f"Shared cache unavailable, computing locally for {SHARED_CACHE_RETRY:.0f}s: {e}")
+            self._down_until = time.time() + SHARED_CACHE_RETRY
+            raise
+
+    def get(self, key):
+        """Stored (status, body) for key, or None (also while the backend is down)."""
+        if time.time() < self._down_until:
+            return None
+        try:
+            value = self._backend_call(self.backend.get, key)
+        except CacheError:
+            return None
+        if value is None:
+            return None
+        self.stats["hits"] += 1
+        return unpack(value)
+
+    def put(self, key, status, body, ttl=SHARED_CACHE_TTL):
+        """Stores a result computed outside get_or_compute (only 200 results, like it)."""
+        if status != 200 or time.time() < self._down_until:
+            return
+        try:
+            self._backend_call(self.backend.set, key, pack(status, body), ttl)
+        except CacheError:
+            pass
+
+    def get_or_compute(self, key, compute, ttl=SHARED_CACHE_TTL):
+        """
+        (status, body) for key: stored, or from compute() (which returns
+        (status, body bytes)). Only 200 results are stored.
+        """
+        if time.time() < self._down_until:
+            return compute()
+        try:
+            return self._get_or_compute(key, compute, ttl)
+        except CacheError:
+            return compute()
+
+    def _get_or_compute(self, key, compute, ttl):
+        lock_key = key + ':lock'
+        deadline = time.time() + SHARED_CACHE_WAIT
+        waited = False
+        while True:
+            value = self._backend_call(self.backend.get, key)
+            if value is not None:
+                self.stats["hits"] += 1
+                return unpack(value)
+            token = uuid.uuid4().hex.encode()
+            if self._backend_call(self.backend.set, lock_key, token, SHARED_CACHE_LOCK_TTL, nx=True):
+                break
+            # Someone else is computing this key: wait for their result
+            if not waited:
+                waited = True
+                self.stats["waits"] += 1
+            if time.time() >= deadline:
+                return compute()
+            time.sleep(POLL_INTERVAL)
+
+        self.stats["misses"] += 1
+        try:
+            status, body = compute()
+            if status == 200:
+                try:
+                    self._backend_call(self.backend.set, key, pack(status, body), ttl)
+                except CacheError:
+                    pass
+            return status, body
+        finally:
+            try:
+                # Not atomic, but a lock that expired and was taken over is
+                # rare and costs only a duplicate computation
+                if self.backend.get(lock_key) == token:
+                    self.backend.delete(lock_key)
+            except CacheError:
+                pass
+
+
+def create_backend(url=SHARED_CACHE_URL):
+    if not url:
+        return MemoryBackend()
+    if url.startswith(('redis://', 'resp://')):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported SHARED_CACHE_URL {url!r}")
+
+
+# Local stand-in server (GET, SET [EX|PX] [NX], DEL, PING, AUTH, SELECT, FLUSHALL)
+
+async def _handle_resp_client(reader, writer, store):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.startswith(b'*'):
+                args = line.split()
+            else:
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+            if not args:
+                continue
+            cmd = args[0].upper()
+            if cmd == b'GET':
+                value = store.get(args[1])
+                reply = b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+            elif cmd == b'SET':
+                ttl, nx = None, False
+                i = 3
+                while i < len(args):
+                    opt = args[i].upper()
+                    if opt in (b'EX', b'PX'):
+                        ttl = int(args[i + 1]) / (1 if opt == b'EX' else 1000)
+                        i += 1
+                    elif opt == b'NX':
+                        nx = True
+                    i += 1
+                reply = b'+OK\r\n' if store.set(args[1], args[2], ttl, nx) else b'$-1\r\n'
+            elif cmd == b'DEL':
+                reply = b':%d\r\n' % sum(store.delete(k) for k in args[1:])
+            elif cmd == b'PING':
+                reply = b'+PONG\r\n'
+            elif cmd in (b'AUTH', b'SELECT'):
+                reply = b'+OK\r\n'
+            elif cmd == b'FLUSHALL':
+                store._entries.clear()
+                reply = b'+OK\r\n'
+            else:
+                reply = b'-ERR unknown command\r\n'
+            writer.write(reply)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_resp(port=6379, max_entries=100000):
+    store = MemoryBackend(max_entries)
+    srv = await asyncio.start_server(lambda r, w: _handle_resp_client(r, w, store), '127.0.0.1', port)
+    print(f"Shared cache stand-in listening on 127.0.0.1:{port}")
+    async with srv:
+        await srv.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        asyncio.run(serve_resp(int(sys.argv[2]) if len(sys.argv) > 2 else 6379))
+    else:
+        print("Usage: python shared_cache.py serve [port]")
@@ -0,0 +1,436 @@
+import array
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import analyze_route
+import segment_store
+
+# Origin-destination trip planner (/api/plan).
+#
+# TripGraph compiles the route database and the hourly segment times into
+# flat arrays once per database and data version:
+#
+#   patterns : distinct stop sequences (+ timetable) of the KMB/CTB variants,
+#              as stop indexes and segment ids
+#   weights  : segments x 7 days x 24 hours float32 seconds, with the same
+#              gap filling and 1.1x factor as the ripple; slots with no data
+#              use the segment's mean, or a distance estimate
+#   waits    : per pattern and day, half the timetable headway
+#   walks    : stops within WALK_RADIUS_M of each other (CSR adjacency)
+#
+# plan() runs a RAPTOR-style search: round k finds the earliest arrival with
+# k rides. Each round scans the patterns serving stops improved in the
+# previous round, riding with time-dependent segment weights, then relaxes one
+# walking leg. Every round that improves the destination yields a journey, so
+# the answer is the set of fastest trips for each number of transfers.
+
+# Walking between nearby stops
+WALK_RADIUS_M = int(os.environ.get('PLAN_WALK_RADIUS', 300))
+WALK_SPEED_MPS = 1.2
+WALK_DETOUR = 1.3  # street distance vs straight line
+MAX_TRANSFERS = 3
+# Used when a segment has no travel time data at all
+BUS_SPEED_MPS = 5.0
+DEFAULT_SEGMENT_SECONDS = 90
+# Expected wait when the timetable gives no headway
+DEFAULT_WAIT_SECONDS = 300
+MAX_WAIT_SECONDS = 1800
+TRAFFIC_FACTOR = 1.1
+
+SLOTS = 7 * 24
+INF = float('inf')
+
+
+def distance_m(a, b):
+    """Equirectangular distance in meters between two (lat, lng) pairs (fine at city scale)."""
+    lat = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(lat)
+    dy = math.radians(b[0] - a[0])
+    return 6371000 * math.hypot(dx, dy)
+
+
+def timetable_waits(freq_data):
+    """Expected wait (seconds) for each day code: half the shortest headway of that day's timetables."""
+    if not freq_data:
+        return [DEFAULT_WAIT_SECONDS] * 7
+    day_masks = [64, 1, 2, 4, 8, 16, 32]  # same day mapping as get_valid_hours_for_day
+    waits = []
+    for mask in day_masks:
+        headways = []
+        for mask_str, timings in freq_data.items():
+            try:
+                if not int(mask_str) & mask:
+                    continue
+                for vals in (timings or {}).values():
+                    if vals and len(vals) > 1 and vals[1]:
+                        headways.append(int(vals[1]))
+            except (TypeError, ValueError):
+                continue
+        waits.append(min(MAX_WAIT_SECONDS, min(headways) / 2) if headways else DEFAULT_WAIT_SECONDS)
+    return waits
+
+
+class TripGraph:
+    def __init__(self, db):
+        started = time.time()
+        index = analyze_route.get_route_index(db)
+        stop_list = db.get('stopList', {})
+
+        # Stops used by any variant
+        self.stop_ids = sorted(index.postings)
+        self.stop_index = {sid: i for i, sid in enumerate(self.stop_ids)}
+        self.names = [stop_list.get(sid, {}).get('name', {}).get('en', sid) for sid in self.stop_ids]
+        locations = []
+        for sid in self.stop_ids:
+            loc = stop_list.get(sid, {}).get('location') or {}
+            locations.append((loc['lat'], loc['lng']) if 'lat' in loc and 'lng' in loc else None)
+
+        # Patterns: variants sharing stops and timetable are searched once
+        segment_ids = {}
+        self.pattern_stops = []
+        self.pattern_segs = []
+        self.pattern_windows = []
+        self.pattern_waits = []
+        self.pattern_variants = []
+        patterns = {}
+        for key, stops in sorted(index.stops.items()):
+            if len(stops) < 2:
+                continue
+            val = db['routeList'][key]
+            windows = index.windows[key]
+            pkey = (tuple(stops), id(windows))
+            p = patterns.get(pkey)
+            if p is None:
+                p = patterns[pkey] = len(self.pattern_stops)
+                self.pattern_stops.append(array.array('I', (self.stop_index[s] for s in stops)))
+                segs = array.array('I')
+                for a, b in zip(stops, stops[1:]):
+                    seg = segment_ids.get((a, b))
+                    if seg is None:
+                        seg = segment_ids[(a, b)] = len(segment_ids)
+                    segs.append(seg)
+                self.pattern_segs.append(segs)
+                self.pattern_windows.append(windows)
+                self.pattern_waits.append(array.array('f', timetable_waits(val.get('freq'))))
+                self.pattern_variants.append([])
+            self.pattern_variants[p].append(key)
+
+        # Stop -> (pattern, position) in CSR form
+        served = [[] for _ in self.stop_ids]
+        for p, stops in enumerate(self.pattern_stops):
+            for pos in range(len(stops) - 1):
+                served[stops[pos]].append((p, pos))
+        self.served_start = array.array('I', [0])
+        self.served_pattern = array.array('I')
+        self.served_pos = array.array('I')
+        for entries in served:
+            for p, pos in entries:
+                self.served_pattern.append(p)
+                self.served_pos.append(pos)
+            self.served_start.append(len(self.served_pattern))
+
+        self.weights = self._build_weights(segment_ids, locations)
+        self._build_walks(locations)
+        self.index = index
+        print(f"Trip graph built: {len(self.stop_ids)} stops, {len(self.pattern_stops)} patterns, "
+              f"{len(segment_ids)} segments, {len(self.walk_to)} walking links ({time.time() - started:.1f}s)")
+
+    def _segment_slots(self, pairs):
+        """
+        Hourly seconds (168 per segment, 0.0 = none), filled down the fallback
+        tiers of segment_store.fill_slot: the store's matrix, or the cached
+        times_hourly shards filled the same way.
+        """
+        store = segment_store.get_store()
+        if store is not None:
+            raw = array.array('f')
+            view = store.matrix()
+            empty = bytes(4 * SLOTS)
+            for a, b in pairs:
+                row = store.segments.get((a, b))
+                if row is None:
+                    raw.frombytes(empty)
+                elif view is not None:
+                    raw.frombytes(view[row * SLOTS:(row + 1) * SLOTS].tobytes())
+                else:
+                    raw.extend(store.row(a, b))
+            return raw
+        # Same lookups as analyze_route.shard_segment_time: own-prefix shards
+        # through SHARD_CACHE, one prefix at a time so its shards stay cached
+        raw = array.array('f', bytes(4 * SLOTS * len(pairs)))
+        by_prefix = {}
+        for seg, (a, b) in enumerate(pairs):
+            by_prefix.setdefault(a[:2], []).append((seg, a, b))
+        for prefix, items in by_prefix.items():
+            for d in range(7):
+                for h in range(24):
+                    shard = analyze_route.load_hourly_shard(d, h, prefix)
+                    if not shard:
+                        continue
+                    for seg, a, b in items:
+                        val = shard.get(a, {}).get(b)
+                        if isinstance(val, (int, float)) and val > 0:
+                            raw[seg * SLOTS + d * 24 + h] = val
+            daily_shard = analyze_route.load_daily_times(prefix)
+            for seg, a, b in items:
+                daily = daily_shard.get(a, {}).get(b)
+                if not (isinstance(daily, (int, float)) and daily > 0):
+                    daily = None
+                base = seg * SLOTS
+                raw[base:base + SLOTS] = segment_store.fill_row(raw[base:base + SLOTS], daily)[0]
+        return raw
+
+    def _build_weights(self, segment_ids, locations):
+        pairs = sorted(segment_ids, key=segment_ids.get)
+        raw = self._segment_slots(pairs)
+        weights = array.array('f', bytes(4 * SLOTS * len(pairs)))
+        for seg, (a, b) in enumerate(pairs):
+            base = seg * SLOTS
+            row = raw[base:base + SLOTS]
+            known = [v for v in row if v > 0]
+            if known:
+                fallback = sum(known) / len(known)
+            else:
+                la, lb = locations[self.stop_index[a]], locations[self.stop_index[b]]
+                fallback = max(30.0, distance_m(la, lb) / BUS_SPEED_MPS) if la and lb else DEFAULT_SEGMENT_SECONDS
+            for d in range(7):
+                day = d * 24
+                for h in range(24):
+                    # Already filled like the ripple's lookups; slots no tier covers get the fallback
+                    v = row[day + h] or fallback
+                    weights[base + day + h] = v * TRAFFIC_FACTOR
+        return weights
+
+    def _build_walks(self, locations):
+        """Links stops within WALK_RADIUS_M using a coarse lat/lng grid."""
+        cell = WALK_RADIUS_M / 111000.0
+        grid = {}
+        for i, loc in enumerate(locations):
+            if loc:
+                grid.setdefault((int(loc[0] // cell), int(loc[1] // cell)), []).append(i)
+
+        self.walk_start = array.array('I', [0])
+        self.walk_to = array.array('I')
+        self.walk_secs = array.array('f')
+        for i, loc in enumerate(locations):
+            if loc:
+                cy, cx = int(loc[0] // cell), int(loc[1] // cell)
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        for j in grid.get((cy + dy, cx + dx), ()):
+                            if j == i:
+                                continue
+                            dist = distance_m(loc, locations[j])
+                            if dist <= WALK_RADIUS_M:
+                                self.walk_to.append(j)
+                                self.walk_secs.append(dist * WALK_DETOUR / WALK_SPEED_MPS)
+            self.walk_start.append(len(self.walk_to))
+
+    def weight(self, seg, day, t):
+        return self.weights[seg * SLOTS + (day + int(t // 86400)) % 7 * 24 + int(t // 3600) % 24]
+
+    def board_wait(self, p, day, t):
+        """Seconds until departure when reaching pattern p's stop at time t, or None if it is not running."""
+        d = (day + int(t // 86400)) % 7
+        if int(t // 3600) % 24 not in self.pattern_windows[p][d]:
+            return None
+        return self.pattern_waits[p][d]
+
+    def plan(self, origin, target, day, depart, max_transfers=2, walk=True):
+        """
+        Fastest journeys from stop index origin to target leaving at `depart`
+        (seconds after midnight of day code `day`). Returns a list of journeys
+        (one per number of transfers that improves the arrival time), each a
+        list of legs.
+        """
+        n = len(self.stop_ids)
+        best = [INF] * n
+        arrival = [INF] * n
+        parents = [{}]
+        best[origin] = arrival[origin] = depart
+        marked = {origin}
+        if walk:
+            for j in range(self.walk_start[origin], self.walk_start[origin + 1]):
+                s, t = self.walk_to[j], depart + self.walk_secs[j]
+                if t < best[s]:
+                    best[s] = arrival[s] = t
+                    parents[0][s] = ('walk', origin, depart)
+                    marked.add(s)
+
+        journeys = []
+        for k in range(1, max_transfers + 2):
+            previous = arrival[:]
+            round_parents = {}
+            parents.append(round_parents)
+
+            # Earliest marked position on every pattern serving a marked stop
+            queue = {}
+            for s in marked:
+                for j in range(self.served_start[s], self.served_start[s + 1]):
+                    p, pos = self.served_pattern[j], self.served_pos[j]
+                    if pos < queue.get(p, INF):
+                        queue[p] = pos
+
+            improved = set()
+            weights = self.weights
+            for p, first in queue.items():
+                stops = self.pattern_stops[p]
+                segs = self.pattern_segs[p]
+                n_segs = len(segs)
+                t = None
+                for pos in range(first, len(stops)):
+                    s = stops[pos]
+                    if t is not None:
+                        if t >= best[target]:
+                            # Already later than the best arrival: drop the trip
+                            t = None
+                        elif t < best[s]:
+                            best[s] = arrival[s] = t
+                            round_parents[s] = ('ride', p, board_pos, pos, board_time)
+                            improved.add(s)
+                    reach = previous[s]
+                    if reach < INF and (t is None or reach < t) and pos < n_segs:
+                        wait = self.board_wait(p, day, reach)
+                        if wait is not None and (t is None or reach + wait < t):
+                            board_pos, board_time = pos, reach
+                            t = reach + wait
+                    if t is not None and pos < n_segs:
+                        # Inlined self.weight(): this is the hot loop
+                        t += weights[segs[pos] * SLOTS + (day + int(t // 86400)) % 7 * 24 + int(t // 3600) % 24]
+
+            if walk:
+                # One walking leg after a ride; never onto a stop just reached
+                # by bus, so legs never chain two walks
+                ridden = set(improved)
+                for s in ridden:
+                    for j in range(self.walk_start[s], self.walk_start[s + 1]):
+                        w, t = self.walk_to[j], arrival[s] + self.walk_secs[j]
+                        if w not in ridden and t < best[w] and t < best[target]:
+                            best[w] = arrival[w] = t
+                            round_parents[w] = ('walk', s, arrival[s])
+                            improved.add(w)
+
+            if target in improved:
+                journeys.append(self._trace(parents, origin, target, k))
+            if not improved:
+                break
+            marked = improved
+        return journeys
+
+    def _trace(self, parents, origin, target, k):
+        """Rebuilds the legs of the round-k journey ending at target."""
+        legs = []
+        s = target
+        while s != origin:
+            # The label may have been set in an earlier round
+            while k >= 0 and s not in parents[k]:
+                k -= 1
+            if k < 0:
+                break
+            parent = parents[k][s]
+            if parent[0] == 'walk':
+                # Walks follow a ride of the same round (or leave the origin)
+                _, frm, start = parent
+                legs.append({"type": "walk", "from": frm, "to": s, "depart": start})
+                s = frm
+            else:
+                _, p, board_pos, alight_pos, reach_time = parent
+                legs.append({"type": "ride", "pattern": p, "board": board_pos, "alight": alight_pos, "reach": reach_time})
+                s = self.pattern_stops[p][board_pos]
+                k -= 1
+        legs.reverse()
+        return legs
+
+
+_graphs = OrderedDict()
+_graphs_lock = threading.Lock()
+
+
+def get_trip_graph(db):
+    """TripGraph for db and the current data version (the last two are kept)."""
+    key = (id(db), analyze_route.get_data_version())
+    graph = _graphs.get(key)
+    if graph is not None:
+        return graph
+    with _graphs_lock:
+        graph = _graphs.get(key)
+        if graph is None:
+            graph = TripGraph(db)
+            _graphs[key] = graph
+            while len(_graphs) > 2:
+                _graphs.popitem(last=False)
+    return graph
+
+
+def clock(t):
+    """'HH:MM' for seconds after midnight of the departure day, '+1' etc. past midnight."""
+    days, rest = divmod(int(round(t)), 86400)
+    label = f"{rest // 3600:02d}:{rest % 3600 // 60:02d}"
+    return label + (f"+{days}" if days else '')
+
+
+def plan_trip(db, from_id, to_id, day=1, hour=8, minute=0, max_transfers=2, walk=True):
+    """
+    Fastest journeys between two stop IDs for a departure at day/hour:minute.
+    Returns (status, payload) like the server's response builders.
+    """
+    graph = get_trip_graph(db)
+    origin = graph.stop_index.get(from_id)
+    target = graph.stop_index.get(to_id)
+    if origin is None or target is None:
+        return 404, {"error": "Unknown stop id"}
+    max_transfers = max(0, min(MAX_TRANSFERS, max_transfers))
+
+    depart = hour * 3600 + minute * 60
+    journeys = []
+    for legs in graph.plan(origin, target, day, depart, max_transfers, walk):
+        out = []
+        t = depart
+        for leg in legs:
+            if leg["type"] == "walk":
+                j = next(j for j in range(graph.walk_start[leg["from"]], graph.walk_start[leg["from"] + 1])
+                         if graph.walk_to[j] == leg["to"])
+                t = leg["depart"] + graph.walk_secs[j]
+                out.append({
+                    "type": "walk",
+                    "from": graph.stop_ids[leg["from"]], "from_name": graph.names[leg["from"]],
+                    "to": graph.stop_ids[leg["to"]], "to_name": graph.names[leg["to"]],
+                    "minutes": round(graph.walk_secs[j] / 60, 1)
+                })
+                continue
+            p = leg["pattern"]
+            stops, segs = graph.pattern_stops[p], graph.pattern_segs[p]
+            key = graph.pattern_variants[p][0]
+            route, variant = graph.index.variant_of[key]
+            wait = graph.board_wait(p, day, leg["reach"])
+            board_t = leg["reach"] + wait
+            t = board_t
+            for pos in range(leg["board"], leg["alight"]):
+                t += graph.weight(segs[pos], day, t)
+            out.append({
+                "type": "ride",
+                "route": route, "variant": variant, "key": key,
+                "dest": db['routeList'][key].get('dest', {}).get('en'),
+                "from": graph.stop_ids[stops[leg["board"]]], "from_name": graph.names[stops[leg["board"]]],
+                "to": graph.stop_ids[stops[leg["alight"]]], "to_name": graph.names[stops[leg["alight"]]],
+                "start": leg["board"], "end": leg["alight"],
+                "wait_minutes": round(wait / 60, 1),
+                "depart": clock(board_t), "arrive": clock(t)
+            })
+        journeys.append({
+            "arrive": clock(t),
+            "minutes": round((t - depart) / 60, 1),
+            "transfers": max(0, sum(1 for leg in out if leg["type"] == "ride") - 1),
+            "legs": out
+        })
+
+    return 200, {
+        "from": {"id": from_id, "name": graph.names[origin]},
+        "to": {"id": to_id, "name": graph.names[target]},
+        "day": day,
+        "depart": clock(depart),
+        "journeys": journeys
+    }